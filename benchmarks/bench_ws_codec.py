@@ -0,0 +1,85 @@
+"""
+WebSocket 接收热路径基准: 对比 "每帧 json.loads" 与 "预过滤 meta_event + 可选 orjson" 的吞吐
+
+用法: python benchmarks/bench_ws_codec.py [帧数] [meta_event 占比]
+"""
+import importlib.util
+import json
+import random
+import sys
+import time
+from pathlib import Path
+
+# 直接按文件加载 utils, 避免导入插件包时依赖 MCDR
+_UTILS_PATH = Path(__file__).resolve().parent.parent / "flex_interface" / "utils.py"
+_spec = importlib.util.spec_from_file_location("flex_utils", _UTILS_PATH)
+utils = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(utils)
+
+
+def build_frames(count, meta_ratio):
+    heartbeat = json.dumps({
+        "time": 1700000000, "self_id": 10001, "post_type": "meta_event", "meta_event_type": "heartbeat",
+        "status": {"app_initialized": True, "app_enabled": True, "app_good": True, "online": True, "good": True},
+        "interval": 5000
+    }, separators=(",", ":"))
+    message = json.dumps({
+        "time": 1700000000, "self_id": 10001, "post_type": "message", "message_type": "group",
+        "sub_type": "normal", "message_id": 123456, "group_id": 654321, "user_id": 112233,
+        "message": [{"type": "text", "data": {"text": '今天服务器谁在线? "post_type":"meta_event"'}}],
+        "raw_message": "今天服务器谁在线?", "font": 0,
+        "sender": {"user_id": 112233, "nickname": "玩家", "card": "群名片", "role": "member"}
+    }, ensure_ascii=False, separators=(",", ":"))
+    rng = random.Random(0)
+    return [heartbeat if rng.random() < meta_ratio else message for _ in range(count)]
+
+
+def baseline(frames):
+    """改动前: 每帧都 json.loads, 解析后再丢弃 meta_event"""
+    handled = 0
+    for frame in frames:
+        data = json.loads(frame)
+        if data.get("post_type") == "message":
+            handled += 1
+    return handled
+
+
+def optimized(frames):
+    """改动后: 先按字节特征跳过 meta_event, 其余帧交给可选的 orjson 解析"""
+    handled = 0
+    for frame in frames:
+        if utils.is_meta_event_frame(frame):
+            continue
+        data = utils.json_loads(frame)
+        if data.get("post_type") == "message":
+            handled += 1
+    return handled
+
+
+def run(func, frames, rounds=5):
+    best = float("inf")
+    result = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        result = func(frames)
+        best = min(best, time.perf_counter() - start)
+    return len(frames) / best, result
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    meta_ratio = float(sys.argv[2]) if len(sys.argv) > 2 else 0.5
+    frames = build_frames(count, meta_ratio)
+    codec = "orjson" if utils.orjson is not None else "json(标准库)"
+
+    base_fps, base_handled = run(baseline, frames)
+    opt_fps, opt_handled = run(optimized, frames)
+    assert base_handled == opt_handled, "预过滤结果与完整解析不一致"
+
+    print(f"帧数: {count}, meta_event 占比: {meta_ratio:.0%}, 解码器: {codec}")
+    print(f"改动前: {base_fps:,.0f} 帧/秒")
+    print(f"改动后: {opt_fps:,.0f} 帧/秒 ({opt_fps / base_fps:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,11 @@ from mcdreforged.api.types import PluginServerInterface, Info
 from mcdreforged.api.all import *
 from .manager_wsclient import WebSocketClient
 from .manager_autochat import AutoChat
+from .manager_outbox import Outbox
+from .manager_botpool import BotPool
+from .manager_transport import ReverseWebSocketServer, HttpTransport
+from .manager_dispatcher import CommandDispatcher, PRIORITY_NAMES
+from .manager_players import OnlinePlayers
 import minecraft_data_api as api
 import logging
 import threading
@@ -30,6 +35,8 @@ mysql_mgr = None
 manager_wsclient = None
 plugin_instance = None
 manager_autochat = None
+manager_dispatcher = None
+manager_online = None
 
 def on_load(server: PluginServerInterface, old):
     if not config:
@@ -48,13 +55,17 @@ def on_load(server: PluginServerInterface, old):
     server.logger.info("插件加载完毕 ✅")
 
 def on_unload(server: PluginServerInterface):
+    server.chat.close()  # 最后一次写入AI用量与上下文, 需在关闭数据库之前
     server.plugin.close()
-    server.wscl.stop()
+    server.dispatcher.close()
+    server.online.close()
+    server.wscl.close()
     server.plugin.mysql_mgr.close()
-    server.chat.close()
 def initialize_plugin_thread(server: PluginServerInterface):
     """初始化插件的线程"""
     try:
+        initialize_dispatcher(server)  # 所有MC指令经由调度器执行
+        initialize_online_players(server)
         plugin_instance = flexInterface(server)
         plugin_instance.initialize(config.get("mysql_config"))
         server.plugin = plugin_instance  # 挂载到server
@@ -66,31 +77,95 @@ def initialize_plugin_thread(server: PluginServerInterface):
         server.logger.critical(f"插件启动失败: {str(e)}")
         return
 
+def initialize_dispatcher(server: PluginServerInterface):
+    """初始化MC指令调度器"""
+    global manager_dispatcher
+    dispatcher_config = config.get("mc_dispatcher", {})
+    manager_dispatcher = CommandDispatcher(
+        server.execute,
+        is_running=server.is_server_running,
+        commands_per_tick=dispatcher_config.get("commands_per_tick", 20),
+        tick_interval=dispatcher_config.get("tick_interval", 0.05),
+        max_queue_size=dispatcher_config.get("max_queue_size", 2000),
+        max_coalesce=dispatcher_config.get("max_coalesce", 8),
+        chat_ttl=dispatcher_config.get("chat_ttl", 30)
+    )
+    server.dispatcher = manager_dispatcher  # 挂载到 server
+
+def initialize_online_players(server: PluginServerInterface):
+    """初始化在线玩家表"""
+    global manager_online
+    online_config = config.get("online_players", {})
+    manager_online = OnlinePlayers(
+        server,
+        reconcile_interval=online_config.get("reconcile_interval", 300),
+        list_timeout=online_config.get("list_timeout", 5)
+    )
+    server.online = manager_online  # 挂载到 server
+
 def initialize_websocket(server: PluginServerInterface):
-    """初始化WebSocket连接"""
+    """初始化WebSocket连接（配置了 bots 时为多账号, 否则使用 ws_url 单账号）"""
     global manager_wsclient
-    manager_wsclient = WebSocketClient(
-        config.get("ws_url"),
+    bot_configs = config.get("bots") or [{"name": "default", "ws_url": config.get("ws_url")}]
+    manager_wsclient = BotPool(
+        bot_configs,
         server.plugin.on_websocket_data,
-        server.plugin.on_ws_status_change
+        server.plugin.on_ws_status_change,
+        client_factory=lambda bot, on_message, on_status: create_ws_client(server, bot, on_message, on_status)
     )
     server.wscl = manager_wsclient  # 挂载到 server
     manager_wsclient.start()
 
+def create_ws_client(server: PluginServerInterface, bot: dict, on_message, on_status) -> WebSocketClient:
+    """按账号配置创建单个连接（mode: forward 正向WS / reverse 反向WS / http）, 每个账号有独立的发件箱目录"""
+    send_queue_config = config.get("ws_send_queue", {})
+    outbox_config = config.get("ws_outbox", {})
+    outbox = None
+    if outbox_config.get("enable", True):
+        outbox = Outbox(
+            server.get_data_folder() + f"/outbox/{bot['name']}",
+            memory_limit=outbox_config.get("memory_limit", 200),
+            max_items=outbox_config.get("max_items", 5000),
+            segment_size=outbox_config.get("segment_size", 500),
+            ttl=outbox_config.get("ttl", 600),
+            replay_rate=outbox_config.get("replay_rate", 2)
+        )
+    client_kwargs = dict(
+        max_queue_size=send_queue_config.get("max_size", 1000),
+        max_batch_size=send_queue_config.get("max_batch", 20),
+        outbox=outbox,
+        action_timeout=send_queue_config.get("action_timeout", 10),
+        max_in_flight=send_queue_config.get("max_in_flight", 64),
+        health_config=config.get("ws_health", {}),
+        name=bot["name"],
+        send_rate=bot.get("send_rate", 0)
+    )
+    mode = bot.get("mode", "forward")
+    if mode == "reverse":  # 插件监听, OneBot 反向连入
+        return ReverseWebSocketServer(
+            bot.get("host", "0.0.0.0"), bot.get("port", 8081), on_message, on_status,
+            path=bot.get("path", "/onebot/v11/ws"), access_token=bot.get("access_token"),
+            max_frame_size=bot.get("max_frame_size", 16 * 1024 * 1024), **client_kwargs
+        )
+    if mode == "http":  # HTTP POST 接收事件 + HTTP API 调用动作
+        return HttpTransport(
+            bot["api_url"], bot.get("host", "0.0.0.0"), bot.get("port", 8082), on_message, on_status,
+            path=bot.get("path", "/"), access_token=bot.get("access_token"), secret=bot.get("secret"), **client_kwargs
+        )
+    return WebSocketClient(bot["ws_url"], on_message, on_status, **client_kwargs)
+
 def initialize_autochat(server: PluginServerInterface):
     """初始化autochat实例"""
     global manager_autochat
     manager_autochat = AutoChat(server)
     server.chat = manager_autochat  # 挂载到 server
+    if manager_autochat.ai_enabled:
+        manager_autochat.ai_router.warmup()  # 提前完成TCP/TLS握手
 
 def initialize_group_info(server: PluginServerInterface):
-    """初始化群组信息"""
-    def _init():
-        time.sleep(5)  # 等待服务启动
-        payload = build_payload(type="get_group_list")
-        manager_wsclient.send_group_message(payload)
-        server.logger.info("群组初始化请求已发送")
-    threading.Thread(target=_init, daemon=True).start()
+    """初始化群组信息（未连接时由连接成功的回调负责拉取）"""
+    if manager_wsclient.is_connected():
+        threading.Thread(target=server.plugin.refresh_group_info, daemon=True).start()
 
 def register_event_listeners(server: PluginServerInterface):
     """注册所有事件监听器"""
@@ -113,12 +188,120 @@ def register_commands(server: PluginServerInterface):
     server.register_command(Literal('!!get_group_list').runs(
         lambda src: get_group_list_by_command(src, server)
     ))
+    server.register_command(Literal('!!flex_wsstats').runs(show_ws_stats))
+    server.register_command(Literal('!!flex_cmdstats').runs(
+        lambda src: show_cmd_stats(src, server)
+    ))
+    server.register_command(Literal('!!flex_aistats').runs(
+        lambda src: show_ai_stats(src, server)
+    ))
 
 def get_group_list_by_command(src: CommandSource, server: PluginServerInterface):
-    """处理获取群列表命令"""
-    payload = build_payload(type="get_group_list")
-    manager_wsclient.send_group_message(payload)
+    """处理获取群列表命令（等待响应可能要十几秒, 在后台线程中请求, 完成后回复）"""
+    def refresh():
+        if server.plugin.refresh_group_info():
+            src.reply('群列表已更新')
+        else:
+            src.reply('群列表更新失败')
+
     src.reply('正在更新群列表...')
+    threading.Thread(target=refresh, name="refresh_group_info", daemon=True).start()
+
+def show_ws_stats(source: CommandSource):
+    """显示每个机器人账号的连接健康状态与发送队列统计"""
+    for client in manager_wsclient.clients:
+        health = client.get_health()
+        rtt = f"{health['rtt_last'] * 1000:.0f}/{health['rtt_avg'] * 1000:.0f} ms" if health['rtt_last'] is not None else "未采样"
+        source.reply(
+            f"[{client.name}] 连接状态: {health['state']} | 在线时长: {int(health['uptime'])}s | "
+            f"重连次数: {health['reconnect_count']} | RTT 最近/平均: {rtt} | "
+            f"可发言群数: {len(manager_wsclient.get_groups(client)) or '全部'}"
+        )
+        stats = client.get_stats()
+        source.reply(
+            f"队列深度: {stats['queue_depth']} | 已发送: {stats['sent']} | "
+            f"丢弃(队列满/未连接): {stats['dropped_full']}/{stats['dropped_disconnected']} | 失败: {stats['failed']}"
+        )
+        if "outbox" in stats:
+            outbox_stats = stats["outbox"]
+            source.reply(
+                f"发件箱待补发: {stats['outbox_pending']} | 已暂存: {outbox_stats['buffered']} | "
+                f"已补发: {outbox_stats['replayed']} | 过期: {outbox_stats['expired']} | 丢弃: {outbox_stats['dropped']}"
+            )
+        source.reply(
+            f"发送延迟 最近/平均/最大: {stats['last_latency'] * 1000:.1f}/"
+            f"{stats['avg_latency'] * 1000:.1f}/{stats['max_latency'] * 1000:.1f} ms"
+        )
+        source.reply(
+            f"进行中的请求: {stats['calls_in_flight']} | 超时: {stats['calls_timeout']} | 拒绝: {stats['calls_rejected']}"
+        )
+    source.reply(f"多账号重复事件丢弃: {manager_wsclient.duplicate_events_dropped}")
+
+def show_cmd_stats(source: CommandSource, server: PluginServerInterface):
+    """显示MC指令调度器的队列与延迟统计, 以及整蛊效果的排队情况"""
+    stats = manager_dispatcher.get_stats()
+    depth = manager_dispatcher.queue_depth()
+    depth_detail = " ".join(f"{name}:{depth.get(priority, 0)}" for priority, name in PRIORITY_NAMES.items())
+    source.reply(
+        f"队列深度: {stats['queue_depth']} ({depth_detail}) | 已提交: {stats['submitted']} | "
+        f"已执行: {stats['executed']} | 合并: {stats['coalesced']} | 满载刻数: {stats['busy_ticks']}"
+    )
+    source.reply(
+        f"丢弃(队列满/过期): {stats['dropped_full']}/{stats['expired']} | 失败: {stats['failed']}"
+    )
+    source.reply(
+        f"排队延迟 最近/平均/最大: {stats['last_delay'] * 1000:.1f}/"
+        f"{stats['avg_delay'] * 1000:.1f}/{stats['max_delay'] * 1000:.1f} ms"
+    )
+    scheduler = server.plugin.effect_scheduler
+    effect_stats = scheduler.stats
+    source.reply(
+        f"整蛊效果 已执行: {effect_stats['executed']} | 排队: {effect_stats['queued']} | 合并: {effect_stats['merged']} | "
+        f"拒绝: {effect_stats['rejected']} | 下线丢弃: {effect_stats['dropped_offline']}"
+    )
+    for account in scheduler.pending():
+        effects = ", ".join(f"{name or '反弹'}×{count}({'、'.join(users)})" for name, count, users in scheduler.pending(account))
+        source.reply(f"  {account} 排队中: {effects}")
+    if scheduler.budget:
+        source.reply(f"实体/方块预算 通过: {scheduler.budget.stats['allowed']} | 降级: {scheduler.budget.stats['degraded']}")
+
+def show_ai_stats(source: CommandSource, server: PluginServerInterface):
+    """显示AI当天的 token 用量与费用（按功能、群、用户）, 以及各接口的延迟与熔断状态"""
+    chat = server.chat
+    ledger = chat.usage_ledger
+    report = ledger.report()
+    total = report["total"]
+    cached = total["cache_hit_tokens"] + total["cache_miss_tokens"]
+    source.reply(
+        f"今日AI请求: {total['requests']} | 输入: {total['prompt_tokens']} (缓存命中 "
+        f"{total['cache_hit_tokens'] / cached * 100 if cached else 0:.1f}%) | 输出: {total['completion_tokens']} | "
+        f"费用: {total['cost']:.4f}元"
+    )
+    for feature, stats in report["by_feature"].items():
+        source.reply(
+            f"  {feature}: 请求 {stats['requests']} | 输入 {stats['prompt_tokens']} | "
+            f"输出 {stats['completion_tokens']} | 费用 {stats['cost']:.4f}元"
+        )
+    source.reply(
+        f"用量最多的群(预算 {ledger.group_daily_tokens or '不限'}): "
+        + (", ".join(f"{group}={tokens}" for group, tokens in report["top_groups"]) or "无")
+    )
+    source.reply(
+        f"用量最多的用户(预算 {ledger.user_daily_tokens or '不限'}): "
+        + (", ".join(f"{user}={tokens}" for user, tokens in report["top_users"]) or "无")
+    )
+    router = chat.ai_router
+    source.reply(
+        f"对冲: {router.stats['hedged']} (胜出 {router.stats['hedge_wins']}) | 失败转移: {router.stats['failovers']} | "
+        f"无可用接口: {router.stats['unavailable']}"
+    )
+    for provider in router.providers:
+        ewma = provider.ewma or 0
+        p90 = provider.percentile(0.9) or 0
+        source.reply(
+            f"  {provider.name} [{provider.state()}] 延迟EWMA/p90: {ewma * 1000:.0f}/{p90 * 1000:.0f} ms | "
+            f"成功/失败: {provider.stats['success']}/{provider.stats['failed']}"
+        )
 
 def check_db_status(source: CommandSource):
     """检查数据库状态"""
@@ -1,7 +1,7 @@
 
 import time
 from .utils import *
-import online_player_api as ol_api
+from .manager_dispatcher import PRIORITY_EFFECT
 import datetime
 import hashlib
 
@@ -14,7 +14,7 @@ def bind_player(self, user_id, nickname, message_id, group_id, first_param, seco
     player_name = second_param  # 兼容大小写
     try:
         if player_name:
-            if ol_api.check_online(player_name):
+            if player_name in self.server.online:
                 if bind_model == 1:  # 严格绑定
                     # 1. 检查是否已绑定
                     if player_name in self.binding_mgr.get_user_bindings(user_id):
@@ -51,7 +51,7 @@ def _verify_binding(self, user_id: str, player_name: str, group_id: int, message
             "bold": False 
         }
 
-        self.server.execute(f"tellraw {player_name} {json.dumps(message)}")
+        self.server.dispatcher.submit(f"tellraw {player_name} {json_dumps(message)}")
         # 启动60秒后自动清理的线程
         threading.Timer(60.0, _clean_expired_binding, args=(self, player_name,)).start()
         return "✅ 已发送绑定请求, 请登录该账号并在聊天框输入「确认绑定」(60s有效)"
@@ -114,38 +114,33 @@ def get_ai_characters(self, *args):
 
 
 def can_send_record(self, *args):
-    payload =  {
-        "action": "can_send_record",
-        "params": {},
-        "echo": "can_send_record"
-    }
-    self.server.wscl.send_group_message(payload)
-
-    format_text = "请求已发送"
-    return format_text
+    result = self.server.wscl.call_action_sync("can_send_record")
+    if result is None:
+        return "查询失败，请稍后再试"
+    return "可以发送语音" if result.get("yes") else "当前无法发送语音"
 
 def get_group_list(self, *args):
-    type = "get_group_list"
-    payload = build_payload(type)
-    self.server.wscl.send_group_message(payload)
-    format_text = "群组信息已更新"
-    return format_text
+    if self.refresh_group_info():
+        return "群组信息已更新"
+    return "群组信息更新失败"
 
 def online_info(self, *args):
     """获取玩家列表并通知"""
-    amount, limit, players = self.mc_api.get_server_player_list()
+    players = self.server.online.players()
     if players:
         player_str = "，".join(players)  # 用中文逗号分隔
-        format_text = f"[CQ:face,id=161] 当前有 {amount} 个人在摸鱼: [{player_str}]"
+        format_text = f"[CQ:face,id=161] 当前有 {len(players)} 个人在摸鱼: [{player_str}]"
     else:
         format_text = f"[CQ:face,id=161] 服务器倒闭了"
     return format_text
 
 
 def stop_server(self, user_id, *args):
-    self.server.execute('tellraw @a {"text":"[服务器将在 10 秒后关闭]","color":"gray"}')
-    self.server.execute("title @a title {\"text\":\"注意!\",\"color\":\"red\"}")
-    self.server.execute("title @a subtitle {\"text\":\"服务器将在 10 秒后关闭\",\"color\":\"gray\"}")
+    self.server.dispatcher.submit([
+        'tellraw @a {"text":"[服务器将在 10 秒后关闭]","color":"gray"}',
+        "title @a title {\"text\":\"注意!\",\"color\":\"red\"}",
+        "title @a subtitle {\"text\":\"服务器将在 10 秒后关闭\",\"color\":\"gray\"}"
+    ], PRIORITY_EFFECT)
     time.sleep(11)
     self.server.execute("stop") 
     return f"{user_id}已尝试关闭服务器"
@@ -159,7 +154,7 @@ def sign_in(self, user_id, card, message_id, group_id, *args) -> str:
     try:
         message, message_to_mc = self.sign_handler.sign_in(user_id, card)
         if message_to_mc:
-            self.server.execute(f'tellraw @a {{\"text\":\"{message_to_mc}\",\"color\":\"gray\"}}')
+            self.server.dispatcher.tellraw_all(f'{{\"text\":\"{message_to_mc}\",\"color\":\"gray\"}}')
 
         return message
     except Exception as e:
@@ -173,7 +168,7 @@ def lucky_rank(self, *args) -> str:
     try:
         msg, msg2mc = self.sign_handler.format_lucky_ranking()
         if msg2mc:
-            self.server.execute(f'tellraw @a {{\"text\":\"{msg2mc}\",\"color\":\"gray\"}}')
+            self.server.dispatcher.tellraw_all(f'{{\"text\":\"{msg2mc}\",\"color\":\"gray\"}}')
         return msg
     except Exception as e:
         self.server.logger.warn(f"幸运排行榜查询失败：{e}", exc_info=True)
@@ -186,7 +181,7 @@ def my_info(self, user_id, nick_name, *args) -> str:
     try:
         sign_info, message_to_qq = self.sign_handler.query_user_sign_info(user_id, nick_name)
         if message_to_qq:
-            self.server.execute(f'tellraw @a {{\"text\":\"{message_to_qq}\",\"color\":\"gray\"}}')
+            self.server.dispatcher.tellraw_all(f'{{\"text\":\"{message_to_qq}\",\"color\":\"gray\"}}')
         # 返回用户签到信息
         return sign_info
     except Exception as e:
@@ -310,12 +305,12 @@ def double_xp(self, *args) -> str:
         if current_state:
             # 关闭双倍经验
             self.server.xpboost_status = False
-            self.server.execute("xprate clear")
+            self.server.dispatcher.submit("xprate clear")
             new_state = "false"
         else:
             # 开启双倍经验
             self.server.xpboost_status = True
-            self.server.execute("xprate 2 on")
+            self.server.dispatcher.submit("xprate 2 on")
             new_state = "true"
         state_str = "开启" if new_state == "true" else "关闭"
         bot_name = self.server.config.get('bot_name')
@@ -337,8 +332,7 @@ def show_xprate(self, player: str) -> None:
             f'title {player} title {{"text":"MCMMO 活动！","color":"gold"}}',
             f'title {player} subtitle {{"text":"双倍技能经验开启中！","color":"yellow"}}',
         ]
-            for cmd in commands:
-                self.server.execute(cmd)
+            self.server.dispatcher.submit(commands, PRIORITY_EFFECT)
 
 
     except Exception as e:
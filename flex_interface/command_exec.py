@@ -2,7 +2,6 @@ import logging
 from .handler_effect_cmd import EffectCommands  
 from .manager_config import config
 from mcdreforged.api.all import *
-import online_player_api as ol_api
 import random
 from .utils import *
 from .manager_config import config
@@ -64,8 +63,11 @@ def trick_binded_player(self, user_id: str, args: list) -> str:
             if not game_accounts:
                 return f"QQ {qq_id} 未绑定游戏账号"
             
-            # 执行效果
+            # 执行效果（按目标账号排队, 冷却中的效果排队或合并）
+            method_name = effect_config.get(effect_type)
             online_accounts = []
+            queued_accounts = []
+            busy_accounts = []
             emerald_drops = 0
             pass_judge = False
             msg = ""
@@ -77,12 +79,21 @@ def trick_binded_player(self, user_id: str, args: list) -> str:
 
             else:
                 for account in game_accounts:
-                    if ol_api.check_online(account):
-                        online_accounts.append(account)  # 不管是否成功 都算消耗
+                    if account in self.server.online:
+                        if not self.effect_scheduler.can_accept(account, method_name):
+                            busy_accounts.append(account)  # 排队已满, 不消耗道具
+                            continue
                         # 根据成功率决定是否执行
-                        commands, msg, emerald_drops = EffectCommands.get_effect(effect_type, account, user_name, effect_config, luck_number)
-                        for cmd in commands:
-                            self.server.execute(cmd)
+                        commands, effect_msg, drops = EffectCommands.get_effect(effect_type, account, user_name, effect_config, luck_number)
+                        # 失败反弹的效果不参与合并
+                        status = self.effect_scheduler.schedule(account, commands, method_name if drops == 0 else None, user_name)
+                        if status == "rejected":
+                            busy_accounts.append(account)  # 检查之后排队被占满, 同样不消耗道具
+                            continue
+                        online_accounts.append(account)  # 不管是否成功 都算消耗
+                        msg, emerald_drops = effect_msg, drops
+                        if status in ("queued", "merged"):
+                            queued_accounts.append(account)
                         if effect_type == "机票": # 机票仅对一个在线账户生效
                             break
                     
@@ -102,11 +113,15 @@ def trick_binded_player(self, user_id: str, args: list) -> str:
                         self.sign_handler.update_emerald_drops(user_id, emerald_drops)
 
                     msg = msg.format(account_list=", ".join(online_accounts))  # mc所有的信息全部在handler内部执行了, only QQ return
+                    if queued_accounts:
+                        msg += f"\n（{', '.join(queued_accounts)} 正在冷却，效果已排队）"
                     
                     return box_msg if box_msg else msg  # 如果有message 那就一定是pass_judge
                 except ValueError:
                     return f"你没有足够的[{effect_type}]道具（需要 {consume_count} 个）"
             
+            if busy_accounts:
+                return f"{', '.join(busy_accounts)} 排队中的整蛊太多了，请稍后再试（道具未消耗）"
             return "目标玩家不在线"
         
         except Exception as e:
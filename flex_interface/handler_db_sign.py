@@ -3,6 +3,7 @@ import logging
 from datetime import date, timedelta
 import datetime
 import time
+from .manager_dispatcher import PRIORITY_ECONOMY
 class PlayerSignManager:
     def __init__(self, server, mysql_mgr, binding_mgr, prize_config):
         self.server = server
@@ -678,8 +679,7 @@ class PlayerSignManager:
                 f'title {username} subtitle {{"text":"你的余额 {emerald_delta:+}","color":"dark_green"}}',
                 f'cmi sound entity.player.levelup {username}',  # 增加经验音效
             ]
-            for cmd in cmds:
-                self.server.execute(cmd)
+            self.server.dispatcher.submit(cmds, PRIORITY_ECONOMY)
                 
             if balance_result:
                 new_balance = balance_result[0]['Balance'] + emerald_delta
@@ -2,7 +2,18 @@ from typing import List, Tuple
 from .manager_config import config
 import random
 import json
+import logging
+import math
+import threading
+import time
+from collections import deque
+import hashlib
+import re
+from pathlib import Path
+logger = logging.getLogger("effect_cmd")
+
 class EffectCommands:
+    datapack = None  # 已生成的数据包(EffectDatapack), 为 None 时逐条执行指令
     @staticmethod
     def get_effect(effect_type: str, account: str, user_name: str, at_effect_config: dict, luck_number: int) -> Tuple[List[str], str, int]:
         """
@@ -36,6 +47,8 @@ class EffectCommands:
             
             method = getattr(EffectCommands, method_name)
             commands, msg = method(account, user_name)  # 先解包
+            if EffectCommands.datapack and EffectCommands.datapack.is_compiled(method_name):
+                commands = [EffectCommands.datapack.function_call(method_name, account, user_name)]  # 一条 function 指令代替整组指令
             return commands, msg, emerald_drops         # 再组合返回
         else:
             # 生成绿宝石掉落数量(成功为正数，失败为负数)
@@ -43,6 +56,18 @@ class EffectCommands:
             commands, msg = EffectCommands.failed_effect(account, user_name, abs(emerald_drops))
             return commands, msg, emerald_drops
         
+    EFFECT_DURATION_PATTERN = re.compile(r"^(effect give \S+ \S+ )(\d+)")
+
+    @staticmethod
+    def build_merged(method_name: str, account: str, user_names: List[str], count: int) -> List[str]:
+        """多次同种效果合并为一次: 状态效果时长乘以合并次数, 提示中列出所有发起人"""
+        user_name = "、".join(dict.fromkeys(user_names))
+        commands, _ = getattr(EffectCommands, method_name)(account, user_name)
+        return [
+            EffectCommands.EFFECT_DURATION_PATTERN.sub(lambda m: f"{m.group(1)}{int(m.group(2)) * count}", cmd)
+            for cmd in commands
+        ]
+
     @staticmethod  # 添加装饰器
     def failed_effect(account: str, user_name: str, emerald_drops: int) -> Tuple[List[str], str]:
         fail_messages = [
@@ -66,9 +91,9 @@ class EffectCommands:
         commands = [
             f'tellraw @a {{"text":{json.dumps(f"[{failed_msg}]")},"color":"gray","italic":true}}'
         ]
-        for _ in range(emerald_drops):
-            commands.append(
-            f"""execute as {account} at @s run summon item ^ ^3 ^-5 {{Item:{{id:"minecraft:emerald",Count:1b}},Motion:[0.0,-0.25,0.2],PickupDelay:40}}""")
+        # 一个堆叠的掉落物代替 N 个实体; count 为 1.20.5+ 写法, Count 兼容旧版本
+        commands.append(
+            f"""execute as {account} at @s run summon item ^ ^3 ^-5 {{Item:{{id:"minecraft:emerald",count:{emerald_drops},Count:{emerald_drops}b}},Motion:[0.0,-0.25,0.2],PickupDelay:40}}""")
         
         return commands, failed_msg
     
@@ -267,4 +292,199 @@ class EffectCommands:
             f'tellraw @a {{"text":"[{qq_id} 让 {account} 进入了子弹时间！]","color":"gray"}}'
         ]
         success_msg = f"成功让 {account} 时间流速变慢了！⏳"
-        return commands, success_msg
\ No newline at end of file
+        return commands, success_msg
+
+
+class EffectDatapack:
+    """
+    把 EffectCommands 中的整蛊效果编译成数据包函数(1.20.2+ 宏函数),
+    每次整蛊只需执行一条 function flex:effect/<name> {account:"...",from:"..."}
+    """
+    PACK_FORMAT = 18  # 1.20.2, 第一个支持函数宏的版本
+    MIN_VERSION = (1, 20, 2)
+    # 含随机分支的效果无法固定成函数, 以及依赖插件指令(非原版)的效果, 保留逐条执行
+    RANDOMIZED_EFFECTS = {"creeper_sound"}
+    VANILLA_COMMANDS = {
+        "effect", "execute", "fill", "summon", "title", "tellraw", "playsound", "particle",
+        "spreadplayers", "tp", "scoreboard", "data", "give", "clear", "setblock"
+    }
+
+    def __init__(self, world_path, namespace="flex"):
+        self.pack_path = Path(world_path) / "datapacks" / namespace
+        self.namespace = namespace
+        self.compiled = set()
+
+    @staticmethod
+    def supports_version(version: str) -> bool:
+        """判断服务端版本是否支持函数宏, 无法解析的版本视为不支持"""
+        try:
+            parts = tuple(int(p) for p in version.split("-")[0].split(".")[:3])
+        except (AttributeError, ValueError):
+            return False
+        return parts + (0,) * (3 - len(parts)) >= EffectDatapack.MIN_VERSION
+
+    def _compile_effect(self, method_name: str):
+        """用宏占位符生成效果的指令, 返回函数文件内容; 不能编译时返回 None"""
+        if method_name in self.RANDOMIZED_EFFECTS:
+            return None
+        method = getattr(EffectCommands, method_name, None)
+        if not callable(method):
+            return None
+        commands, _ = method("$(account)", "$(from)")
+        lines = []
+        for cmd in commands:
+            if cmd.split(" ", 1)[0] not in self.VANILLA_COMMANDS:
+                return None
+            lines.append(f"${cmd}" if "$(" in cmd else cmd)
+        return "\n".join(lines) + "\n"
+
+    def build(self, method_names) -> bool:
+        """
+        生成数据包文件, 返回文件内容是否有变化（有变化且服务器运行中时需要 reload）
+        :param method_names: 需要编译的效果方法名
+        """
+        files = {
+            "pack.mcmeta": json.dumps({"pack": {
+                "pack_format": self.PACK_FORMAT,
+                "supported_formats": {"min_inclusive": self.PACK_FORMAT, "max_inclusive": 99},
+                "description": "flex_interface 整蛊效果"
+            }}, ensure_ascii=False, indent=2)
+        }
+        self.compiled = set()
+        for method_name in sorted(set(method_names)):
+            content = self._compile_effect(method_name)
+            if content is None:
+                continue
+            self.compiled.add(method_name)
+            # 1.21 起目录名由 functions 改为 function, 两个都写上以兼容
+            for folder in ("functions", "function"):
+                files[f"data/{self.namespace}/{folder}/effect/{method_name}.mcfunction"] = content
+
+        changed = False
+        for rel_path, content in files.items():
+            path = self.pack_path / rel_path
+            if path.exists() and hashlib.md5(path.read_bytes()).digest() == hashlib.md5(content.encode("utf-8")).digest():
+                continue
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(content, encoding="utf-8")
+            changed = True
+        logger.info(f"整蛊数据包已生成: {self.pack_path}, 编译 {len(self.compiled)} 个效果, 文件{'有' if changed else '无'}变化")
+        return changed
+
+    def is_compiled(self, method_name: str) -> bool:
+        return method_name in self.compiled
+
+    @staticmethod
+    def _nbt_string(value: str) -> str:
+        return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+    def function_call(self, method_name: str, account: str, user_name: str) -> str:
+        return (
+            f"function {self.namespace}:effect/{method_name} "
+            f"{{account:{self._nbt_string(account)},from:{self._nbt_string(user_name)}}}"
+        )
+
+
+class EffectBudget:
+    """
+    限制整蛊效果生成的实体(summon)与方块修改(fill)数量:
+    - 每个区块、全服每分钟各有上限
+    - 一次效果整体判断, 超出预算时其中的 summon/fill 换成粒子, 标题、药水、音效、广播照常执行
+    """
+    WORLD_EDIT_PATTERN = re.compile(r"^execute (?:as (\S+) at @s|at (\S+)) run (summon|fill) (.*)$")
+    FUNCTION_PATTERN = re.compile(r"^function \S+:effect/")
+
+    def __init__(self, locate=None, chunk_entities=6, chunk_blocks=64, minute_entities=30, minute_blocks=300, window=60):
+        """
+        :param locate: 返回玩家 (维度, x, z) 的函数, 获取失败返回 None（此时按玩家本身计区块预算）
+        """
+        self.locate = locate
+        self.chunk_entities = chunk_entities
+        self.chunk_blocks = chunk_blocks
+        self.minute_entities = minute_entities
+        self.minute_blocks = minute_blocks
+        self.window = window
+        self._records = deque()  # (时间, 区块, 实体数, 方块数)
+        self._lock = threading.Lock()
+        self.stats = {"allowed": 0, "degraded": 0}
+
+    @staticmethod
+    def _fill_volume(args: str) -> int:
+        """估算 fill 修改的方块数（相对坐标 ~N 取偏移量, 绝对坐标按原值计算）"""
+        coords = []
+        for token in args.split()[:6]:
+            try:
+                coords.append(float(token.lstrip("~^") or 0))
+            except ValueError:
+                return 1
+        if len(coords) < 6:
+            return 1
+        return int(math.prod(abs(coords[i + 3] - coords[i]) + 1 for i in range(3)))
+
+    def _cost(self, commands):
+        entities = blocks = 0
+        for cmd in commands:
+            match = self.WORLD_EDIT_PATTERN.match(cmd)
+            if not match:
+                continue
+            if match.group(3) == "summon":
+                entities += 1
+            else:
+                blocks += self._fill_volume(match.group(4))
+        return entities, blocks
+
+    def _chunk_of(self, account):
+        position = None
+        if self.locate:
+            try:
+                position = self.locate(account)
+            except Exception as e:
+                logger.warning(f"获取 {account} 的位置失败: {e}")
+        if not position:
+            return ("player", account)
+        dimension, x, z = position
+        return (dimension, math.floor(x) >> 4, math.floor(z) >> 4)
+
+    def _used(self, now, chunk):
+        while self._records and now - self._records[0][0] > self.window:
+            self._records.popleft()
+        total_entities = total_blocks = chunk_entities = chunk_blocks = 0
+        for _, record_chunk, entities, blocks in self._records:
+            total_entities += entities
+            total_blocks += blocks
+            if record_chunk == chunk:
+                chunk_entities += entities
+                chunk_blocks += blocks
+        return total_entities, total_blocks, chunk_entities, chunk_blocks
+
+    def apply(self, account: str, commands: List[str], expand=None) -> List[str]:
+        """
+        按预算处理一次效果的指令, 返回实际执行的指令
+        :param expand: 返回效果原始指令的函数, 指令是数据包 function 调用时用于计算开销和降级
+        """
+        raw = commands
+        if expand and any(self.FUNCTION_PATTERN.match(cmd) for cmd in commands):
+            raw = expand()
+        entities, blocks = self._cost(raw)
+        if not entities and not blocks:
+            return commands
+        chunk = self._chunk_of(account)
+        with self._lock:
+            now = time.time()
+            total_entities, total_blocks, chunk_entities, chunk_blocks = self._used(now, chunk)
+            if (total_entities + entities <= self.minute_entities and total_blocks + blocks <= self.minute_blocks
+                    and chunk_entities + entities <= self.chunk_entities and chunk_blocks + blocks <= self.chunk_blocks):
+                self._records.append((now, chunk, entities, blocks))
+                self.stats["allowed"] += 1
+                return commands
+            self.stats["degraded"] += 1
+        logger.info(f"{account} 所在区块的整蛊预算已用完，效果降级为粒子（实体 {entities}, 方块 {blocks}）")
+        return [self._degrade(cmd) for cmd in raw]
+
+    def _degrade(self, cmd: str) -> str:
+        match = self.WORLD_EDIT_PATTERN.match(cmd)
+        if not match:
+            return cmd
+        anchor = match.group(1) or match.group(2)
+        particle = "minecraft:poof" if match.group(3) == "summon" else "minecraft:cloud"
+        return f"execute at {anchor} run particle {particle} ~ ~1 ~ 0.6 0.6 0.6 0.02 20"
@@ -16,6 +16,10 @@ from collections import defaultdict
 from .handler_db_bind import SimplePendingBindManager
 from .handler_db_bind import PlayerBindingManager
 from .handler_db_sign import PlayerSignManager
+from .manager_shaper import GroupShaper
+from .manager_effect_queue import EffectScheduler
+from .manager_dispatcher import PRIORITY_EFFECT
+from .handler_effect_cmd import EffectCommands, EffectDatapack, EffectBudget
 from collections import defaultdict, deque
 import time
 # 获取 Logger 对象
@@ -24,6 +28,17 @@ logger = logging.getLogger("main")
 # "今日行情": {"command": "query_market_trend", "message_type": "reply", "permission": "default","times_limit": 5},
         # "机票": "fly_charge",
             # {"name": "机票", "rarity": 7, "category": "QQ", "base_amount": 1, "sell_price": 500},
+class _SentenceForwarder:
+    """流式 AI 回复的逐句转发器, 记录已经发出的句数（为 0 时由调用方整段发送）"""
+    def __init__(self, send):
+        self.send = send  # send(句子, 序号)
+        self.sent = 0
+
+    def __call__(self, sentence):
+        self.send(sentence, self.sent)
+        self.sent += 1
+
+
 class flexInterface:
     def __init__(self, server: PluginServerInterface):
         self.server = server
@@ -38,10 +53,51 @@ class flexInterface:
         self.pending_bindings = {}
         self.lock = threading.Lock() 
         self.user_command_timestamps = defaultdict(lambda: deque())
+        # 事件去重: 重连或重复推送时同一个 message_id 只处理一次
+        dedup_config = config.get("event_dedup", {})
+        self.recent_message_ids = RecentIdSet(
+            maxlen=dedup_config.get("max_ids", 2048),
+            ttl=dedup_config.get("ttl", 300)
+        )
+        self.duplicate_events_dropped = 0
+        # 出站整形: 转发类消息按群合并限速, 指令与AI回复走优先通道
+        shaper_config = config.get("relay_shaper", {})
+        self.shaper = GroupShaper(
+            lambda payload: self.server.wscl.send_group_message(payload),
+            merge_window=shaper_config.get("merge_window", 1.5),
+            max_merge_lines=shaper_config.get("max_merge_lines", 10),
+            max_pending_lines=shaper_config.get("max_pending_lines", 50),
+            rate=shaper_config.get("rate", 0.5),
+            burst=shaper_config.get("burst", 3)
+        )
+        # 整蛊效果按目标账号排队, 冷却期间的同种效果合并
+        effect_queue_config = config.get("effect_queue", {})
+        budget_config = config.get("effect_budget", {})
+        effect_budget = None
+        if budget_config.get("enable", True):
+            effect_budget = EffectBudget(
+                locate=self.locate_player,
+                chunk_entities=budget_config.get("chunk_entities", 6),
+                chunk_blocks=budget_config.get("chunk_blocks", 64),
+                minute_entities=budget_config.get("minute_entities", 30),
+                minute_blocks=budget_config.get("minute_blocks", 300)
+            )
+        self.effect_scheduler = EffectScheduler(
+            lambda commands: self.server.dispatcher.submit(commands, PRIORITY_EFFECT),
+            EffectCommands.build_merged,
+            is_online=lambda account: account in self.server.online,
+            cooldown=effect_queue_config.get("cooldown", 10),
+            max_pending=effect_queue_config.get("max_pending", 5),
+            merge_rules=effect_queue_config.get("merge", {
+                "freeze_effect": 3, "get_vertigo_commands": 3, "hunger_effect": 3, "jump_effect": 3, "time_slow_effect": 2
+            }),
+            budget=effect_budget
+        )
     def initialize(self, config_db):
         """统一初始化所有组件"""
         self.__initialize_database(config_db)  # 挂载数据库
         self.__initialize_handlers()  # 获取功能类实体 绑定，签到
+        self.initialize_effect_datapack()  # 整蛊效果编译为数据包函数
 
     def __initialize_database(self, config_db):
         """私有方法：初始化数据库连接"""
@@ -66,6 +122,43 @@ class flexInterface:
         self.sign_handler = PlayerSignManager(self.server, self.mysql_mgr, self.binding_mgr, config.get("prize_config"))
     
     
+    def initialize_effect_datapack(self):
+        """生成整蛊效果数据包; 服务器已在运行且文件有变化时执行 reload 使其生效"""
+        datapack_config = config.get("effect_datapack", {})
+        if not datapack_config.get("enable", False):
+            return
+        try:
+            datapack = EffectDatapack(datapack_config.get("world_path", "server/world"))
+            changed = datapack.build(config.get("at_effect_config", {}).values())
+            EffectCommands.datapack = datapack
+            if self.server.is_server_startup():
+                self.check_effect_datapack_version()
+                if changed and EffectCommands.datapack:
+                    self.server.execute("reload")
+        except Exception as e:
+            EffectCommands.datapack = None
+            self.server.logger.error(f"整蛊数据包生成失败，使用逐条指令: {e}", exc_info=True)
+
+    def check_effect_datapack_version(self):
+        """服务端版本低于 1.20.2（不支持函数宏）时退回逐条执行指令"""
+        if not EffectCommands.datapack:
+            return
+        version = self.server.get_server_information().version
+        if version and not EffectDatapack.supports_version(version):
+            self.server.logger.warning(f"服务端版本 {version} 不支持函数宏，整蛊效果改为逐条执行指令")
+            EffectCommands.datapack = None
+
+    def locate_player(self, player: str):
+        """
+        从玩家快照中取 (维度, x, z), 用于整蛊效果的区块预算
+        在效果调度线程中调用, 只读缓存不等待查询; 未命中时按未知区块处理
+        """
+        snapshot = self.server.chat.snapshots.peek(player)
+        if not snapshot or "Pos" not in snapshot:
+            return None
+        pos = snapshot["Pos"]
+        return snapshot.get("Dimension", "minecraft:overworld"), pos[0], pos[2]
+
     def parse_message(self, content, prefix_to_match=["world", "Mainland","world_nether","world_the_end"]):
         # 如果提供了 prefix_to_match，检查 [prefix] 是否在 prefix_to_match 列表中
         for prefix in prefix_to_match:
@@ -108,21 +201,26 @@ class flexInterface:
     def on_server_start(self, server_interface: PluginServerInterface):
         """服务器启动事件"""
         self.server.logger.info("服务器已启动")
+        self.server.online.reconcile_async()
+        self.check_effect_datapack_version()
         self.handle_server_start()
         
     def on_server_stop(self, server_interface: PluginServerInterface, *_):
         """服务器停止事件"""
         self.server.logger.info("服务器已停止")
+        self.server.online.clear()
         self.handle_server_stop()
 
     def on_player_joined(self, server_interface: PluginServerInterface, player: str, _):
         """玩家加入事件"""
         self.server.logger.info(f"玩家 {player} 加入了游戏")
+        self.server.online.on_join(player)
         threading.Thread(target=self.handle_player_join, args=(player,)).start()
 
     def on_player_left(self, server_interface: PluginServerInterface, player: str):
         """玩家离开事件"""
         self.server.logger.info(f"玩家 {player} 离开了游戏")
+        self.server.online.on_left(player)
         threading.Thread(target=self.handle_player_left, args=(player,)).start()
 
     def on_player_death(self, server: PluginServerInterface, player, event, content):
@@ -153,22 +251,23 @@ class flexInterface:
             message_formated = f"[地狱] {player}: {message}"
         elif prefix == "world_the_end":
             message_formated = f"[末地] {player}: {message}"
-        payload = build_payload(message_type, self.group_ids_aync_chat, message_formated)
-        
-        self.server.wscl.send_group_message(payload)
+        self.shaper.submit(self.group_ids_aync_chat, message_formated)
 
-        ai_response = self.server.chat.generate_ai_response(context=message, source="MC玩家",user=player)
-        if ai_response:
-            message_2 = f"{ai_response}"
-            payload_2 = build_payload(message_type, self.group_ids_aync_chat, message_2)
-            self.server.wscl.send_group_message(payload_2)
+        def send_ai_reply(text, index=0):
+            payload_2 = build_payload(message_type, self.group_ids_aync_chat, text)
+            self.shaper.send_priority(payload_2)
             send_to_mc_message = {
                 "text": "",
                 "extra": [
-                    {"text": f"[Creep] {ai_response} "}
+                    {"text": f"[Creep] {text} "}
                 ]
             }
-            self.server.execute(f'tellraw @a {json.dumps(send_to_mc_message, ensure_ascii=False)}')
+            self.server.dispatcher.tellraw_all(send_to_mc_message)
+
+        forwarder = _SentenceForwarder(send_ai_reply)  # 流式输出时逐句发送
+        ai_response = self.server.chat.generate_ai_response(context=message, source="MC玩家",user=player, on_sentence=forwarder)
+        if ai_response and not forwarder.sent:
+            send_ai_reply(ai_response)
 
     def _handle_binding_confirmation(self, player_name: str):
         """处理玩家确认绑定的回调（线程中执行）"""
@@ -179,7 +278,7 @@ class flexInterface:
                     "text": f"[绑定系统] 当前没有绑定请求，或绑定请求已超时",
                     "color": "yellow",
                     }
-                    self.server.execute(f"tellraw {player_name} {json.dumps(message_to_mc)}")
+                    self.server.dispatcher.submit(f"tellraw {player_name} {json_dumps(message_to_mc)}")
                     return  # 没有对应的绑定请求
                 # 获取绑定请求信息
                 user_id, group_id, msg_id, timestamp = self.pending_bindings.pop(player_name)
@@ -197,7 +296,7 @@ class flexInterface:
                 "text": f"[绑定系统] 已成功将 {player_name} 绑定至QQ: {user_id}",
                 "color": "green",
                 }
-            self.server.execute(f"tellraw {player_name} {json.dumps(message_to_mc)}")
+            self.server.dispatcher.submit(f"tellraw {player_name} {json_dumps(message_to_mc)}")
             
         except Exception as e:
             self.server.logger.error(f"绑定确认回调出错: {str(e)}")
@@ -231,34 +330,26 @@ class flexInterface:
 
     def handle_player_join(self, player: str):
         """处理玩家加入事件"""
-        message_type = "default"
         message = f"[CQ:face,id=151] {player}开始摸鱼了~"
-        payload = build_payload(message_type, self.group_ids_aync_chat, message)
-        self.server.wscl.send_group_message(payload)
+        self.shaper.submit(self.group_ids_aync_chat, message)
         self.sign_handler.apply_emerald_to_player_on_join(player)  # 玩家加入时同步绿宝石账户
         bot_command_exec.show_xprate(self, player)  # 玩家加入时显示当前经验倍率
         
     def handle_player_left(self, player: str):
         """处理玩家离开事件"""
-        message_type = "default"
         message = f"[CQ:face,id=151] {player}停止了摸鱼~"
-        payload = build_payload(message_type, self.group_ids_aync_chat, message)
-        self.server.wscl.send_group_message(payload)
+        self.shaper.submit(self.group_ids_aync_chat, message)
         self.sign_handler.sync_balance_from_cmi()  # 每当玩家退出,统一将CMI的经济缓存到cache_current(cmi也是在玩家退出后才更新economy字段)
 
     def handle_player_death(self, message):
         """处理玩家死亡事件"""
-        message_type = "default"
         message = "[CQ:face,id=37] " + message
-        payload = build_payload(message_type, self.group_ids_aync_chat, message)
-        self.server.wscl.send_group_message(payload)
+        self.shaper.submit(self.group_ids_aync_chat, message)
 
     def handle_player_advancement(self, message):
         """处理玩家成就事件"""
-        message_type = "default"
         message = "[CQ:face,id=160] " + message
-        payload = build_payload(message_type, self.group_ids_aync_chat, message)
-        self.server.wscl.send_group_message(payload)
+        self.shaper.submit(self.group_ids_aync_chat, message)
 
     #==============================QQ2MC===============================
 
@@ -369,7 +460,7 @@ class flexInterface:
         else:  # 非指令消息直接转发到MC
             if group_id in self.group_ids_aync_chat:  # 过滤不想同步消息的群
                 message_from_qq = build_message_from_qq(group_id, card, user_id, reply, text_content, at_target, group_name)
-                self.server.execute(f'tellraw @a {message_from_qq}')
+                self.server.dispatcher.tellraw_all(message_from_qq)
         return payload, text_to_auto_chat
 
 
@@ -377,12 +468,25 @@ class flexInterface:
         if "post_type" in data:
             post_type = data.get("post_type")
             if post_type == 'message':
+                if self.is_duplicate_event(data):
+                    return
                 self.server.logger.info("进入handle_websocket_message")
                 threading.Thread(target=self.handle_websocket_message, args=(data,)).start()
         elif "echo" in data and data["echo"] is not None:
             self.server.logger.info("进入handle_websocket_echo")
             self.handle_websocket_echo(data)
 
+    def is_duplicate_event(self, data) -> bool:
+        """根据 message_id 判断是否为重复投递的事件, 重复则计数并丢弃"""
+        message_id = data.get("message_id")
+        if message_id is None:
+            return False
+        if self.recent_message_ids.add((data.get("self_id"), message_id)):
+            return False
+        self.duplicate_events_dropped += 1
+        self.server.logger.info(f"丢弃重复事件 message_id={message_id}, 累计丢弃 {self.duplicate_events_dropped} 条")
+        return True
+
     def handle_websocket_message(self, data):
         """处理 message"""
 
@@ -414,31 +518,42 @@ class flexInterface:
                     
                     if payload:  # 如果指令处理返回了内容,就发送
                         self.server.logger.info("payload构建完毕")
-                        self.server.wscl.send_group_message(payload)
+                        self.shaper.send_priority(payload)
                     elif text_to_auto_chat: # 用AI构建payload的内容
                         ai_response = None
                         payload_ai = None
-                        ai_response_build = None
                         lucky_number = self.sign_handler.querry_today_sign(user_id)
-                        ai_response = self.server.chat.generate_ai_response(context=text_to_auto_chat, source="QQ用户", group=group_id,user=card, lucky_number=lucky_number)
+                        modes = ["default", "reply", "at"]
+                        weights = [60, 20, 20]  # 60% default, 30% reply, 10% at
+                        # 按权重随机选择（k=1表示选1个，返回的是列表，取第一个元素）
+                        reply_mode = random.choices(modes, weights=weights, k=1)[0]
+                        if random.random() < 0.01:
+                            reply_mode = "record"
+
+                        def send_ai_reply(text, index=0):
+                            # 流式输出时只有第一句使用回复/@格式
+                            payload_ai = build_payload(reply_mode if index == 0 else "default", group_id, text, message_id, user_id)
+                            self.shaper.send_priority(payload_ai) # 发送QQ消息
+                            if group_id in self.group_ids_aync_chat:  # 发送至MC
+                                ai_response_build = build_message_from_qq(group_id, config.get("bot_name"), "114514", None, text, None, group_name)
+                                self.server.dispatcher.tellraw_all(ai_response_build)
+
+                        forwarder = _SentenceForwarder(send_ai_reply) if reply_mode != "record" else None  # 语音不拆句
+                        mentioned = any(  # 从消息段识别是否@了机器人
+                            item.get("type") == "at" and str(item.get("data", {}).get("qq")) == str(config.get("bot"))
+                            for item in message_content
+                        )
+                        ai_response = self.server.chat.generate_ai_response(context=text_to_auto_chat, source="QQ用户", group=group_id,user=card, lucky_number=lucky_number, on_sentence=forwarder, mentioned=mentioned, user_id=user_id)
                         if ai_response:  # 如果超时了就不管
-                            modes = ["default", "reply", "at"]
-                            weights = [60, 20, 20]  # 60% default, 30% reply, 10% at
-                            # 按权重随机选择（k=1表示选1个，返回的是列表，取第一个元素）
-                            reply_mode = random.choices(modes, weights=weights, k=1)[0]
-                            if random.random() < 0.01:
-                                reply_mode = "record"
-                            payload_ai = build_payload(reply_mode, group_id, ai_response, message_id, user_id)
-                            ai_response_build = build_message_from_qq(group_id, config.get("bot_name"), "114514", None, ai_response, None, group_name)
+                            if not (forwarder and forwarder.sent):
+                                send_ai_reply(ai_response)
                         else:
                             chance = random.random()
                             if chance < 0.001:  # 几率触发枪毙
                                 reply_mode = random.choice(["default", "reply", "at"])
                                 payload_ai = build_payload(reply_mode, group_id,"[CQ:face,id=169]", message_id, user_id)
                         if payload_ai:
-                            self.server.wscl.send_group_message(payload_ai) # 发送QQ消息
-                        if group_id in self.group_ids_aync_chat and ai_response_build:  # 发送至MC
-                            self.server.execute(f'tellraw @a {ai_response_build}')
+                            self.shaper.send_priority(payload_ai) # 发送QQ消息
         except Exception as e:
             self.server.logger.error(f"[handle_websocket_message] 处理消息失败: {e}")
 
@@ -447,17 +562,32 @@ class flexInterface:
         echo = data.get("echo")
         data = data.get("data")
         if echo.startswith("get_group_list"):
-            for group in data:
-                gid = str(group['group_id'])  # 确保键统一为字符串类型
-                if gid not in group_info:
-                    new_info = {
-                        'group_name': group['group_name'],
-                        'member_count': group['member_count'],
-                        'max_member_count': group['max_member_count']}
-                    if group_info.get(gid) != new_info:
-                        group_info[gid] = new_info
-            self.server.logger.info(f"已初始化群组信息:{group_info}")
+            self.update_group_info(data)
+
+    def update_group_info(self, groups):
+        """缓存 get_group_list 返回的群组信息"""
+        for group in groups or []:
+            gid = str(group['group_id'])  # 确保键统一为字符串类型
+            if gid not in group_info:
+                new_info = {
+                    'group_name': group['group_name'],
+                    'member_count': group['member_count'],
+                    'max_member_count': group['max_member_count']}
+                if group_info.get(gid) != new_info:
+                    group_info[gid] = new_info
+        self.server.logger.info(f"已初始化群组信息:{group_info}")
+
+    def refresh_group_info(self) -> bool:
+        """请求群列表并等待响应, 返回是否成功"""
+        groups = self.server.wscl.call_action_sync("get_group_list")
+        if groups is None:
+            return False
+        self.update_group_info(groups)
+        return True
+
     def on_ws_status_change(self, connected: bool):
+        if connected:
+            threading.Thread(target=self.refresh_group_info, daemon=True).start()
         # if connected:
         #     type="default"
         #     bot_name = self.server.config.get('bot_name')
@@ -467,10 +597,11 @@ class flexInterface:
         #     self.server.wscl.send_group_message(payload)
         # else:
         #     self.server.logger.warning("[WS 状态] 机器人已断开，等待重连中")
-        pass
 
     def close(self):
         """关闭数据库连接"""
+        self.shaper.close()
+        self.effect_scheduler.close()
         if self.mysql_mgr.connection:
             self.mysql_mgr.connection.close()  # 使用 connection.close() 来关闭连接
         self.server.logger.info("数据库连接已关闭")
@@ -0,0 +1,198 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from .utils import json_loads
+logger = logging.getLogger("aiclient")
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+class AIClient:
+    """
+    AI 接口的 HTTP 客户端:
+    - 共享 Session 与连接池, keep-alive 复用 TCP/TLS 连接, 空闲时定期预热防止连接被服务端关闭
+    - 连接超时与读取超时分开设置
+    - post() 立即返回 Future; 失败重试由定时器调度, 不在调用线程中 sleep
+    - stream() 以生成器逐段返回 SSE 流式输出的增量文本
+    """
+    def __init__(self, api_url, api_key, connect_timeout=3, read_timeout=10, max_retries=3,
+                 retry_backoff=2, pool_size=8, keepalive_interval=50):
+        self.api_url = api_url
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max(1, max_retries)
+        self.retry_backoff = retry_backoff
+        self.keepalive_interval = keepalive_interval
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        })
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="ai_client")
+        self._lock = threading.Lock()
+        self._timers = set()
+        self._pending = set()
+        self._closed = False
+        self._stop_event = threading.Event()
+        self.last_used = 0.0
+        self.stats = {"requests": 0, "retries": 0, "failed": 0, "warmups": 0}
+        if keepalive_interval:
+            threading.Thread(target=self._keepalive_loop, name="ai_client_keepalive", daemon=True).start()
+
+    @property
+    def timeout(self):
+        return (self.connect_timeout, self.read_timeout)
+
+    def total_timeout(self) -> float:
+        """一次 post 包括全部重试在内的最长耗时"""
+        backoff = sum(self.retry_backoff * (attempt + 1) for attempt in range(self.max_retries - 1))
+        return self.max_retries * (self.connect_timeout + self.read_timeout) + backoff
+
+    # -------------------- 预热 --------------------
+    def warmup(self):
+        """在后台建立到接口的连接（只关心握手, 不关心响应内容）"""
+        if self.api_url:
+            self._executor.submit(self._warmup)
+
+    def _warmup(self):
+        parts = urlsplit(self.api_url)
+        started = time.time()
+        try:
+            self.session.head(f"{parts.scheme}://{parts.netloc}/", timeout=self.timeout)
+            self.last_used = time.time()
+            self.stats["warmups"] += 1
+            logger.info(f"AI 接口连接已预热, 耗时 {(time.time() - started) * 1000:.0f} ms")
+        except requests.RequestException as e:
+            logger.warning(f"AI 接口连接预热失败: {e}")
+
+    def _keepalive_loop(self):
+        while not self._stop_event.wait(self.keepalive_interval):
+            if self.last_used and time.time() - self.last_used >= self.keepalive_interval:
+                self._warmup()
+
+    # -------------------- 请求 --------------------
+    def post(self, data: dict) -> Future:
+        """发送 JSON 请求, Future 的结果为响应 JSON, 重试耗尽后为最后一次的异常"""
+        future = Future()
+        with self._lock:
+            if self._closed:
+                future.set_exception(RuntimeError("AI 客户端已关闭"))
+                return future
+            self._pending.add(future)
+        future.add_done_callback(self._discard)
+        self._executor.submit(self._attempt, data, future, 0)
+        return future
+
+    def _discard(self, future):
+        with self._lock:
+            self._pending.discard(future)
+
+    def _attempt(self, data, future, attempt):
+        if future.done() or self._closed:
+            return
+        self.stats["requests"] += 1
+        try:
+            response = self.session.post(self.api_url, json=data, timeout=self.timeout)
+            self.last_used = time.time()
+            if response.status_code in RETRYABLE_STATUS:
+                raise requests.HTTPError(f"HTTP {response.status_code}", response=response)
+            response.raise_for_status()
+            result = response.json()
+        except (requests.ConnectionError, requests.Timeout, requests.HTTPError, ValueError) as e:
+            retryable = not isinstance(e, requests.HTTPError) or e.response is None or e.response.status_code in RETRYABLE_STATUS
+            if retryable and attempt + 1 < self.max_retries:
+                self._schedule_retry(data, future, attempt + 1, e)
+            else:
+                self.stats["failed"] += 1
+                self._set_exception(future, e)
+            return
+        except Exception as e:
+            self.stats["failed"] += 1
+            self._set_exception(future, e)
+            return
+        if not future.done():
+            future.set_result(result)
+
+    def stream(self, data: dict, on_usage=None):
+        """
+        流式请求(调用方需在 data 中设置 stream=True), 逐段 yield 增量文本
+        只有在还没收到任何内容时才会重试, 收到内容后出错直接抛出
+        on_usage: 收到用量信息(最后一个数据块的 usage)时回调
+        """
+        for attempt in range(self.max_retries):
+            received = False
+            self.stats["requests"] += 1
+            try:
+                with self.session.post(self.api_url, json=data, timeout=self.timeout, stream=True) as response:
+                    if response.status_code in RETRYABLE_STATUS:
+                        raise requests.HTTPError(f"HTTP {response.status_code}", response=response)
+                    response.raise_for_status()
+                    for line in response.iter_lines():
+                        self.last_used = time.time()
+                        if not line.startswith(b"data:"):
+                            continue  # 空行、注释与心跳
+                        chunk = line[5:].strip()
+                        if chunk == b"[DONE]":
+                            return
+                        payload = json_loads(chunk)
+                        if payload.get("usage") and on_usage:
+                            on_usage(payload["usage"])
+                        choices = payload.get("choices") or [{}]
+                        delta = (choices[0].get("delta") or {}).get("content")
+                        if delta:
+                            received = True
+                            yield delta
+                    return
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+                retryable = not isinstance(e, requests.HTTPError) or e.response.status_code in RETRYABLE_STATUS
+                if received or not retryable or attempt + 1 >= self.max_retries or self._closed:
+                    self.stats["failed"] += 1
+                    raise
+                delay = self.retry_backoff * (attempt + 1)
+                self.stats["retries"] += 1
+                logger.warning(f"AI 流式请求失败 (尝试 {attempt + 1}/{self.max_retries}): {e}, {delay}s 后重试")
+                if self._stop_event.wait(delay):
+                    raise
+
+    def _schedule_retry(self, data, future, attempt, error):
+        delay = self.retry_backoff * attempt
+        logger.warning(f"AI 请求失败 (尝试 {attempt}/{self.max_retries}): {error}, {delay}s 后重试")
+        self.stats["retries"] += 1
+
+        def fire():
+            with self._lock:
+                self._timers.discard(timer)
+            if not self._closed:
+                self._executor.submit(self._attempt, data, future, attempt)
+
+        timer = threading.Timer(delay, fire)
+        timer.daemon = True
+        with self._lock:
+            self._timers.add(timer)
+        timer.start()
+
+    @staticmethod
+    def _set_exception(future, error):
+        if not future.done():
+            future.set_exception(error)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            timers, self._timers = list(self._timers), set()
+            pending, self._pending = list(self._pending), set()
+        self._stop_event.set()
+        for timer in timers:
+            timer.cancel()
+        for future in pending:
+            self._set_exception(future, RuntimeError("AI 客户端已关闭"))
+        self._executor.shutdown(wait=False)
+        self.session.close()
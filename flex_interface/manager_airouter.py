@@ -0,0 +1,271 @@
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from .manager_aiclient import AIClient
+logger = logging.getLogger("airouter")
+
+
+class AIProvider:
+    """
+    一个 OpenAI 兼容的接口:
+    - 记录延迟的指数滑动平均(EWMA)与最近若干次延迟, 用于选路和计算对冲等待时间
+    - 熔断: 连续失败 failure_threshold 次后熔断 open_seconds 秒, 到期后只放行一个探测请求, 成功才恢复
+    """
+    def __init__(self, name, client: AIClient, model=None, weight=1.0, ewma_alpha=0.3,
+                 failure_threshold=3, open_seconds=30, sample_size=50, summary_model=None):
+        self.name = name
+        self.client = client
+        self.model = model  # 设置后替换聊天请求中的 model
+        self.summary_model = summary_model  # 设置后替换摘要请求中的 model; 未设置时摘要保留请求自己选的 model
+        self.weight = max(weight, 0.01)
+        self.ewma_alpha = ewma_alpha
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.ewma = None
+        self._samples = deque(maxlen=sample_size)
+        self._failures = 0
+        self._open_until = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "success": 0, "failed": 0, "opened": 0}
+
+    def available(self, now=None) -> bool:
+        """熔断关闭, 或熔断到期且没有进行中的探测请求; 只用于选路排序, 发请求前以 try_acquire 为准"""
+        now = now or time.time()
+        with self._lock:
+            if self._failures < self.failure_threshold:
+                return True
+            return now >= self._open_until and not self._probing
+
+    def try_acquire(self, now=None) -> bool:
+        """
+        发出请求前调用, 检查与占用在同一把锁内完成:
+        熔断关闭时直接放行; 熔断到期时只有一个调用者能拿到探测名额, 其余返回 False
+        """
+        now = now or time.time()
+        with self._lock:
+            if self._failures >= self.failure_threshold:
+                if now < self._open_until or self._probing:
+                    return False
+                self._probing = True
+            self.stats["requests"] += 1
+            return True
+
+    def release(self):
+        """请求被调用方放弃(未成功也不算接口故障)时归还探测名额"""
+        with self._lock:
+            self._probing = False
+
+    def record_success(self, latency: float):
+        with self._lock:
+            self.ewma = latency if self.ewma is None else self.ewma_alpha * latency + (1 - self.ewma_alpha) * self.ewma
+            self._samples.append(latency)
+            if self._failures >= self.failure_threshold:
+                logger.info(f"AI 接口 {self.name} 探测成功，解除熔断")
+            self._failures = 0
+            self._probing = False
+            self.stats["success"] += 1
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            self.stats["failed"] += 1
+            if self._failures >= self.failure_threshold:
+                self._open_until = time.time() + self.open_seconds
+                self.stats["opened"] += 1
+                logger.warning(f"AI 接口 {self.name} 连续失败 {self._failures} 次，熔断 {self.open_seconds}s")
+
+    def percentile(self, q=0.9):
+        """最近延迟的分位数, 样本不足 5 个时返回 None"""
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < 5:
+            return None
+        return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+    def state(self) -> str:
+        with self._lock:
+            if self._failures < self.failure_threshold:
+                return "正常"
+            return "探测中" if self._probing else "熔断"
+
+    def payload(self, data: dict, summary=False) -> dict:
+        model = self.summary_model if summary else self.model
+        return dict(data, model=model) if model else data
+
+
+class AIRouter:
+    """
+    多个 AI 接口之间的路由, 对外接口与 AIClient 相同(post / stream / total_timeout / warmup / close):
+    - 按 权重 / EWMA延迟 加权随机选择首选接口, 熔断中的接口不参与
+    - 对冲: 首选接口超过其 p90 延迟仍未返回时, 再向另一个接口发出同样的请求, 先返回的为准
+    - 失败转移: 某个接口失败后立即改用下一个还未尝试的接口
+    - 流式请求不对冲, 只在收到内容之前失败转移
+    """
+    def __init__(self, providers, hedge=True, hedge_delay=3.0, hedge_min_delay=0.5):
+        """
+        :param hedge_delay: 首选接口延迟样本不足时的对冲等待时间（秒）
+        :param hedge_min_delay: 对冲等待时间下限, 避免延迟很低时几乎每次都对冲
+        """
+        self.providers = list(providers)
+        self.hedge = hedge
+        self.hedge_delay = hedge_delay
+        self.hedge_min_delay = hedge_min_delay
+        self.stats = {"requests": 0, "hedged": 0, "hedge_wins": 0, "failovers": 0, "unavailable": 0}
+
+    # -------------------- 选路 --------------------
+    def _candidates(self) -> list:
+        """可用接口按加权随机排序, 权重为 weight / EWMA延迟（没有样本的按 hedge_delay 估计）"""
+        now = time.time()
+        pool = [p for p in self.providers if p.available(now)]
+        ordered = []
+        while pool:
+            scores = [p.weight / max(p.ewma if p.ewma is not None else self.hedge_delay, 0.05) for p in pool]
+            chosen = random.choices(pool, weights=scores, k=1)[0]
+            pool.remove(chosen)
+            ordered.append(chosen)
+        return ordered
+
+    def _hedge_delay(self, provider: AIProvider) -> float:
+        p90 = provider.percentile(0.9)
+        delay = self.hedge_delay if p90 is None else p90
+        return max(delay, self.hedge_min_delay)
+
+    # -------------------- 请求 --------------------
+    def post(self, data: dict, summary=False) -> Future:
+        """
+        发送 JSON 请求, Future 的结果为最先成功的接口的响应 JSON
+        :param summary: 是否为摘要请求, 决定使用接口的 model 还是 summary_model
+        """
+        self.stats["requests"] += 1
+        result = Future()
+        candidates = self._candidates()
+        if not candidates:
+            self.stats["unavailable"] += 1
+            result.set_exception(RuntimeError("没有可用的AI接口（全部熔断）"))
+            return result
+        _RoutedCall(self, data, candidates, result, summary).start()
+        return result
+
+    def stream(self, data: dict, on_usage=None):
+        """流式请求, 逐段 yield 增量文本; 收到内容之前失败时换下一个接口"""
+        self.stats["requests"] += 1
+        error = None
+        for provider in self._candidates():
+            if not provider.try_acquire():
+                continue
+            if error is not None:
+                self.stats["failovers"] += 1
+                logger.warning(f"AI 流式请求改用接口 {provider.name}: {error}")
+            started = time.time()
+            received = False
+            outcome = None
+            try:
+                for delta in provider.client.stream(provider.payload(data), on_usage=on_usage):
+                    received = True
+                    yield delta
+                outcome = True
+            except Exception as e:
+                outcome = False
+                if received:
+                    raise
+                error = e
+                continue
+            finally:
+                # 调用方中途关闭生成器(GeneratorExit)时 outcome 仍为 None, 只归还探测名额
+                if outcome:
+                    provider.record_success(time.time() - started)
+                elif outcome is False:
+                    provider.record_failure()
+                else:
+                    provider.release()
+            return
+        if error is None:
+            self.stats["unavailable"] += 1
+            raise RuntimeError("没有可用的AI接口（全部熔断）")
+        raise error
+
+    def total_timeout(self) -> float:
+        """一次请求最长耗时: 所有接口依次失败转移的情况"""
+        return sum(p.client.total_timeout() for p in self.providers)
+
+    def warmup(self):
+        for provider in self.providers:
+            provider.client.warmup()
+
+    def close(self):
+        for provider in self.providers:
+            provider.client.close()
+
+
+class _RoutedCall:
+    """一次 post 的对冲与失败转移状态"""
+    def __init__(self, router: AIRouter, data, candidates, result: Future, summary=False):
+        self.router = router
+        self.data = data
+        self.summary = summary
+        self.remaining = deque(candidates)
+        self.result = result
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        primary = self._launch()
+        if primary is None:
+            self.router.stats["unavailable"] += 1
+            self.result.set_exception(RuntimeError("没有可用的AI接口（全部熔断）"))
+            return
+        if self.router.hedge and self.remaining:
+            timer = threading.Timer(self.router._hedge_delay(primary), self._fire_hedge)
+            timer.daemon = True
+            timer.start()
+            self.result.add_done_callback(lambda _: timer.cancel())
+
+    def _fire_hedge(self):
+        if self._launch(hedge=True):
+            self.router.stats["hedged"] += 1
+
+    def _launch(self, hedge=False):
+        """向下一个还未尝试且能占用的接口发出请求, 返回该接口; 没有可用接口或已有结果时返回 None"""
+        with self._lock:
+            while True:
+                if not self.remaining or self.result.done():
+                    return None
+                provider = self.remaining.popleft()
+                if provider.try_acquire():  # 选路之后可能已被其他请求占用探测名额
+                    break
+            self.in_flight += 1
+        started = time.time()
+        if hedge:
+            logger.info(f"AI 请求超过对冲等待时间，同时向接口 {provider.name} 发出")
+        future = provider.client.post(provider.payload(self.data, self.summary))
+        future.add_done_callback(lambda f: self._on_done(provider, started, f, hedge))
+        return provider
+
+    def _on_done(self, provider, started, future, hedge):
+        error = future.exception()
+        if error is None:
+            provider.record_success(time.time() - started)
+        else:
+            provider.record_failure()
+        with self._lock:
+            self.in_flight -= 1
+            if error is None:
+                if not self.result.done():
+                    if hedge:
+                        self.router.stats["hedge_wins"] += 1
+                    self.result.set_result(future.result())
+                return
+            if self.result.done():
+                return
+        logger.warning(f"AI 接口 {provider.name} 请求失败: {error}")
+        if self._launch():
+            self.router.stats["failovers"] += 1
+            return
+        with self._lock:
+            if not self.in_flight and not self.result.done():  # 已没有进行中的请求, 也没有可以转移的接口
+                self.result.set_exception(error)
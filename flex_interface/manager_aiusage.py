@@ -0,0 +1,165 @@
+import logging
+import threading
+from collections import defaultdict
+from datetime import date
+logger = logging.getLogger("aiusage")
+
+# 计数字段: 请求数, 输入, 输入(缓存命中), 输入(未命中), 输出, 费用
+FIELDS = ("requests", "prompt_tokens", "cache_hit_tokens", "cache_miss_tokens", "completion_tokens", "cost")
+# 默认按 deepseek-chat 的价格, 单位: 元 / 百万 tokens
+DEFAULT_PRICING = {"cache_hit": 0.5, "cache_miss": 2.0, "output": 8.0}
+
+
+def _new_counter():
+    return [0, 0, 0, 0, 0, 0.0]
+
+
+class AIUsageLedger:
+    """
+    AI 用量与费用记账:
+    - 每次响应的 usage 按 (群, 用户, 功能) 累加到内存计数, 每隔 flush_interval 秒批量写入 ai_usage_daily 表
+    - 同时维护当天按群、按用户的合计, 用于每日预算判断; 启动时从表中读回当天已有的用量
+    - 功能: chat(聊天回复) / auto_topic(主动话题) / summary(聊天摘要)
+    """
+    def __init__(self, mysql_mgr=None, flush_interval=300, pricing=None, group_daily_tokens=0, user_daily_tokens=0):
+        """
+        :param group_daily_tokens: 每个群每天的 token 预算, 0 为不限
+        :param user_daily_tokens: 每个用户每天的 token 预算, 0 为不限
+        """
+        self.mysql_mgr = mysql_mgr
+        self.flush_interval = flush_interval
+        self.pricing = dict(DEFAULT_PRICING, **(pricing or {}))
+        self.group_daily_tokens = group_daily_tokens
+        self.user_daily_tokens = user_daily_tokens
+        self._lock = threading.Lock()
+        self._day = date.today()
+        self._pending = defaultdict(_new_counter)  # (日期, 群, 用户, 功能) -> 未写入数据库的增量
+        self._today = defaultdict(_new_counter)  # (日期, 群, 用户, 功能) -> 当天合计
+        self._groups = defaultdict(int)  # 群 -> 当天 tokens
+        self._users = defaultdict(int)  # 用户 -> 当天 tokens
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run_loop, name="ai_usage_ledger", daemon=True)
+        self._thread.start()
+
+    def cost_of(self, usage: dict) -> float:
+        prompt_tokens = usage.get("prompt_tokens", 0)
+        hit = usage.get("prompt_cache_hit_tokens", 0)
+        miss = usage.get("prompt_cache_miss_tokens", prompt_tokens - hit)
+        return (hit * self.pricing["cache_hit"] + miss * self.pricing["cache_miss"]
+                + usage.get("completion_tokens", 0) * self.pricing["output"]) / 1_000_000
+
+    # -------------------- 记账 --------------------
+    def _rollover(self):
+        """跨天后清空当天合计（调用时持有锁）"""
+        today = date.today()
+        if today != self._day:
+            self._day = today
+            self._today.clear()
+            self._groups.clear()
+            self._users.clear()
+
+    def record(self, group, user, feature, usage: dict) -> float:
+        """记录一次响应的用量, 返回本次费用"""
+        prompt_tokens = usage.get("prompt_tokens", 0)
+        hit = usage.get("prompt_cache_hit_tokens", 0)
+        miss = usage.get("prompt_cache_miss_tokens", prompt_tokens - hit)
+        completion = usage.get("completion_tokens", 0)
+        cost = self.cost_of(usage)
+        delta = (1, prompt_tokens, hit, miss, completion, cost)
+        with self._lock:
+            self._rollover()
+            key = (self._day, str(group or ""), str(user or ""), feature)
+            for counter in (self._pending[key], self._today[key]):
+                for index, value in enumerate(delta):
+                    counter[index] += value
+            self._groups[key[1]] += prompt_tokens + completion
+            if key[2]:
+                self._users[key[2]] += prompt_tokens + completion
+        return cost
+
+    # -------------------- 预算 --------------------
+    def over_budget(self, group=None, user=None):
+        """当天用量超出预算时返回超出的范围("群"/"用户"), 否则返回 None"""
+        with self._lock:
+            self._rollover()
+            if group is not None and self.group_daily_tokens and self._groups.get(str(group), 0) >= self.group_daily_tokens:
+                return "群"
+            if user is not None and self.user_daily_tokens and self._users.get(str(user), 0) >= self.user_daily_tokens:
+                return "用户"
+        return None
+
+    # -------------------- 报表 --------------------
+    def report(self, top=5) -> dict:
+        """当天合计: total / by_feature / top_groups / top_users"""
+        total = _new_counter()
+        by_feature = defaultdict(_new_counter)
+        with self._lock:
+            self._rollover()
+            for (_, _, _, feature), counter in self._today.items():
+                for index, value in enumerate(counter):
+                    total[index] += value
+                    by_feature[feature][index] += value
+            top_groups = sorted(self._groups.items(), key=lambda item: item[1], reverse=True)[:top]
+            top_users = sorted(self._users.items(), key=lambda item: item[1], reverse=True)[:top]
+        return {
+            "total": dict(zip(FIELDS, total)),
+            "by_feature": {feature: dict(zip(FIELDS, counter)) for feature, counter in by_feature.items()},
+            "top_groups": top_groups,
+            "top_users": top_users
+        }
+
+    # -------------------- 持久化 --------------------
+    def _load_today(self):
+        """读回当天已写入数据库的用量, 插件重载后预算不清零"""
+        rows = self.mysql_mgr.query_all(
+            f"SELECT group_id, user_id, feature, {', '.join(FIELDS)} FROM ai_usage_daily WHERE usage_date = %s",
+            (self._day,)
+        )
+        with self._lock:
+            for row in rows or []:
+                # 读取期间可能已经记过账, 数据库中的用量累加到现有计数上, 不能覆盖
+                key = (self._day, row["group_id"], row["user_id"], row["feature"])
+                counter = self._today[key]
+                for index, field in enumerate(FIELDS):
+                    counter[index] += float(row[field]) if field == "cost" else int(row[field])
+                tokens = int(row["prompt_tokens"]) + int(row["completion_tokens"])
+                self._groups[row["group_id"]] += tokens
+                if row["user_id"]:
+                    self._users[row["user_id"]] += tokens
+
+    def flush(self):
+        """把增量写入数据库, 失败时放回下次再写"""
+        if not self.mysql_mgr:
+            return
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(_new_counter)
+        for key, counter in pending.items():
+            try:
+                self.mysql_mgr.safe_query(
+                    f"""
+                    INSERT INTO ai_usage_daily (usage_date, group_id, user_id, feature, {', '.join(FIELDS)})
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                    ON DUPLICATE KEY UPDATE {', '.join(f'{field} = {field} + VALUES({field})' for field in FIELDS)}
+                    """,
+                    key + tuple(counter)
+                )
+            except Exception as e:
+                logger.error(f"写入AI用量失败: {e}")
+                with self._lock:
+                    restored = self._pending[key]
+                    for index, value in enumerate(counter):
+                        restored[index] += value
+
+    def _run_loop(self):
+        if self.mysql_mgr:
+            try:
+                self._load_today()
+            except Exception as e:
+                logger.warning(f"读取当天AI用量失败: {e}")
+        while not self._stop_event.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        self._stop_event.set()
+        self._thread.join(timeout=2)
+        self.flush()
@@ -1,44 +1,76 @@
 import threading
-import requests
 from typing import List, Optional, Dict, Any
 from collections import defaultdict
-from queue import Queue
+from queue import Queue, Empty
+from concurrent.futures import Future, TimeoutError as FutureTimeout
 import schedule
 import json
 import random
 import time
 from datetime import datetime
 from .utils import *
+from .manager_snapshot import PlayerSnapshots
+from .manager_aiclient import AIClient
+from .manager_airouter import AIProvider, AIRouter
+from .manager_context import ContextStore, ChatRecord, estimate_tokens, truncate_to_tokens
+from .manager_summary import ContextSummarizer
+from .manager_chatstate import ContextPersistence
+from .manager_aiusage import AIUsageLedger
 
 current_date = datetime.now()
 cached_date = current_date.strftime("%m月%d日")  # 缓存几月几日
 weekdays_chinese = ["星期一", "星期二", "星期三", "星期四", "星期五", "星期六", "星期日"]
 cached_weekday = weekdays_chinese[current_date.weekday()]  # 缓存星期几
+LIVE_INFO_TOKENS = 100  # 为末尾的实时信息预留的 token 数
 
 class AutoChat:
     def __init__(self, server):
         self.server = server
         self._send_qq_message = server.wscl.send_group_message
         self.config = server.config.get("autochat", {})
-        self.lock = threading.Lock()
+        self.lock = threading.Lock()  # 仅用于广播
+        self._workers_lock = threading.Lock()
         self.broadcast_messages = self.config.get("broadcast_messages", [])
         self.current_broadcast_index = 0
         self.broadcast_interval = self.config.get("broadcast_interval", 1800)
 
         self.group_queues = defaultdict(Queue)  # 每个群组一个独立消息队列
+        self._busy_groups = set()  # 正在处理AI请求的群
         self.group_workers = {}  # 每个群组一个独立线程处理
+        self.group_queue_limit = self.config.get("group_queue_limit", 3)  # 每个群排队中的AI请求上限, 超出直接放弃
+        self.worker_idle_timeout = self.config.get("worker_idle_timeout", 300)  # 群工作线程空闲多久后退出
+        self.request_wait_margin = self.config.get("request_wait_margin", 10)  # 调用方在接口最长耗时之外多等的秒数
 
-        self.group_contexts = {}  # 存储上下文
-
+        self.context_max_length = self.config.get("context_max_length", 50)
+        self.group_contexts = ContextStore(self.context_max_length)  # 存储上下文, 每个群一个环形缓冲
+        self.last_reply_time = {}  # 记录每个群组的最后回复时间
 
-        self.get_player_info = self.server.mc_api.get_player_info
+        # 上下文持久化: 定期写入数据目录, 重载后某个群第一次用到时恢复
+        persist_config = self.config.get("persist", {})
+        self.persistence = None
+        if persist_config.get("enable", True):
+            self.persistence = ContextPersistence(
+                self.server.get_data_folder() + "/ai_context",
+                self.group_contexts,
+                get_state=lambda group_key: {"last_reply_time": self.last_reply_time.get(group_key, 0)},
+                set_state=lambda group_key, state: self.last_reply_time.setdefault(group_key, state.get("last_reply_time", 0)),
+                interval=persist_config.get("interval", 60),
+                max_age=persist_config.get("max_age", 86400)
+            )
+
+        # 玩家实体快照: 每人只查一次完整NBT, 并行查询并短暂缓存
+        snapshot_config = self.config.get("player_snapshot", {})
+        self.snapshots = PlayerSnapshots(
+            self.server.mc_api.get_player_info,
+            max_workers=snapshot_config.get("max_workers", 4),
+            ttl=snapshot_config.get("ttl", 5),
+            timeout=snapshot_config.get("timeout", 5)
+        )
         # 添加线程控制事件
         self._stop_event = threading.Event()
         self._thread = threading.Thread(target=self._auto_trigger_loop, daemon=True)
         self._thread.start()
-        self.last_reply_time = {}  # 记录每个群组的最后回复时间
 
-        self.context_max_length = self.config.get("context_max_length", 50)
         self.bot_name = self.config.get("bot_name", "苦力仆")  # 添加默认值
         self.ai_enabled = self.config.get("enable", False)  # 添加默认值
         self.prompt = self.config.get("prompt", "你是一个在QQ与MC互通的Minecraft服务器聊天机器人")
@@ -48,18 +80,114 @@ class AutoChat:
         self.max_tokens = self.config.get("max_tokens", 2000)
         self.max_context_tokens = self.config.get("max_context_tokens", 3000)  # 加上上下文的max上线
         self.max_retries = self.config.get("max_retries", 3)  # 添加重试机制
+        self.stream_enabled = self.config.get("stream", False)  # 流式输出, 逐句转发
+        self.stream_min_sentence = self.config.get("stream_min_sentence", 6)
+        self.stream_max_messages = self.config.get("stream_max_messages", 3)  # 一次回复最多拆成几条消息
+        self.system_prompt = self._build_system_prompt()  # 固定前缀, 便于命中接口的上下文缓存
+        self.system_prompt_tokens = estimate_tokens(self.system_prompt)
 
-        if self.ai_enabled and not self.config.get("api_key"):
+        # 本地回复判定: 触发词预编译为一个正则, 在构建提示词之前决定是否回复
+        triggers = self.config.get("triggers", {})
+        self.keyword_pattern = compile_keywords(triggers.get("keywords", [self.bot_name]))
+        self.base_reply_prob = triggers.get("base_probability", 0.01)  # 未@也未命中关键词时的回复概率
+        self.reply_interval = triggers.get("reply_interval", 2.0)  # 同一个群两次回复的最短间隔
+
+        # 多个AI接口之间路由: 按延迟选路、对冲慢请求、熔断故障接口; 未配置 providers 时只有 ai_api_url 一个
+        provider_configs = self.config.get("providers") or [{
+            "name": "default", "api_url": self.ai_api_url, "api_key": self.config.get("api_key")
+        }]
+        provider_configs = [provider for provider in provider_configs if provider.get("api_url") and provider.get("api_key")]
+        if self.ai_enabled and not provider_configs:
             self.server.logger.error("DeepSeek API密钥未配置，AI功能将禁用")
             self.ai_enabled = False
+        self.ai_api_url = self.ai_api_url or next((provider["api_url"] for provider in provider_configs), None)
+        routing = self.config.get("routing", {})
+        self.ai_router = AIRouter(
+            [self._create_provider(provider, routing, len(provider_configs) > 1) for provider in provider_configs],
+            hedge=routing.get("hedge", True),
+            hedge_delay=routing.get("hedge_delay", 3.0),
+            hedge_min_delay=routing.get("hedge_min_delay", 0.5)
+        )
         
+        # 接口用量统计, 命中上下文缓存的输入 token 计费更低、首字更快
+        self._usage_lock = threading.Lock()
+        self.usage_stats = {
+            "requests": 0, "prompt_tokens": 0, "cache_hit_tokens": 0,
+            "cache_miss_tokens": 0, "completion_tokens": 0, "latency_total": 0.0
+        }
+        # 按群/用户/功能记账, 定期写入数据库; 超出每日预算的群或用户降低回复概率或停用AI
+        budget_config = self.config.get("ai_budget", {})
+        self.budget_action = budget_config.get("action", "reduce")  # reduce: 降低回复概率 / off: 停用AI
+        self.budget_reduce_factor = budget_config.get("reduce_factor", 0.1)
+        self.usage_ledger = AIUsageLedger(
+            getattr(self.server.plugin, "mysql_mgr", None),
+            flush_interval=budget_config.get("flush_interval", 300),
+            pricing=budget_config.get("pricing"),
+            group_daily_tokens=budget_config.get("group_daily_tokens", 0),
+            user_daily_tokens=budget_config.get("user_daily_tokens", 0)
+        )
+
+        # 滚动摘要: 较早的聊天记录在后台折叠成摘要, 请求中只带摘要和最近几条原文
+        summary_config = self.config.get("summary", {})
+        self.summary_model = summary_config.get("model", self.config.get("model", "deepseek-chat"))
+        self.summary_max_length = summary_config.get("max_length", 200)  # 摘要字数上限
+        self.summarizer = None
+        if self.ai_enabled and summary_config.get("enable", False):  # 摘要会额外消耗接口额度, 需要显式开启
+            self.summarizer = ContextSummarizer(
+                self.group_contexts,
+                self._summarize,
+                is_busy=self._is_group_busy,
+                keep_recent=summary_config.get("keep_recent", 10),
+                fold_threshold=summary_config.get("fold_threshold", 20),
+                interval=summary_config.get("interval", 60),
+                max_summary_tokens=self.summary_max_length,
+                max_backoff=summary_config.get("max_backoff", 1800)
+            )
+
         # 消息速率限制
         self.last_message_time = 0
         self.message_cooldown = self.config.get("message_cooldown", 5)  # 默认5秒冷却
 
+    def _create_provider(self, provider: dict, routing: dict, multiple: bool) -> AIProvider:
+        """
+        每个接口一个共享连接池的AI客户端, 连接超时与读取超时分开
+        有多个接口时默认不在单个接口内重试, 失败直接转移到其他接口
+        """
+        client = AIClient(
+            provider["api_url"],
+            provider["api_key"],
+            connect_timeout=provider.get("connect_timeout", self.config.get("ai_connect_timeout", 3)),
+            read_timeout=provider.get("read_timeout", self.ai_timeout),
+            max_retries=provider.get("max_retries", 1 if multiple else self.max_retries),
+            pool_size=provider.get("pool_size", self.config.get("ai_pool_size", 8)),
+            keepalive_interval=provider.get("keepalive_interval", self.config.get("ai_keepalive_interval", 50))
+        )
+        return AIProvider(
+            provider.get("name", provider["api_url"]),
+            client,
+            model=provider.get("model"),
+            summary_model=provider.get("summary_model"),
+            weight=provider.get("weight", 1.0),
+            ewma_alpha=routing.get("ewma_alpha", 0.3),
+            failure_threshold=routing.get("failure_threshold", 3),
+            open_seconds=routing.get("open_seconds", 30)
+        )
+
     def close(self):
         """清理资源，停止后台线程"""
         self._stop_event.set()
+        with self._workers_lock:
+            for queue in self.group_queues.values():
+                self._drain_queue(queue)  # 先结束排队中的请求, 正在处理的由工作线程自己完成
+            for group_key in self.group_workers:
+                self.group_queues[group_key].put(None)  # 通知工作线程退出
+        self.snapshots.close()
+        if self.summarizer:
+            self.summarizer.close()
+        if self.persistence:
+            self.persistence.close()  # 最后保存一次
+        self.usage_ledger.close()
+        self.ai_router.close()
         if self._thread.is_alive():
             self._thread.join(timeout=2)  # 等待线程结束，最多2秒
             if self._thread.is_alive():
@@ -116,7 +244,7 @@ class AutoChat:
             json_msg = {
                 "text": f"<Creep> {message}"
             }
-            self.server.execute(f"tellraw @a {json.dumps(json_msg)}")
+            self.server.dispatcher.tellraw_all(json_msg)
         except Exception as e:
             self.server.logger.error(f"发送MC消息失败: {e}")
 
@@ -129,55 +257,172 @@ class AutoChat:
         user: Optional[str] = None,
         lucky_number: Optional[str] = '未签到',
         auto_context: bool = False,
+        on_sentence=None,
+        mentioned: bool = False,
+        user_id: Optional[str] = None,
     ) -> Optional[str]:
-        """调用DeepSeek AI生成响应（带重试机制）"""
+        """
+        调用DeepSeek AI生成响应（带重试机制）, 在该群的工作线程中执行并等待结果
+        on_sentence: 开启流式输出时, 每生成完一句就用它转发; 调用方据此判断回复是否已经发出
+        mentioned: 消息是否@了机器人（由调用方从消息段中识别）
+        user_id: 用量记账与预算使用的用户标识（QQ号）, 不传时使用 user
+        """
         if not self.ai_enabled or not self.ai_api_url:
             return None
+        user_id = user_id or user
+        if auto_context and random.random() >= self._budget_factor(str(group)):
+            self.server.logger.info(f"群 {group} 今日AI用量已超出预算，跳过主动话题")
+            return None
+        if not auto_context:
+            # 群消息在判定之后立即按到达顺序记入上下文, 不论是否回复、排队是否已满、等待是否超时
+            reply = self._reply_gate(context, str(group), mentioned, user_id)
+            record = self._make_record(context, source, user, lucky_number)
+            self.group_contexts.append(record, self._context_targets(str(group)))
+            if not reply:
+                return None  # 不回复的消息不构建提示词也不占用群工作线程
+        future = self.submit_ai_request(
+            context=context, source=source, group=group, user=user,
+            lucky_number=lucky_number, auto_context=auto_context, on_sentence=on_sentence, user_id=user_id
+        )
+        try:
+            return future.result(timeout=self.ai_router.total_timeout() + self.request_wait_margin)
+        except FutureTimeout:
+            future.cancel()  # 还在排队的请求不再处理
+            self.server.logger.warning(f"群 {group} 的AI请求等待超时，放弃本条")
+            return None
+
+    def submit_ai_request(self, **kwargs) -> Future:
+        """
+        把AI请求交给所属群的工作线程: 同一个群串行处理, 不同群并行
+        该群排队已满时直接返回结果为 None 的 Future
+        """
+        group_key = str(kwargs.get("group", "default"))
+        future = Future()
+        with self._workers_lock:
+            if self._stop_event.is_set():
+                future.set_result(None)
+                return future
+            queue = self.group_queues[group_key]
+            if queue.qsize() >= self.group_queue_limit:
+                self.server.logger.info(f"群 {group_key} 排队中的AI请求已满，放弃本条")
+                future.set_result(None)
+                return future
+            queue.put((kwargs, future))
+            worker = self.group_workers.get(group_key)
+            if worker is None or not worker.is_alive():
+                worker = threading.Thread(target=self._group_worker, args=(group_key,), name=f"ai_worker_{group_key}", daemon=True)
+                self.group_workers[group_key] = worker
+                worker.start()
+        return future
+
+    @staticmethod
+    def _drain_queue(queue: Queue):
+        """取出队列中剩余的请求, 让等待它们的线程拿到 None 返回"""
+        while True:
+            try:
+                item = queue.get_nowait()
+            except Empty:
+                return
+            if item is not None and item[1].set_running_or_notify_cancel():
+                item[1].set_result(None)
+
+    def _group_worker(self, group_key: str):
+        """群工作线程: 依次处理该群的AI请求, 空闲超时后退出; 退出时结束队列中剩余的请求"""
+        queue = self.group_queues[group_key]
+        while not self._stop_event.is_set():
+            try:
+                item = queue.get(timeout=self.worker_idle_timeout)
+            except Empty:
+                with self._workers_lock:
+                    if queue.empty():
+                        self.group_workers.pop(group_key, None)
+                        return
+                continue
+            if item is None:
+                break
+            kwargs, future = item
+            if not future.set_running_or_notify_cancel():
+                continue  # 调用方已等待超时并取消
+            self._busy_groups.add(group_key)
+            try:
+                future.set_result(self._generate_ai_response(**kwargs))
+            except Exception as e:
+                self.server.logger.error(f"群 {group_key} 的AI请求处理失败: {e}", exc_info=True)
+                future.set_result(None)
+            finally:
+                self._busy_groups.discard(group_key)
+        self._drain_queue(queue)
+
+    def _is_group_busy(self, group_key: str) -> bool:
+        """该群是否有排队中或正在处理的AI请求"""
+        queue = self.group_queues.get(group_key)
+        return group_key in self._busy_groups or bool(queue and not queue.empty())
+
+    def _generate_ai_response(self, context=None, source='QQ用户', group="default", user=None,
+                              lucky_number='未签到', auto_context=False, on_sentence=None, user_id=None) -> Optional[str]:
         group_key = str(group)
-        with self.lock:
-            # 确保default组存在
-            if "default" not in self.group_contexts:
-                self.group_contexts["default"] = []
-            
-            # 1. 处理上下文
-            processed_context = self.enrich_context() if auto_context else context
+        feature = "auto_topic" if auto_context else "chat"
+        # 1. 主动话题的实时信息在工作线程中查询（较慢, 不持锁）; 群消息已在 generate_ai_response 中记录
+        record = self._make_record(self.enrich_context(), source, user, lucky_number, auto_context) if auto_context else None
+        # group_contexts 自带锁, 首次读盘恢复只阻塞该群, 这里不再加外层锁
+        if record:
+            self.group_contexts.append(record, self._context_targets(group_key))
+        # 2. 构建消息历史（是否回复已在入队前判定）: 固定前缀 + 上下文 + 实时信息
+        messages = self._build_messages_for_api(group_key)
+        self.server.logger.debug(f"群 {group_key} 的AI请求消息: {messages}")
+        # 3. 调用API获取回复
+        if self.stream_enabled and on_sentence:
+            ai_response = self._request_api_stream(messages, group_key, on_sentence, user_id, feature)
+        else:
+            ai_response = self._request_api(messages, group_key, user_id, feature)
+        self.server.logger.debug(f"群 {group_key} 的AI回复: {ai_response}")
+        # 4. 处理AI回复的同步
+        if ai_response:
+            # 标准化AI回复消息, 添加到当前群组并同步到关联群组
+            ai_msg = ChatRecord("assistant", ai_response, time.time(), source="bot")
+            self.group_contexts.append(ai_msg, self._context_targets(group_key))
 
-            # 2. 截断超长消息
-            if processed_context and len(processed_context) > self.max_tokens * 4:
-                processed_context = processed_context[:self.max_tokens * 4] + "... [已截断]"
-                self.server.logger.warning(f"AI上下文过长，已截断至 {self.max_tokens} tokens")
-            
-            # 3. 标准化消息格式
-            standardized_msg = {
-                "role": "system" if auto_context else "user",
-                "content": str(processed_context),
-                "source": source,
-                "user": user,
-                "lucky_number": lucky_number,
-                "timestamp": time.time()
-            }
+        return ai_response
+
+    def _make_record(self, context, source, user, lucky_number, auto_context=False) -> ChatRecord:
+        """截断超长消息并生成上下文记录"""
+        if context and estimate_tokens(context) > self.max_tokens:
+            context = truncate_to_tokens(context, self.max_tokens) + "... [已截断]"
+            self.server.logger.warning(f"AI上下文过长，已截断至 {self.max_tokens} tokens")
+        return ChatRecord(
+            "system" if auto_context else "user",
+            str(context),
+            time.time(),
+            source=source,
+            user=user,
+            lucky_number=lucky_number
+        )
 
-            # 4. 添加到当前群组上下文
-            if group_key not in self.group_contexts:
-                self.group_contexts[group_key] = []
-            self.group_contexts[group_key].append(standardized_msg)
-            self.group_contexts[group_key] = self.group_contexts[group_key][-self.context_max_length:]
-            # 5. 处理用户消息同步
-            self._sync_message_to_groups(standardized_msg, group_key)
-
-        # 6. 构建系统提示
-        current_time = datetime.now().strftime("%H:%M")
-        active_users = {msg['user'] for msg in self.group_contexts[group_key] if msg.get('user')}
-        system_prompt = (
+    def _context_targets(self, source_group: str) -> List[str]:
+        """一条消息需要写入的群组上下文: 来源群, 加上需要同步的群"""
+        sync_groups = []
+        # 如果是default组，同步到所有关联群组
+        if source_group == "default":
+            sync_groups = getattr(self.server.plugin, 'group_ids_aync_chat', [])
+        # 如果不是default组，检查是否需要同步到default
+        elif source_group in getattr(self.server.plugin, 'group_ids_aync_chat', []):
+            sync_groups = ["default"]
+        return [source_group] + [group_id for group_id in sync_groups if group_id != source_group]
+
+    def _build_system_prompt(self) -> str:
+        """
+        固定的系统提示（角色、规则、人设）, 初始化时生成一次
+        每次请求的开头字节完全一致, 才能命中接口的上下文缓存; 时间等易变信息放在 _build_live_info
+        """
+        return (
             f"""【系统设定】
             - 角色：{self.bot_name}
-            - 当前参与聊天的群友：{', '.join(active_users) if active_users else '无'}
-            - 当前时间：{current_time}
 
             【对话规则】
             1.  `---分割线---` 表示长时间间隔或话题转换。
-            2.  消息格式解读：所有用户在QQ群内的消息都会以“[用户类型][群内昵称][幸运数字:XX]说: 内容”的格式出现。
-                - **用户类型**：包含`QQ用户`或`MC玩家`, 其中MC玩家不需要签到, 尽管幸运数字:未签到,你也不能在对话中提及任何用户没有签到的事情.
+            2.  消息格式解读：所有用户在QQ群内的消息都会以“[用户类型][群内昵称]说: 内容”的格式出现。
+                - **用户类型**：包含`QQ用户`或`MC玩家`, 其中MC玩家不需要签到, 你也不能在对话中提及任何用户没有签到的事情.
+                - 最后一条【实时信息】给出当前时间、参与聊天的群友以及QQ用户的今日幸运数字。
             3.  **【最重要】无关消息处理：** 如果用户的消息@{self.bot_name}，你就必须回复。如果你认为用户发的内容与你无关（例如是与其他人的对话、无意义的图片/视频、或明显不是对你说的），请直接返回字符串 `'no'`，禁止带上`(QQ用户,MC玩家)`等任何其他内容。你可以通过以角色身份询问（如“你是在和我说话吗？”）来确认对方是否在与你沟通。
             4.  **【最重要】禁止复读：** 如果上下文内容中你已回复过类似对话，必须直接返回字符串 `'no'`。严格禁止回复格式和之前高度类似，禁止做复读机（例如一直使用用户名字＋疑问句）。
             5.  **【最重要】禁止换行回复多个聊天记录：** 如果上下文内容中存在多个user的对话内容，你也只需要回复最新的user的对话，而不是把之前的每个都回复一遍。
@@ -198,158 +443,202 @@ class AutoChat:
             #     - **幸运数字 31-69（运气一般）：** 可以侃侃而谈，但不会套近乎。
             #     - **幸运数字 2-30（有点倒霉）或“未签到”：** 语气**简洁、直接、机械、冷淡**。避免寒暄，可以说一些脏话，可表示拒绝或质疑。
             #     - **幸运数字 1（超级倒霉）：只用回复他“滚”，可以讥讽他今天的运势。
-        # 7. 构建消息历史
-        messages = self._build_messages_for_api(system_prompt, group_key)
-        # 8. 检查是否需要回复
-        if not auto_context and not self._should_reply(context, group_key):
-            return None
-        print(f"messages: {messages}")
-        # 9. 调用API获取回复
-        ai_response = self._request_api(messages, group_key)
-        print(f"ai_response: {ai_response}")
-        # 10. 处理AI回复的同步
-        if ai_response:
-            # 标准化AI回复消息
-            ai_msg = {
-                "role": "assistant",
-                "content": ai_response,
-                "source": "bot",
-                "timestamp": time.time()
-            }
-            
-            # 添加到当前群组
-            if group_key not in self.group_contexts:
-                self.group_contexts[group_key] = []
-            self.group_contexts[group_key].append(ai_msg)
-            self.group_contexts[group_key] = self.group_contexts[group_key][-self.context_max_length:]
-            
-            # 同步AI回复到其他群组
-            self._sync_ai_response_to_groups(ai_msg, group_key)
-        
-        return ai_response
 
-    def _sync_message_to_groups(self, message: dict, source_group: str) -> None:
-        """同步用户消息到其他群组"""
-        sync_groups = []
-        # 如果是default组，同步到所有关联群组
-        if source_group == "default":
-            sync_groups = getattr(self.server.plugin, 'group_ids_aync_chat', [])
-        # 如果不是default组，检查是否需要同步到default
-        elif source_group in getattr(self.server.plugin, 'group_ids_aync_chat', []):
-            sync_groups = ["default"]
-        # 执行同步
-        for group_id in sync_groups:
-            if group_id != source_group:  # 不同步到来源群组
-                if group_id not in self.group_contexts:
-                    self.group_contexts[group_id] = []
-                self.group_contexts[group_id].append(message)
-                self.group_contexts[group_id] = self.group_contexts[group_id][-self.context_max_length:]
-
-    def _sync_ai_response_to_groups(self, ai_msg: dict, source_group: str) -> None:
-        """同步AI回复到其他群组"""
-        sync_groups = []
-        
-        # 如果是default组的回复，同步到所有关联群组
-        if source_group == "default":
-            sync_groups = getattr(self.server.plugin, 'group_ids_aync_chat', [])
-        # 如果不是default组，检查是否需要同步到default
-        elif source_group in getattr(self.server.plugin, 'group_ids_aync_chat', []):
-            sync_groups = ["default"]
-        
-        # 执行同步
-        for group_id in sync_groups:
-            if group_id != source_group:  # 不同步到来源群组
-                if group_id not in self.group_contexts:
-                    self.group_contexts[group_id] = []
-                self.group_contexts[group_id].append(ai_msg)
-                self.group_contexts[group_id] = self.group_contexts[group_id][-self.context_max_length:]
-
-    def _build_messages_for_api(self, system_prompt: str, group_key: str) -> List[dict]:
-        """构建API需要的消息格式"""
-        messages = [{"role": "system", "content": system_prompt}]
+    def _build_live_info(self, records: List[ChatRecord]) -> str:
+        """实时信息: 当前时间、参与聊天的群友及QQ用户的今日幸运数字, 作为最后一条消息"""
+        users = {}
+        for msg in records:
+            if msg.role == "user" and msg.user:
+                users.pop(msg.user, None)  # 按最近发言排序, 幸运数字取最新一条
+                users[msg.user] = msg
+        participants = [
+            f"{user}(幸运数字:{msg.lucky_number or '未签到'})" if msg.source == "QQ用户" else user
+            for user, msg in users.items()
+        ]
+        return (
+            f"【实时信息】\n"
+            f"- 当前时间：{datetime.now().strftime('%H:%M')}\n"
+            f"- 当前参与聊天的群友：{', '.join(participants) if participants else '无'}"
+        )
+
+    def _format_record(self, msg: ChatRecord) -> str:
+        if msg.role == "user":
+            return f"[{msg.source}][{msg.user or '匿名用户'}]说: {msg.content}"
+        return msg.content
+
+    def _build_messages_for_api(self, group_key: str) -> List[dict]:
+        """
+        构建API需要的消息格式: 固定系统提示 -> 聊天摘要 -> 未折叠的上下文（旧到新） -> 实时信息
+        整个请求的输入不超过 max_context_tokens, 扣除其余部分后上下文从最新往前截取
+        """
+        messages = [{"role": "system", "content": self.system_prompt}]
+        summary = self.group_contexts.summary(group_key)
+        if summary:
+            messages.append({"role": "system", "content": f"【之前的聊天摘要】\n{summary}"})
         prev_timestamp = None
-        
-        for msg in sorted(self.group_contexts.get(group_key, [])[-self.context_max_length:], 
-                         key=lambda x: x['timestamp']):
-            if not isinstance(msg.get("content"), (str, int, float)):
-                continue
-            
+        budget = self.max_context_tokens - self.system_prompt_tokens - estimate_tokens(summary) - LIVE_INFO_TOKENS
+        records = self.group_contexts.window(group_key, max(budget, 0))
+
+        for msg in records:
             # 添加时间分割线
-            if prev_timestamp and msg['timestamp'] - prev_timestamp > 300:
+            if prev_timestamp and msg.timestamp - prev_timestamp > 300:
                 messages.append({"role": "system", "content": "--- 新对话 ---"})
-            
-            # 构建消息内容
-            if msg.get("role") == "user":
-                content = f"[{msg.get('source')}][{msg.get('user', '匿名用户')}][幸运数字:{msg.get('lucky_number','未签到')}]说: {msg['content']}"
-            else:
-                content = msg['content']
 
             messages.append({
-                "role": msg["role"],
-                "content": content
+                "role": msg.role,
+                "content": self._format_record(msg)
             })
-            prev_timestamp = msg['timestamp']
-        
+            prev_timestamp = msg.timestamp
+
+        messages.append({"role": "system", "content": self._build_live_info(records)})
         return messages
-        
-    def _request_api(self, messages: List[dict], group_key: str) -> Optional[str]:
-        """调用DeepSeek API"""
-        last_error = None
-        
-        for attempt in range(self.max_retries):
-            if self._stop_event.is_set():
+
+    def _request_api(self, messages: List[dict], group_key: str, user_id=None, feature="chat") -> Optional[str]:
+        """调用AI接口（选路、对冲与重试由 AIRouter / AIClient 负责, 这里只等待最终结果）"""
+        if self._stop_event.is_set():
+            return None
+        # 1. 准备请求数据
+        data = {
+            "model": self.config.get("model", "deepseek-chat"),
+            "messages": messages,
+            "max_tokens": self.max_tokens,
+            "temperature": self.config.get("temperature", 0.7),
+            "frequency_penalty": 1.2,
+            "stream": False
+        }
+        started = time.time()
+        try:
+            # 2. 发送请求
+            result = self.ai_router.post(data).result(timeout=self.ai_router.total_timeout())
+            self._record_usage(result.get("usage"), group_key, started, user_id, feature)
+
+            # 3. 处理响应
+            if not result.get('choices'):
+                raise ValueError("API返回无有效choices")
+            ai_response = result['choices'][0]['message']['content'].strip()
+        except Exception as e:
+            self.server.logger.error(f"DeepSeek请求最终失败: {e}")
+            return None
+
+        # 4. 更新最后回复时间
+        self.last_reply_time[group_key] = time.time()
+
+        return None if is_no_sentinel(ai_response) else ai_response
+
+    def _request_api_stream(self, messages: List[dict], group_key: str, on_sentence, user_id=None, feature="chat") -> Optional[str]:
+        """
+        流式调用: 每凑满一句就交给 on_sentence 转发, 最多转发 stream_max_messages 条, 剩余部分并入最后一条
+        开头可能是 'no' 时先不转发, 确认不是后再开始
+        """
+        if self._stop_event.is_set():
+            return None
+        data = {
+            "model": self.config.get("model", "deepseek-chat"),
+            "messages": messages,
+            "max_tokens": self.max_tokens,
+            "temperature": self.config.get("temperature", 0.7),
+            "frequency_penalty": 1.2,
+            "stream": True,
+            "stream_options": {"include_usage": True}
+        }
+        started = time.time()
+        usage = {}
+        parts = []
+        buffer = ""
+        sent = 0
+        decided = False
+        try:
+            for delta in self.ai_router.stream(data, on_usage=usage.update):
+                parts.append(delta)
+                buffer += delta
+                if not decided:
+                    if may_be_no_sentinel(buffer):
+                        continue
+                    decided = True
+                if sent >= self.stream_max_messages - 1:
+                    continue  # 后面的内容攒到最后一条
+                sentences, buffer = split_sentences(buffer, self.stream_min_sentence, self.stream_max_messages - 1 - sent)
+                for sentence in sentences:
+                    on_sentence(sentence)
+                    sent += 1
+        except Exception as e:
+            self.server.logger.error(f"DeepSeek流式请求中断: {e}")
+            if not sent:
                 return None
-                
-            try:
-                # 1. 准备请求数据
-                data = {
-                    "model": self.config.get("model", "deepseek-chat"),
-                    "messages": messages,
-                    "max_tokens": self.max_tokens,
-                    "temperature": self.config.get("temperature", 0.7),
-                    "frequency_penalty": 1.2,
-                    "stream": False
-                }
-
-                # 2. 发送请求
-                response = requests.post(
-                    self.ai_api_url,
-                    headers={
-                        "Authorization": f"Bearer {self.config.get('api_key', '')}",
-                        "Content-Type": "application/json"
-                    },
-                    json=data,
-                    timeout=self.ai_timeout
-                )
-                response.raise_for_status()
-
-                # 3. 处理响应
-                result = response.json()
-                if not result.get('choices'):
-                    raise ValueError("API返回无有效choices")
-                    
-                ai_response = result['choices'][0]['message']['content'].strip()
-                
-                # 4. 标准化回复
-                if ai_response.lower() == "no":
-                    ai_response = "no"
-                    
-                # 5. 更新最后回复时间
-                self.last_reply_time[group_key] = time.time()
-                
-                return ai_response if ai_response != "no" else None
-                
-            except Exception as e:
-                last_error = e
-                wait_time = (attempt + 1) * 2
-                self.server.logger.warning(
-                    f"DeepSeek请求失败 (尝试 {attempt + 1}/{self.max_retries}): {str(e)}"
-                )
-                time.sleep(wait_time)
+        self._record_usage(usage, group_key, started, user_id, feature)
 
-        self.server.logger.error(f"DeepSeek请求最终失败: {last_error}")
-        return None
+        ai_response = "".join(parts).strip()
+        if not sent and is_no_sentinel(ai_response):
+            return None
+        if buffer.strip():
+            on_sentence(buffer.strip())
+        self.last_reply_time[group_key] = time.time()
+        return ai_response or None
+
+    def _summarize(self, group_key: str, previous: str, records: List[ChatRecord]) -> Optional[str]:
+        """把旧摘要和较早的聊天记录压缩成新摘要（低温度、短输出）"""
+        if self._stop_event.is_set():
+            return None
+        lines = []
+        for msg in records:
+            if msg.role == "assistant":
+                lines.append(f"{self.bot_name}: {msg.content}")
+            elif msg.role == "system":
+                lines.append(f"[实时信息] {msg.content}")
+            else:
+                lines.append(self._format_record(msg))
+        data = {
+            "model": self.summary_model,
+            "messages": [
+                {"role": "system", "content": (
+                    f"你负责整理QQ群与MC服务器互通群的聊天记录。把【已有摘要】和【新的聊天记录】合并成一段新的摘要，"
+                    f"保留正在聊的话题、关键人物、他们的态度和约定以及{self.bot_name}说过的要点，省略寒暄、表情和重复内容。"
+                    f"只输出摘要本身，不超过{self.summary_max_length}字。"
+                )},
+                {"role": "user", "content": f"【已有摘要】\n{previous or '无'}\n\n【新的聊天记录】\n" + "\n".join(lines)}
+            ],
+            "max_tokens": self.summary_max_length,
+            "temperature": 0.3,
+            "stream": False
+        }
+        started = time.time()
+        try:
+            result = self.ai_router.post(data, summary=True).result(timeout=self.ai_router.total_timeout())
+            self._record_usage(result.get("usage"), group_key, started, feature="summary")
+            return result['choices'][0]['message']['content'].strip() or None
+        except Exception as e:
+            self.server.logger.warning(f"生成聊天摘要失败: {e}")
+            return None
+
+    def _record_usage(self, usage: Optional[dict], group_key: str, started: float, user_id=None, feature="chat"):
+        """记录一次请求的用量; DeepSeek 在 usage 中返回 prompt_cache_hit_tokens / prompt_cache_miss_tokens"""
+        if not usage:
+            return
+        cost = self.usage_ledger.record(group_key, user_id, feature, usage)
+        latency = time.time() - started
+        prompt_tokens = usage.get("prompt_tokens", 0)
+        hit = usage.get("prompt_cache_hit_tokens", 0)
+        miss = usage.get("prompt_cache_miss_tokens", prompt_tokens - hit)
+        with self._usage_lock:
+            self.usage_stats["requests"] += 1
+            self.usage_stats["prompt_tokens"] += prompt_tokens
+            self.usage_stats["cache_hit_tokens"] += hit
+            self.usage_stats["cache_miss_tokens"] += miss
+            self.usage_stats["completion_tokens"] += usage.get("completion_tokens", 0)
+            self.usage_stats["latency_total"] += latency
+        self.server.logger.info(
+            f"AI用量｜群组: {group_key}｜功能: {feature}｜输入: {prompt_tokens} (缓存命中 {hit})｜"
+            f"输出: {usage.get('completion_tokens', 0)}｜费用: {cost:.4f}元｜耗时: {latency * 1000:.0f} ms"
+        )
 
+    def get_usage_stats(self) -> dict:
+        """累计用量, 附带缓存命中率与平均耗时"""
+        with self._usage_lock:
+            stats = dict(self.usage_stats)
+        cached = stats["cache_hit_tokens"] + stats["cache_miss_tokens"]
+        stats["cache_hit_rate"] = stats["cache_hit_tokens"] / cached if cached else 0.0
+        stats["avg_latency"] = stats["latency_total"] / stats["requests"] if stats["requests"] else 0.0
+        return stats
 
     def _auto_trigger_loop(self):
         """每30分钟随机广播一条消息，每轮不重复"""
@@ -386,7 +675,7 @@ class AutoChat:
     #     t.start()
 
     def enrich_context(self):
-        _, _, online_players = self.server.mc_api.get_server_player_list()
+        online_players = self.server.online.players()
         print(f"online_players: {online_players}")
         if not online_players:
             return "当前无玩家在线，你需要主动在QQ挑起话题" + f"\n{self.auto_prompt}"
@@ -403,12 +692,15 @@ class AutoChat:
             "death_history"       # 死亡记录
         ])
         print(f"enrich_type: {enrich_type}")
+        # 一次性并行获取所有玩家的快照, 查询失败的玩家跳过
+        snapshots = self.snapshots.get_many(online_players)
+        online_players = [player for player in online_players if player in snapshots]
         # 查询所有玩家的相关信息
         if enrich_type == "location_info":
             context += "玩家当前坐标和维度：\n"
             for player in online_players:
-                pos = self.get_player_info(player, 'Pos')  # [x, y, z]
-                dim = self.get_player_info(player, 'Dimension').replace('minecraft:', '')
+                pos = snapshots[player].get('Pos', [0, 0, 0])  # [x, y, z]
+                dim = snapshots[player].get('Dimension', '未知').replace('minecraft:', '')
                 context += (
                     f"- {player}: 坐标 [{pos[0]:.1f}, {pos[1]:.1f}, {pos[2]:.1f}] "
                     f"(维度: {dim})\n"
@@ -417,7 +709,7 @@ class AutoChat:
         elif enrich_type == "held_item_info":
             context += "玩家手持物品详情：\n"
             for player in online_players:
-                held_item = self.get_player_info(player, 'SelectedItem')
+                held_item = snapshots[player].get('SelectedItem') or {}
                 item_name = held_item.get('id', '空气').replace('minecraft:', '')
                 count = held_item.get('count', 1)
                 enchants = held_item.get('components', {}).get('minecraft:enchantments', {})
@@ -435,15 +727,15 @@ class AutoChat:
             context += "玩家装备和状态：\n"
             for player in online_players:
                 # 装备信息
-                equipment = self.get_player_info(player, 'equipment')
+                equipment = snapshots[player].get('equipment') or {}
                 armor = [
                     slot + ":" + item['id'].replace('minecraft:', '') 
                     for slot, item in equipment.items() 
                     if slot in ['head', 'chest', 'legs', 'feet'] and item.get('id')
                 ]
                 # 生命值和饥饿值
-                health = self.get_player_info(player, 'Health')
-                food = self.get_player_info(player, 'foodLevel')
+                health = snapshots[player].get('Health')
+                food = snapshots[player].get('foodLevel')
                 context += (
                     f"- {player}: ❤️{health}/20 🍗{food}/20, "
                     f"装备 [{', '.join(armor) if armor else '无'}]\n"
@@ -452,7 +744,7 @@ class AutoChat:
         elif enrich_type == "death_history":
             context += "玩家死亡记录：\n"
             for player in online_players:
-                death_loc = self.get_player_info(player, 'LastDeathLocation')
+                death_loc = snapshots[player].get('LastDeathLocation')
                 if death_loc:
                     dim = death_loc.get('dimension', '未知').replace('minecraft:', '')
                     pos = death_loc.get('pos', [])
@@ -462,46 +754,38 @@ class AutoChat:
         
         return context + f"\n{self.auto_prompt}"
     
-    def _should_reply(self, context: str, group_key: str) -> bool:
-        """判断是否需要回复（优化版）"""
-
+    def _budget_factor(self, group_key: str, user_id=None) -> float:
+        """当天用量超出群或用户预算时的回复概率系数: 未超出为 1, action=off 时为 0"""
+        scope = self.usage_ledger.over_budget(group_key, user_id)
+        if not scope:
+            return 1.0
+        self.server.logger.debug(f"{scope}今日AI用量已超出预算｜群组: {group_key}｜用户: {user_id}")
+        return 0.0 if self.budget_action == "off" else self.budget_reduce_factor
+
+    def _reply_gate(self, context: str, group_key: str, mentioned: bool = False, user_id=None) -> bool:
+        """
+        本地回复判定, 只用到消息本身和最近几条记录, 不构建提示词
+        @机器人或命中触发词时必回, 否则按基础概率; 超出每日预算时再乘以预算系数
+        """
         now = time.time()
-        if now - self.last_reply_time.get(group_key, 0) < 2.0:
-            print("间隔太短")
-            return False
-
-        # 3. 检查重复内容（最近3条用户消息）
-        last_msgs = [
-            msg["content"] 
-            for msg in self.group_contexts.get(group_key, [])[-3:] 
-            if msg.get("role") == "user"
-        ]
-        if context == last_msgs:
-            print("信息重复")
+        if now - self.last_reply_time.get(group_key, 0) < self.reply_interval:
             return False
-        # 4. 动态回复概率（安全访问配置）
-        default_keywords = [f"{self.bot_name}"]  # 默认触发词
-        triggers = self.config.get("triggers", {})
-        keywords = triggers.get("keywords", default_keywords)
 
-        # 计算回复概率（关键词触发时概率更高）
-        base_reply_prob = 0.01 # 基础回复概率80%
-        keyword_reply_prob = 1  # 关键词触发时回复概率90%
-        
-        use_keyword_prob = any(keyword in context for keyword in keywords)
-        reply_prob = keyword_reply_prob if use_keyword_prob else base_reply_prob
+        # 未@机器人且与最近3条用户消息重复的不回复（判定在本条写入上下文之前）
+        if not mentioned:
+            recent = [msg.content for msg in self.group_contexts.records(group_key, last=3) if msg.role == "user"]
+            if context in recent:
+                return False
 
-        # 5. 记录日志（更清晰的变量名）
-        roll = random.random()  # 随机数决定是否回复
-        self.server.logger.info(
-            f"回复判定｜群组: {group_key}｜内容: {context[:20]}...｜"
-            f"关键词触发: {use_keyword_prob}｜"
+        keyword_hit = bool(self.keyword_pattern and context and self.keyword_pattern.search(context))
+        reply_prob = (1 if mentioned or keyword_hit else self.base_reply_prob) * self._budget_factor(group_key, user_id)
+        roll = random.random()
+        self.server.logger.debug(
+            f"回复判定｜群组: {group_key}｜内容: {str(context)[:20]}...｜"
+            f"@机器人: {mentioned}｜关键词触发: {keyword_hit}｜"
             f"回复阈值: {reply_prob:.2f}｜随机值: {roll:.2f}"
         )
-        
-        # 6. 更新最后回复时间（仅当确定回复时更新）
-        if roll <= reply_prob:
-            self.last_reply_time[group_key] = now  # 更新冷却时间
+        if roll < reply_prob:
+            self.last_reply_time[group_key] = now  # 确定回复时更新冷却时间
             return True
-        
-        return False
\ No newline at end of file
+        return False
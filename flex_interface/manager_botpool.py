@@ -0,0 +1,155 @@
+import logging
+import threading
+from concurrent.futures import Future
+from .manager_wsclient import WebSocketClient
+from .utils import RecentIdSet
+logger = logging.getLogger("botpool")
+
+
+class BotPool:
+    """
+    多个 OneBot 账号的连接池, 对外提供与 WebSocketClient 相同的发送接口
+    - 出站: 每条群消息路由给能在该群发言、已连接且预计最快发出的账号（按各账号的 send_rate 估算）
+    - 入站: 多个账号在同一个群时, 同一条群消息只处理一次; 自家账号发出的消息不再处理
+    - 故障转移: 账号断线时, 积压的消息转交给其他能在该群发言的账号
+    """
+    def __init__(self, bot_configs, on_message_callback, on_status_callback=None, client_factory=None, dedup_ttl=300):
+        """
+        :param bot_configs: 账号配置列表, 每项包含 name, ws_url, groups(可选, 为空时连接后自动从 get_group_list 获取), send_rate(可选)
+        :param client_factory: 创建 WebSocketClient 的函数, 接收 (bot_config, on_message, on_status)
+        """
+        self.on_message_callback = on_message_callback
+        self.on_status_callback = on_status_callback
+        self.clients = []
+        self._groups = {}  # 账号名 -> 可发言的群号集合
+        self._static_groups = {}  # 账号名 -> 是否在配置中写死了群号
+        self._self_ids = set()  # 所有账号自己的QQ号
+        self._recent_events = RecentIdSet(maxlen=4096, ttl=dedup_ttl)
+        self._lock = threading.Lock()
+        self.duplicate_events_dropped = 0
+        client_factory = client_factory or (lambda bot, on_message, on_status: WebSocketClient(
+            bot["ws_url"], on_message, on_status, name=bot["name"], send_rate=bot.get("send_rate", 0)
+        ))
+
+        for index, bot in enumerate(bot_configs):
+            bot.setdefault("name", f"bot{index + 1}")
+            client = client_factory(bot, self._on_client_message, None)
+            client.on_status_callback = self._make_status_handler(client)
+            client.on_undeliverable = self._reroute
+            self.clients.append(client)
+            groups = {str(g) for g in bot.get("groups", [])}
+            self._groups[client.name] = groups
+            self._static_groups[client.name] = bool(groups)
+            if bot.get("self_id"):
+                self._self_ids.add(str(bot["self_id"]))
+
+    # -------------------- 生命周期 --------------------
+    def start(self):
+        for client in self.clients:
+            client.start()
+
+    def stop(self):
+        for client in self.clients:
+            client.stop()
+
+    def close(self):
+        for client in self.clients:
+            client.close()
+
+    def is_connected(self) -> bool:
+        return any(client.is_connected() for client in self.clients)
+
+    # -------------------- 入站 --------------------
+    def _on_client_message(self, data):
+        self_id = data.get("self_id")
+        if self_id is not None:
+            self._self_ids.add(str(self_id))
+        if data.get("post_type") == "message" and data.get("message_type") == "group":
+            if str(data.get("user_id")) in self._self_ids:
+                return  # 自家其他账号发出的消息
+            # 不同账号收到的 message_id 不同, 用消息本身的特征去重
+            key = (data.get("group_id"), data.get("user_id"), data.get("time"), data.get("raw_message") or str(data.get("message")))
+            if not self._recent_events.add(key):
+                self.duplicate_events_dropped += 1
+                return
+        self.on_message_callback(data)
+
+    def _make_status_handler(self, client):
+        def handler(connected: bool):
+            if connected and not self._static_groups[client.name]:
+                threading.Thread(target=self._learn_groups, args=(client,), daemon=True).start()
+            if self.on_status_callback:
+                self.on_status_callback(connected=connected)
+        return handler
+
+    def _learn_groups(self, client):
+        """未配置群号的账号, 连接后用 get_group_list 获取它能发言的群"""
+        groups = client.call_action_sync("get_group_list")
+        if groups is None:
+            return
+        with self._lock:
+            self._groups[client.name] = {str(g["group_id"]) for g in groups}
+        logger.info(f"[{client.name}] 可发言的群: {sorted(self._groups[client.name])}")
+
+    # -------------------- 出站 --------------------
+    def _candidates(self, group_id, connected_only=True):
+        with self._lock:
+            candidates = [
+                c for c in self.clients
+                if group_id is None or not self._groups[c.name] or str(group_id) in self._groups[c.name]
+            ]
+        if connected_only:
+            candidates = [c for c in candidates if c.is_connected()]
+        return candidates
+
+    def _route(self, payload, exclude=None):
+        """为一条 payload 选择账号: 优先已连接且预计最快发出的, 都未连接时交给第一个能发言的账号暂存"""
+        params = payload.get("params", {}) if isinstance(payload, dict) else {}
+        group_id = params.get("group_id")
+        candidates = [c for c in self._candidates(group_id) if c is not exclude]
+        if candidates:
+            return min(candidates, key=lambda c: c.estimated_delay())
+        fallback = [c for c in self._candidates(group_id, connected_only=False) if c is not exclude]
+        return fallback[0] if fallback else None
+
+    def _reroute(self, source_client, payload) -> bool:
+        """账号断线时, 把无法发出的消息转交给其他已连接的账号"""
+        params = payload.get("params", {}) if isinstance(payload, dict) else {}
+        candidates = [c for c in self._candidates(params.get("group_id")) if c is not source_client]
+        if not candidates:
+            return False
+        target = min(candidates, key=lambda c: c.estimated_delay())
+        return target.send_group_message(payload)
+
+    def send_group_message(self, payload, wait=False, timeout=None):
+        """与 WebSocketClient.send_group_message 相同, 每个 payload 独立选择账号"""
+        if not isinstance(payload, list):
+            payload = [payload]
+        results = []
+        for p in payload:
+            client = self._route(p)
+            if client is None:
+                logger.warning(f"没有账号能在该群发言，丢弃消息: {p}")
+                results.append(False)
+                continue
+            results.append(client.send_group_message(p, wait=wait, timeout=timeout))
+        return all(results)
+
+    def call_action(self, action, params=None, timeout=None) -> Future:
+        client = self._route({"action": action, "params": params or {}})
+        if client is None:
+            future = Future()
+            future.set_exception(ConnectionError("没有可用的机器人账号"))
+            return future
+        return client.call_action(action, params, timeout)
+
+    def call_action_sync(self, action, params=None, timeout=None):
+        client = self._route({"action": action, "params": params or {}})
+        if client is None:
+            return None
+        return client.call_action_sync(action, params, timeout)
+
+    # -------------------- 统计 --------------------
+    def get_groups(self, client) -> set:
+        with self._lock:
+            return set(self._groups[client.name])
@@ -0,0 +1,136 @@
+import logging
+import os
+import re
+import threading
+import time
+from pathlib import Path
+from .manager_context import ContextStore, ChatRecord
+from .utils import json_dumps, json_loads
+logger = logging.getLogger("chatstate")
+
+
+class ContextPersistence:
+    """
+    AI 群聊上下文的本地持久化, 插件重载或服务器重启后接着之前的话题聊:
+    - 每个群一个 JSONL 文件: 第一行为群状态(摘要、已折叠条数、调用方的附加状态), 之后每行一条记录
+    - 后台每隔 interval 秒只写有变化的群; 先写临时文件再 os.replace, 中途中断也不会损坏旧文件
+    - 加载插件时不读盘, 某个群第一次被用到时才恢复; 超过 max_age 秒的记录不再恢复
+    """
+    def __init__(self, folder, store: ContextStore, get_state=None, set_state=None, interval=60, max_age=86400):
+        """
+        :param get_state: 保存时调用, 接收群号, 返回需要一起保存的附加状态(dict)
+        :param set_state: 恢复时调用, 接收 (群号, 附加状态)
+        """
+        self.folder = Path(folder)
+        self.store = store
+        self.get_state = get_state
+        self.set_state = set_state
+        self.interval = interval
+        self.max_age = max_age
+        self.stats = {"saved": 0, "restored": 0, "failed": 0}
+        os.makedirs(self.folder, exist_ok=True)
+        store.loader = self.load
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run_loop, name="context_persistence", daemon=True)
+        self._thread.start()
+
+    def _path(self, group_key) -> Path:
+        return self.folder / f"{re.sub(r'[^0-9A-Za-z_-]', '_', str(group_key))}.jsonl"
+
+    # -------------------- 恢复 --------------------
+    def load(self, group_key):
+        """
+        读取一个群的持久化文件, 返回 (记录列表, 摘要, 已折叠条数), 没有、损坏或已过期返回 None
+        格式不对的行直接跳过, 不影响其余记录
+        """
+        path = self._path(group_key)
+        if not path.exists():
+            return None
+        try:
+            with open(path, "rb") as f:
+                header = json_loads(f.readline())
+                lines = [line for line in f if line.strip()]
+            if not isinstance(header, dict):
+                raise ValueError("文件头格式错误")
+            saved_at = float(header.get("saved_at") or 0)
+            folded = int(header.get("folded") or 0)
+            summary = str(header.get("summary") or "")
+            state = header.get("state")
+        except (OSError, ValueError, TypeError) as e:
+            self.stats["failed"] += 1
+            logger.warning(f"恢复群 {group_key} 的AI上下文失败: {e}")
+            return None
+        if self.set_state and isinstance(state, dict) and state:
+            self.set_state(group_key, state)
+        if time.time() - saved_at > self.max_age:
+            return None
+        oldest = time.time() - self.max_age
+        folded_count = folded
+        records = []
+        skipped = 0
+        for index, line in enumerate(lines):
+            record = self._parse_row(line)
+            if record is None:
+                skipped += 1
+            if record is None or record.timestamp < oldest:
+                if index < folded:  # 丢弃的记录原本已折叠, 折叠条数相应减少
+                    folded_count -= 1
+                continue
+            records.append(record)
+        if skipped:
+            logger.warning(f"群 {group_key} 的AI上下文文件中有 {skipped} 条损坏记录，已跳过")
+        self.stats["restored"] += 1
+        logger.info(f"已恢复群 {group_key} 的AI上下文: {len(records)} 条记录")
+        # 头部的折叠条数可能与实际行数不符（手工编辑或写入中断）, 不能超过恢复的记录数
+        return records, summary, max(0, min(folded_count, len(records)))
+
+    @staticmethod
+    def _parse_row(line):
+        """解析一条记录, 格式不对时返回 None"""
+        try:
+            role, content, timestamp, source, user, lucky_number = json_loads(line)
+            if role not in ("user", "assistant", "system") or not isinstance(content, str):
+                return None
+            return ChatRecord(role, content, float(timestamp), source=source, user=user, lucky_number=lucky_number)
+        except (ValueError, TypeError):
+            return None
+
+    # -------------------- 保存 --------------------
+    def save(self, group_key):
+        records, summary, folded_count = self.store.export(group_key)
+        header = {
+            "saved_at": time.time(),
+            "summary": summary,
+            "folded": folded_count,
+            "state": self.get_state(group_key) if self.get_state else {}
+        }
+        path = self._path(group_key)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(json_dumps(header) + "\n")
+            for record in records:
+                f.write(json_dumps([record.role, record.content, record.timestamp,
+                                    record.source, record.user, record.lucky_number]) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        self.stats["saved"] += 1
+
+    def flush(self):
+        """保存所有有变化的群"""
+        for group_key in self.store.take_dirty():
+            try:
+                self.save(group_key)
+            except Exception as e:
+                self.stats["failed"] += 1
+                logger.error(f"保存群 {group_key} 的AI上下文失败: {e}")
+
+    def _run_loop(self):
+        while not self._stop_event.wait(self.interval):
+            self.flush()
+
+    def close(self):
+        """停止后台线程并做最后一次保存"""
+        self._stop_event.set()
+        self._thread.join(timeout=2)
+        self.flush()
@@ -0,0 +1,192 @@
+import logging
+import math
+import re
+import threading
+from collections import deque
+logger = logging.getLogger("context")
+
+# 中日韩字符约 0.6 token/字, 其他字符约 0.3 token/字（DeepSeek 官方给出的估算比例）
+CJK_PATTERN = re.compile(r"[　-〿぀-ヿ㐀-䶿一-鿿가-힯＀-￯]")
+
+
+def estimate_tokens(text) -> int:
+    """近似估算文本的 token 数"""
+    if not text:
+        return 0
+    text = str(text)
+    cjk = len(CJK_PATTERN.findall(text))
+    return math.ceil(cjk * 0.6 + (len(text) - cjk) * 0.3)
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """把文本截断到大约 max_tokens 个 token 以内"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    low, high = 0, len(text)
+    while low < high:  # 二分查找能放下的最长前缀
+        mid = (low + high + 1) // 2
+        if estimate_tokens(text[:mid]) <= max_tokens:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low]
+
+
+class ChatRecord:
+    """一条上下文消息; 同步到多个群时共享同一个对象"""
+    __slots__ = ("role", "content", "source", "user", "lucky_number", "timestamp", "tokens", "seq")
+
+    def __init__(self, role, content, timestamp, source=None, user=None, lucky_number=None):
+        self.role = role
+        self.content = content
+        self.source = source
+        self.user = user
+        self.lucky_number = lucky_number
+        self.timestamp = timestamp
+        self.tokens = estimate_tokens(content)
+        self.seq = 0  # 写入 ContextStore 时分配的递增序号
+
+
+class ContextStore:
+    """
+    按群保存聊天上下文:
+    - 每个群一个 deque(maxlen) 环形缓冲, 追加时自动淘汰最旧的消息, 不再切片复制
+    - 记录按到达顺序追加, 本身有序, 取用时无需排序
+    - window() 按 token 预算从最新往前取消息
+    - 每个群可以有一段滚动摘要, 已折叠进摘要的记录不再出现在 window() 中
+    - 设置了 loader 时, 某个群第一次被用到才从持久化文件恢复
+    """
+    def __init__(self, max_length=50):
+        self.max_length = max_length
+        self._groups = {}
+        self._summaries = {}  # 群 -> (摘要文本, 已折叠到的记录序号)
+        self._seq = 0
+        self._lock = threading.Lock()
+        self.loader = None  # 恢复函数, 接收群号, 返回 (记录列表, 摘要, 已折叠条数) 或 None
+        self._loaded = set()
+        self._load_locks = {}  # 群 -> 正在恢复时使用的锁, 恢复完成后移除
+        self._dirty = set()  # 有变化、需要持久化的群
+
+    def _ensure_loaded(self, group_key):
+        """
+        每个群单独加锁读盘, 不持有 _lock, 其他群的读写与首次恢复不受影响
+        恢复失败也视为已恢复, 之后按空上下文继续, 不会每条消息都重试
+        """
+        if self.loader is None or group_key in self._loaded:
+            return
+        with self._lock:
+            load_lock = self._load_locks.setdefault(group_key, threading.Lock())
+        with load_lock:
+            if group_key in self._loaded:
+                return
+            try:
+                restored = self.loader(group_key)
+            except Exception as e:
+                logger.error(f"恢复群 {group_key} 的上下文失败: {e}")
+                restored = None
+            with self._lock:
+                self._loaded.add(group_key)
+                self._load_locks.pop(group_key, None)
+                if restored:
+                    try:
+                        self._restore(group_key, *restored)
+                    except Exception as e:
+                        logger.error(f"恢复群 {group_key} 的上下文失败: {e}")
+
+    def _restore(self, group_key, records, summary, folded_count):
+        """把恢复的记录放在已有记录之前; 先校验完再修改, 出错时不影响已有上下文"""
+        records = list(records)
+        folded_count = max(0, min(int(folded_count), len(records)))
+        for record in records:
+            self._seq += 1
+            record.seq = self._seq
+        buffer = self._buffer(group_key)
+        existing = list(buffer)
+        buffer.clear()
+        buffer.extend(records + existing)
+        if summary or folded_count:
+            folded_seq = records[folded_count - 1].seq if folded_count else 0
+            self._summaries[group_key] = (summary, folded_seq)
+
+    def _buffer(self, group_key):
+        buffer = self._groups.get(group_key)
+        if buffer is None:
+            buffer = self._groups[group_key] = deque(maxlen=self.max_length)
+        return buffer
+
+    def append(self, record: ChatRecord, group_keys):
+        """把同一条记录追加到多个群的上下文"""
+        for group_key in group_keys:
+            self._ensure_loaded(group_key)
+        with self._lock:
+            if not record.seq:
+                self._seq += 1
+                record.seq = self._seq
+            for group_key in group_keys:
+                self._buffer(group_key).append(record)
+                self._dirty.add(group_key)
+
+    def records(self, group_key, last=None) -> list:
+        """按时间顺序返回该群的记录（last 指定时只取最后几条）"""
+        self._ensure_loaded(group_key)
+        with self._lock:
+            buffer = self._groups.get(group_key, ())
+            if last is None or last >= len(buffer):
+                return list(buffer)
+            return [buffer[i] for i in range(len(buffer) - last, len(buffer))]
+
+    def window(self, group_key, max_tokens) -> list:
+        """从最新往前取, 总 token 数不超过 max_tokens, 按时间顺序返回"""
+        self._ensure_loaded(group_key)
+        selected = []
+        used = 0
+        with self._lock:
+            folded = self._summaries.get(group_key, ("", 0))[1]
+            for record in reversed(self._groups.get(group_key, ())):
+                if record.seq <= folded:
+                    break
+                if used + record.tokens > max_tokens and selected:
+                    break
+                selected.append(record)
+                used += record.tokens
+        selected.reverse()
+        return selected
+
+    def unfolded(self, group_key) -> list:
+        """还没有折叠进摘要的记录, 按时间顺序"""
+        self._ensure_loaded(group_key)
+        with self._lock:
+            folded = self._summaries.get(group_key, ("", 0))[1]
+            return [record for record in self._groups.get(group_key, ()) if record.seq > folded]
+
+    def summary(self, group_key) -> str:
+        self._ensure_loaded(group_key)
+        with self._lock:
+            return self._summaries.get(group_key, ("", 0))[0]
+
+    def fold(self, group_key, summary: str, upto_seq: int):
+        """用新摘要替换旧摘要, 序号不大于 upto_seq 的记录视为已折叠"""
+        self._ensure_loaded(group_key)
+        with self._lock:
+            self._summaries[group_key] = (summary, upto_seq)
+            self._dirty.add(group_key)
+
+    def export(self, group_key):
+        """持久化用: 返回 (记录列表副本, 摘要, 已折叠条数)"""
+        with self._lock:
+            records = list(self._groups.get(group_key, ()))
+            summary, folded_seq = self._summaries.get(group_key, ("", 0))
+        return records, summary, sum(1 for record in records if record.seq <= folded_seq)
+
+    def take_dirty(self) -> set:
+        """取出并清空有变化的群"""
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        return dirty
+
+    def groups(self) -> list:
+        with self._lock:
+            return list(self._groups)
+
+    def __contains__(self, group_key):
+        return group_key in self._groups
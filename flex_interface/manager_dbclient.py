@@ -217,6 +217,22 @@ class MySQLManager:
                     INDEX idx_reward_name (reward_name),
                     INDEX idx_account (account)
                 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+            """,
+            'ai_usage_daily': """
+                CREATE TABLE IF NOT EXISTS ai_usage_daily (
+                    usage_date DATE NOT NULL,
+                    group_id VARCHAR(64) NOT NULL,
+                    user_id VARCHAR(64) NOT NULL DEFAULT '',
+                    feature VARCHAR(16) NOT NULL,
+                    requests INT NOT NULL DEFAULT 0,
+                    prompt_tokens BIGINT NOT NULL DEFAULT 0,
+                    cache_hit_tokens BIGINT NOT NULL DEFAULT 0,
+                    cache_miss_tokens BIGINT NOT NULL DEFAULT 0,
+                    completion_tokens BIGINT NOT NULL DEFAULT 0,
+                    cost DECIMAL(12, 6) NOT NULL DEFAULT 0,
+                    PRIMARY KEY (usage_date, group_id, user_id, feature),
+                    INDEX idx_user_id (user_id)
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
             """
         }
 
@@ -0,0 +1,225 @@
+import heapq
+import itertools
+import json
+import logging
+import threading
+import time
+from .utils import json_dumps
+logger = logging.getLogger("dispatcher")
+
+# 优先级, 数值越小越先执行
+PRIORITY_ECONOMY = 0  # 经济发放/扣除, 不能丢
+PRIORITY_EFFECT = 1  # 整蛊效果、标题、音效
+PRIORITY_NORMAL = 2  # 其他游戏指令、对单个玩家的提示
+PRIORITY_CHAT = 3  # tellraw @a 广播（转发消息、AI 回复）, 队列满时优先丢弃
+PRIORITY_NAMES = {PRIORITY_ECONOMY: "经济", PRIORITY_EFFECT: "效果", PRIORITY_NORMAL: "普通", PRIORITY_CHAT: "广播"}
+
+TELLRAW_ALL_PREFIX = "tellraw @a "
+
+
+class _Command:
+    __slots__ = ("priority", "seq", "command", "enqueued_at", "expire_at", "component")
+
+    def __init__(self, priority, seq, command, enqueued_at, expire_at, component=None):
+        self.priority = priority
+        self.seq = seq
+        self.command = command
+        self.enqueued_at = enqueued_at
+        self.expire_at = expire_at
+        self.component = component  # tellraw @a 的文本组件, 入队时解析一次, 合并时直接使用; 其他指令为 None
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class CommandDispatcher:
+    """
+    MC 控制台指令的统一出口:
+    - 所有线程提交的指令进入同一个优先级队列, 由单独的线程按游戏刻(默认 50ms)执行
+    - 每刻最多执行 commands_per_tick 条, 刷屏时把压力摊到后续的刻上, 保护服务器 TPS
+    - 同一刻内连续的 tellraw @a 合并成一条多组件 tellraw
+    - 广播类消息在队列中超过 chat_ttl 秒未执行则丢弃, 服务器未运行时暂停执行
+    """
+    def __init__(self, execute_func, is_running=None, commands_per_tick=20, tick_interval=0.05,
+                 max_queue_size=2000, max_coalesce=8, chat_ttl=30):
+        """
+        :param execute_func: 实际执行指令的函数, 一般为 server.execute
+        :param is_running: 返回服务器是否在运行, 为空时视为一直运行
+        """
+        self.execute_func = execute_func
+        self.is_running = is_running or (lambda: True)
+        self.commands_per_tick = max(1, commands_per_tick)
+        self.tick_interval = tick_interval
+        self.max_queue_size = max_queue_size
+        self.max_coalesce = max_coalesce
+        self.chat_ttl = chat_ttl
+
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._stop_event = threading.Event()
+        self.stats = {
+            "submitted": 0, "executed": 0, "coalesced": 0, "dropped_full": 0, "expired": 0, "failed": 0,
+            "busy_ticks": 0, "last_delay": 0.0, "avg_delay": 0.0, "max_delay": 0.0
+        }
+        self._thread = threading.Thread(target=self._dispatch_loop, name="mc_command_dispatcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, commands, priority=PRIORITY_NORMAL) -> bool:
+        """提交一条或多条指令（多条时保持顺序）, 返回是否全部入队"""
+        if isinstance(commands, str):
+            commands = [commands]
+        return self._enqueue([(command, self._parse_tellraw_all(command)) for command in commands], priority)
+
+    def _enqueue(self, entries, priority) -> bool:
+        """entries 为 [(指令, tellraw @a 组件或 None)]"""
+        now = time.time()
+        expire_at = now + self.chat_ttl if priority >= PRIORITY_CHAT and self.chat_ttl else None
+        accepted = True
+        with self._cond:
+            for command, component in entries:
+                if len(self._heap) >= self.max_queue_size and priority >= PRIORITY_CHAT:
+                    self.stats["dropped_full"] += 1
+                    accepted = False
+                    continue
+                heapq.heappush(self._heap, _Command(priority, next(self._seq), command, now, expire_at, component))
+                self.stats["submitted"] += 1
+            self._cond.notify()
+        if not accepted:
+            logger.warning(f"指令队列已满({self.max_queue_size})，丢弃广播指令")
+        return accepted
+
+    def tellraw_all(self, component) -> bool:
+        """广播一条 tellraw（component 为字典/列表或已序列化的 JSON 字符串）"""
+        if isinstance(component, str):
+            return self.submit(TELLRAW_ALL_PREFIX + component, PRIORITY_CHAT)
+        return self._enqueue([(TELLRAW_ALL_PREFIX + json_dumps(component), component)], PRIORITY_CHAT)
+
+    def _dispatch_loop(self):
+        while not self._stop_event.is_set():
+            with self._cond:
+                while not self._heap and not self._stop_event.is_set():
+                    self._cond.wait()
+                if self._stop_event.is_set():
+                    return
+            if not self.is_running():
+                self._drop_expired()
+                self._stop_event.wait(1)
+                continue
+            started = time.time()
+            self._run_tick(started)
+            elapsed = time.time() - started
+            if elapsed < self.tick_interval:
+                self._stop_event.wait(self.tick_interval - elapsed)
+
+    def _take_batch(self, now):
+        """取出本刻要执行的指令, 跳过已过期的广播"""
+        batch = []
+        with self._cond:
+            while self._heap and len(batch) < self.commands_per_tick:
+                item = heapq.heappop(self._heap)
+                if item.expire_at is not None and item.expire_at < now:
+                    self.stats["expired"] += 1
+                    continue
+                batch.append(item)
+            if self._heap:
+                self.stats["busy_ticks"] += 1
+        return batch
+
+    def _drop_expired(self):
+        now = time.time()
+        with self._cond:
+            kept = [item for item in self._heap if item.expire_at is None or item.expire_at >= now]
+            self.stats["expired"] += len(self._heap) - len(kept)
+            heapq.heapify(kept)
+            self._heap = kept
+
+    def _run_tick(self, now):
+        batch = self._take_batch(now)
+        for command, items in self._coalesce(batch):
+            self._record_delay(items, now)
+            try:
+                self.execute_func(command)
+                self.stats["executed"] += 1
+            except Exception as e:
+                self.stats["failed"] += 1
+                logger.error(f"执行指令失败: {command} {e}")
+
+    def _coalesce(self, batch):
+        """把相邻的 tellraw @a 合并, 返回 [(指令, 来源条目列表)]"""
+        merged = []
+        group = []
+
+        def flush():
+            if len(group) == 1:
+                merged.append((group[0].command, list(group)))
+            elif group:
+                components = [""]
+                for index, item in enumerate(group):
+                    if index:
+                        components.append("\n")
+                    components.append(item.component)
+                merged.append((TELLRAW_ALL_PREFIX + json_dumps(components), list(group)))
+                self.stats["coalesced"] += len(group) - 1
+            group.clear()
+
+        for item in batch:
+            if item.component is not None and len(group) < self.max_coalesce:
+                group.append(item)
+                continue
+            flush()
+            if item.component is not None:
+                group.append(item)
+            else:
+                merged.append((item.command, [item]))
+        flush()
+        return merged
+
+    @staticmethod
+    def _parse_tellraw_all(command: str):
+        """tellraw @a 指令返回解析后的文本组件, 其他指令或 JSON 无效时返回 None"""
+        if not command.startswith(TELLRAW_ALL_PREFIX):
+            return None
+        try:
+            return json.loads(command[len(TELLRAW_ALL_PREFIX):])
+        except ValueError:
+            return None
+
+    def _record_delay(self, items, now):
+        for item in items:
+            delay = now - item.enqueued_at
+            self.stats["last_delay"] = delay
+            self.stats["max_delay"] = max(self.stats["max_delay"], delay)
+            # 指数滑动平均
+            self.stats["avg_delay"] = delay if not self.stats["avg_delay"] else self.stats["avg_delay"] * 0.9 + delay * 0.1
+
+    def queue_depth(self) -> dict:
+        """各优先级排队中的指令数"""
+        depth = {}
+        with self._cond:
+            for item in self._heap:
+                depth[item.priority] = depth.get(item.priority, 0) + 1
+        return depth
+
+    def get_stats(self) -> dict:
+        stats = dict(self.stats)
+        stats["queue_depth"] = sum(self.queue_depth().values())
+        return stats
+
+    def close(self):
+        """停止调度线程, 服务器仍在运行时把剩余的非广播指令执行完"""
+        self._stop_event.set()
+        with self._cond:
+            self._cond.notify_all()
+        self._thread.join(timeout=2)
+        with self._cond:
+            remaining = sorted(self._heap)
+            self._heap = []
+        if not self.is_running():
+            return
+        for item in remaining:
+            if item.priority < PRIORITY_CHAT:
+                try:
+                    self.execute_func(item.command)
+                except Exception as e:
+                    logger.error(f"执行指令失败: {item.command} {e}")
@@ -0,0 +1,144 @@
+import logging
+import threading
+import time
+from collections import deque
+logger = logging.getLogger("effect_queue")
+
+
+class _PendingEffect:
+    __slots__ = ("method_name", "commands", "user_names", "count", "queued_at")
+
+    def __init__(self, method_name, commands, user_name):
+        self.method_name = method_name
+        self.commands = commands
+        self.user_names = [user_name]
+        self.count = 1
+        self.queued_at = time.time()
+
+
+class EffectScheduler:
+    """
+    按目标账号串行执行整蛊效果:
+    - 同一账号两次效果之间至少间隔 cooldown 秒, 冷却期间到达的效果排队
+    - 排队中已有同种可合并效果时合并为一次（如 3 次冰冻合并为一次 3 倍时长的冰冻）
+    - 每个账号最多排队 max_pending 个, 排满时拒绝, 由调用方退还道具
+    - 配置了 budget(EffectBudget) 时, 执行前按实体/方块预算检查, 超出则降级
+    """
+    def __init__(self, submit_func, build_merged, is_online=None, cooldown=10, max_pending=5, merge_rules=None, budget=None):
+        """
+        :param submit_func: 执行一组指令的函数, 一般为 server.dispatcher.submit
+        :param build_merged: 生成合并效果指令的函数, 接收 (method_name, account, user_names, count)
+        :param is_online: 判断账号是否在线, 执行时已下线的效果丢弃
+        :param merge_rules: {效果方法名: 最多合并次数}
+        """
+        self.submit_func = submit_func
+        self.build_merged = build_merged
+        self.is_online = is_online or (lambda account: True)
+        self.cooldown = cooldown
+        self.max_pending = max_pending
+        self.merge_rules = merge_rules or {}
+        self.budget = budget
+        self._queues = {}  # 账号 -> deque[_PendingEffect]
+        self._ready_at = {}  # 账号 -> 冷却结束时间
+        self._cond = threading.Condition()
+        self._stop_event = threading.Event()
+        self.stats = {"executed": 0, "queued": 0, "merged": 0, "rejected": 0, "dropped_offline": 0}
+        self._thread = threading.Thread(target=self._run_loop, name="effect_scheduler", daemon=True)
+        self._thread.start()
+
+    def can_accept(self, account: str, method_name=None) -> bool:
+        """该账号的排队是否还有空位, 或者能并入排队中的同种效果"""
+        with self._cond:
+            queue = self._queues.get(account, ())
+            if len(queue) < self.max_pending:
+                return True
+            max_stack = self.merge_rules.get(method_name, 1) if method_name else 1
+            return any(p.method_name == method_name and p.count < max_stack for p in queue)
+
+    def schedule(self, account: str, commands, method_name=None, user_name=None) -> str:
+        """
+        提交一次效果, 返回 "run"(立即执行) / "queued"(冷却中排队) / "merged"(并入排队中的同种效果) / "rejected"(排队已满)
+        :param method_name: 效果方法名, 为空时不参与合并（如失败反弹效果）
+        """
+        with self._cond:
+            queue = self._queues.setdefault(account, deque())
+            max_stack = self.merge_rules.get(method_name, 1) if method_name else 1
+            if max_stack > 1:
+                for pending in queue:
+                    if pending.method_name == method_name and pending.count < max_stack:
+                        pending.count += 1
+                        pending.user_names.append(user_name)
+                        self.stats["merged"] += 1
+                        return "merged"
+            if len(queue) >= self.max_pending:
+                self.stats["rejected"] += 1
+                return "rejected"
+            queue.append(_PendingEffect(method_name, commands, user_name))
+            cooling = self._ready_at.get(account, 0) > time.time() or len(queue) > 1
+            if cooling:
+                self.stats["queued"] += 1
+            self._cond.notify()
+            return "queued" if cooling else "run"
+
+    def _run_loop(self):
+        while not self._stop_event.is_set():
+            with self._cond:
+                due, wait_time = self._take_due()
+                if not due:
+                    self._cond.wait(timeout=wait_time)
+                    continue
+            for account, pending in due:
+                self._execute(account, pending)
+
+    def _take_due(self):
+        """取出冷却已结束的账号的下一个效果, 并返回距下一个到期的等待时间"""
+        now = time.time()
+        due = []
+        wait_time = None
+        for account, queue in list(self._queues.items()):
+            if not queue:
+                if self._ready_at.get(account, 0) <= now:
+                    del self._queues[account]
+                    self._ready_at.pop(account, None)
+                continue
+            ready_at = self._ready_at.get(account, 0)
+            if ready_at <= now:
+                due.append((account, queue.popleft()))
+                self._ready_at[account] = now + self.cooldown
+            else:
+                wait_time = ready_at - now if wait_time is None else min(wait_time, ready_at - now)
+        return due, wait_time
+
+    def _execute(self, account, pending: _PendingEffect):
+        if not self.is_online(account):
+            self.stats["dropped_offline"] += 1
+            logger.info(f"{account} 已下线，丢弃排队中的效果 {pending.method_name}")
+            return
+        commands = pending.commands
+        if pending.count > 1:
+            commands = self.build_merged(pending.method_name, account, pending.user_names, pending.count)
+        try:
+            if self.budget:
+                commands = self.budget.apply(
+                    account, commands,
+                    expand=lambda: self.build_merged(pending.method_name, account, pending.user_names, pending.count)
+                )
+            self.submit_func(commands)
+            self.stats["executed"] += 1
+        except Exception as e:
+            logger.error(f"执行 {account} 的效果 {pending.method_name} 失败: {e}")
+
+    def pending(self, account: str = None):
+        """
+        排队中的效果; 传入账号时返回 [(效果方法名, 合并次数, 发起人列表)], 否则返回 {账号: 排队数}
+        """
+        with self._cond:
+            if account is not None:
+                return [(p.method_name, p.count, list(p.user_names)) for p in self._queues.get(account, ())]
+            return {acc: len(queue) for acc, queue in self._queues.items() if queue}
+
+    def close(self):
+        self._stop_event.set()
+        with self._cond:
+            self._cond.notify_all()
+        self._thread.join(timeout=2)
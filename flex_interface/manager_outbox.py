@@ -0,0 +1,245 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from pathlib import Path
+logger = logging.getLogger("outbox")
+
+
+class Outbox:
+    """
+    断线期间的发件箱: 机器人未连接时暂存待发送的 payload, 重连后按顺序补发
+    - 优先存内存, 内存满了之后交给后台线程追加写入磁盘分段文件(每行一条 JSON), 调用方不等待磁盘
+    - 顺序为 内存 -> 磁盘分段 -> 等待落盘的消息, 补发时依次取出
+    - 已出队但没发出去的消息通过 requeue 放回最前面, 不打乱顺序
+    - 每条消息有过期时间, 补发时跳过已过期的消息
+    - 补发速率受 replay_rate 限制, 避免重连后刷屏
+    """
+    def __init__(self, outbox_dir, memory_limit=200, max_items=5000, segment_size=500,
+                 ttl=600, replay_rate=2, buffer_actions=("send_group_msg", "send_group_ai_record")):
+        self.outbox_dir = Path(outbox_dir)
+        self.memory_limit = memory_limit
+        self.max_items = max_items
+        self.segment_size = segment_size
+        self.ttl = ttl
+        self.replay_rate = replay_rate
+        self.buffer_actions = set(buffer_actions)
+
+        self._memory = deque()  # (expire_at, payload)
+        self._spill = deque()  # 比磁盘分段更新、等待后台线程落盘的记录
+        self._segments = deque()  # 按顺序排列的磁盘分段文件
+        self._tail_count = 0  # 最后一个分段已写入的条数
+        self._disk_count = 0
+        self._segment_seq = 0
+        self._lock = threading.Lock()  # 保护内存中的队列与计数, 持有期间不做磁盘读写
+        self._io_lock = threading.Lock()  # 串行化分段文件的读写, 先于 _lock 获取
+        self._replay_thread = None
+        self._replay_stop = threading.Event()
+        self._flush_wakeup = threading.Event()
+        self._flush_stop = threading.Event()
+        self.stats = {"buffered": 0, "replayed": 0, "expired": 0, "dropped": 0, "requeued": 0}
+        self._load_segments()
+        self._flush_thread = threading.Thread(target=self._flush_loop, name="ws_outbox_flush", daemon=True)
+        self._flush_thread.start()
+
+    def _load_segments(self):
+        """启动时接管上次遗留的磁盘分段"""
+        os.makedirs(self.outbox_dir, exist_ok=True)
+        for path in sorted(self.outbox_dir.glob("segment_*.jsonl")):
+            with open(path, "r", encoding="utf-8") as f:
+                count = sum(1 for line in f if line.strip())
+            self._segments.append(path)
+            self._disk_count += count
+            self._tail_count = count
+            self._segment_seq = max(self._segment_seq, int(path.stem.split("_")[1]) + 1)
+        if self._segments:
+            logger.info(f"发件箱载入 {len(self._segments)} 个磁盘分段, 共 {self._disk_count} 条待补发消息")
+
+    def accepts(self, payload) -> bool:
+        """只缓存发消息类的动作, 查询类请求重连后没有补发的意义"""
+        return isinstance(payload, dict) and payload.get("action") in self.buffer_actions
+
+    def __len__(self):
+        with self._lock:
+            return len(self._memory) + self._disk_count + len(self._spill)
+
+    def push(self, payload) -> bool:
+        """暂存一条 payload, 返回是否成功（只操作内存, 落盘由后台线程完成）"""
+        if not self.accepts(payload):
+            return False
+        record = (time.time() + self.ttl, payload)
+        with self._lock:
+            if len(self._memory) + self._disk_count + len(self._spill) >= self.max_items:
+                self.stats["dropped"] += 1
+                logger.warning(f"发件箱已满({self.max_items})，丢弃消息: {payload}")
+                return False
+            if self._disk_count or self._spill or len(self._memory) >= self.memory_limit:
+                self._spill.append(record)
+                self._flush_wakeup.set()
+            else:
+                self._memory.append(record)
+            self.stats["buffered"] += 1
+            return True
+
+    def requeue(self, payloads) -> int:
+        """
+        把已经出队但没能发出的 payload 按原顺序放回最前面（比发件箱中的其他消息都旧）
+        返回放回的条数, 不接受的动作会被跳过
+        """
+        expire_at = time.time() + self.ttl
+        records = [(expire_at, payload) for payload in payloads if self.accepts(payload)]
+        with self._lock:
+            self._memory.extendleft(reversed(records))
+            self.stats["requeued"] += len(records)
+        return len(records)
+
+    # -------------------- 落盘 --------------------
+    def _flush_loop(self):
+        while not self._flush_stop.is_set():
+            self._flush_wakeup.wait(timeout=1)
+            self._flush_wakeup.clear()
+            self._flush()
+
+    def _flush(self):
+        """把等待落盘的记录追加到分段文件; 文件写入时不持有 _lock"""
+        with self._io_lock:
+            with self._lock:
+                records = list(self._spill)
+                self._spill.clear()
+                self._disk_count += len(records)  # 计入磁盘, 长度在写入期间保持不变
+            if records:
+                self._write_records(records)
+
+    def _write_records(self, records):
+        """追加写入分段文件（需持有 _io_lock）"""
+        while records:
+            if not self._segments or self._tail_count >= self.segment_size:
+                self._segments.append(self.outbox_dir / f"segment_{self._segment_seq:08d}.jsonl")
+                self._segment_seq += 1
+                self._tail_count = 0
+            chunk, records = records[:self.segment_size - self._tail_count], records[self.segment_size - self._tail_count:]
+            try:
+                with open(self._segments[-1], "a", encoding="utf-8") as f:
+                    f.writelines(
+                        json.dumps({"expire_at": expire_at, "payload": payload}, ensure_ascii=False) + "\n"
+                        for expire_at, payload in chunk
+                    )
+            except OSError as e:
+                logger.error(f"写入发件箱分段 {self._segments[-1]} 失败，丢弃 {len(chunk)} 条消息: {e}")
+                with self._lock:
+                    self._disk_count -= len(chunk)
+                    self.stats["dropped"] += len(chunk)
+                continue
+            self._tail_count += len(chunk)
+
+    def _read_segment(self, path):
+        records = []
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    item = json.loads(line)
+                    records.append((item["expire_at"], item["payload"]))
+                except (ValueError, KeyError) as e:
+                    logger.warning(f"发件箱分段 {path.name} 存在损坏记录，已跳过: {e}")
+                    records.append(None)
+        return records
+
+    def _refill(self):
+        """内存取空后, 读回最旧的磁盘分段; 没有分段时接管等待落盘的记录"""
+        with self._io_lock:
+            if not self._segments:
+                with self._lock:
+                    self._disk_count = 0
+                    self._memory.extend(self._spill)
+                    self._spill.clear()
+                return
+            path = self._segments.popleft()
+            try:
+                records = self._read_segment(path)
+                os.remove(path)
+            except OSError as e:
+                logger.error(f"读取发件箱分段 {path} 失败: {e}")
+                records = []
+            with self._lock:
+                self._disk_count -= len(records)
+                if not self._segments:
+                    self._tail_count = 0
+                    self._disk_count = 0
+                # 读取期间 requeue 放回的消息更旧, 留在前面
+                self._memory.extend(record for record in records if record)
+
+    def pop(self):
+        """按顺序取出下一条未过期的 payload, 没有则返回 None"""
+        now = time.time()
+        while True:
+            with self._lock:
+                while self._memory:
+                    expire_at, payload = self._memory.popleft()
+                    if expire_at < now:
+                        self.stats["expired"] += 1
+                        continue
+                    return payload
+                if not self._disk_count and not self._spill:
+                    return None
+            self._refill()
+
+    def start_replay(self, send_func, is_connected):
+        """
+        在后台线程中按限速补发
+        :param send_func: 实际发送函数, 接收单个 payload
+        :param is_connected: 返回当前是否已连接, 断开时暂停补发
+        """
+        if self._replay_thread and self._replay_thread.is_alive():
+            return
+        if not len(self):
+            return
+        self._replay_stop.clear()
+        self._replay_thread = threading.Thread(
+            target=self._replay_loop, args=(send_func, is_connected), name="ws_outbox_replay", daemon=True
+        )
+        self._replay_thread.start()
+
+    def is_replaying(self) -> bool:
+        return bool(self._replay_thread and self._replay_thread.is_alive())
+
+    def _replay_loop(self, send_func, is_connected):
+        interval = 1.0 / self.replay_rate if self.replay_rate > 0 else 0
+        logger.info(f"开始补发发件箱中的 {len(self)} 条消息")
+        while not self._replay_stop.is_set() and is_connected():
+            payload = self.pop()
+            if payload is None:
+                break
+            send_func(payload)
+            self.stats["replayed"] += 1
+            if interval:
+                self._replay_stop.wait(interval)
+        logger.info(f"发件箱补发结束, 剩余 {len(self)} 条")
+
+    def close(self):
+        """停止补发与后台落盘, 剩余消息全部落盘以便下次加载"""
+        self._replay_stop.set()
+        if self._replay_thread and self._replay_thread.is_alive():
+            self._replay_thread.join(timeout=2)
+        self._flush_stop.set()
+        self._flush_wakeup.set()
+        self._flush_thread.join(timeout=2)
+        self._flush()
+        with self._io_lock:
+            with self._lock:
+                memory = list(self._memory)
+                self._memory.clear()
+            if not memory:
+                return
+            # 内存中的消息比磁盘中的旧, 与磁盘分段一起按顺序重写
+            pending = memory + [record for path in self._segments for record in self._read_segment(path) if record]
+            for path in list(self._segments):
+                os.remove(path)
+            self._segments.clear()
+            self._tail_count = 0
+            with self._lock:
+                self._disk_count = len(pending)
+            self._write_records(pending)
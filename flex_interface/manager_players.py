@@ -0,0 +1,107 @@
+import logging
+import threading
+import time
+logger = logging.getLogger("players")
+
+
+class OnlinePlayers:
+    """
+    进程内的在线玩家表, 查询不再向服务器发 list 等待回复
+    - 由 PLAYER_JOINED / PLAYER_LEFT 事件实时维护
+    - 服务器启动完成时以及每隔 reconcile_interval 秒用 list 的结果校正一次（插件重载、漏掉事件时兜底）
+    - 玩家名区分大小写, 与游戏内一致
+    """
+    def __init__(self, server, reconcile_interval=300, list_timeout=5):
+        """
+        :param server: PluginServerInterface, 需已挂载 mc_api
+        """
+        self.server = server
+        self.reconcile_interval = reconcile_interval
+        self.list_timeout = list_timeout
+        self.limit = 0  # 服务器最大人数, 校正后可用
+        self._players = {}  # 玩家名 -> 加入时间
+        self._changed_at = {}  # 玩家名 -> 最近一次进出事件的时间, 用于校正时避开事件竞争
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._reconcile_loop, name="online_players", daemon=True)
+        self._thread.start()
+
+    # -------------------- 事件 --------------------
+    def on_join(self, player: str):
+        now = time.time()
+        with self._lock:
+            self._players.setdefault(player, now)
+            self._changed_at[player] = now
+
+    def on_left(self, player: str):
+        with self._lock:
+            self._players.pop(player, None)
+            self._changed_at[player] = time.time()
+
+    def clear(self):
+        """服务器停止时清空"""
+        with self._lock:
+            self._players.clear()
+            self._changed_at.clear()
+
+    # -------------------- 查询 --------------------
+    def __contains__(self, player) -> bool:
+        return player in self._players
+
+    def __len__(self):
+        return len(self._players)
+
+    def is_online(self, player: str) -> bool:
+        return player in self._players
+
+    def joined_at(self, player: str):
+        """玩家加入时间, 不在线返回 None"""
+        return self._players.get(player)
+
+    def players(self) -> list:
+        """按加入先后排列的在线玩家"""
+        with self._lock:
+            return sorted(self._players, key=self._players.get)
+
+    # -------------------- 校正 --------------------
+    def reconcile(self) -> bool:
+        """用 list 的结果校正在线表, 返回是否成功"""
+        started = time.time()
+        result = self.server.mc_api.get_server_player_list(timeout=self.list_timeout)
+        if not result:
+            logger.warning("获取在线玩家列表失败，跳过本次校正")
+            return False
+        amount, limit, players = result
+        listed = set(players)
+        now = time.time()
+        with self._lock:
+            self.limit = limit
+            for player in listed - set(self._players):
+                if self._changed_at.get(player, 0) < started:  # list 发出后有进出事件的以事件为准
+                    self._players[player] = now
+                    logger.info(f"校正在线玩家: 补充 {player}")
+            for player in set(self._players) - listed:
+                if self._changed_at.get(player, 0) < started:
+                    del self._players[player]
+                    logger.info(f"校正在线玩家: 移除 {player}")
+            self._changed_at = {p: t for p, t in self._changed_at.items() if t >= started}
+        return True
+
+    def reconcile_async(self):
+        threading.Thread(target=self._safe_reconcile, name="online_players_reconcile", daemon=True).start()
+
+    def _safe_reconcile(self):
+        try:
+            self.reconcile()
+        except Exception as e:
+            logger.error(f"校正在线玩家失败: {e}")
+
+    def _reconcile_loop(self):
+        if self.server.is_server_startup():  # 插件重载时服务器已在运行, 先取一次完整列表
+            self._safe_reconcile()
+        while not self._stop_event.wait(self.reconcile_interval):
+            if self.server.is_server_startup():
+                self._safe_reconcile()
+
+    def close(self):
+        self._stop_event.set()
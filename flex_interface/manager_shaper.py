@@ -0,0 +1,150 @@
+import logging
+import threading
+import time
+from .utils import build_payload
+logger = logging.getLogger("shaper")
+
+
+class _GroupState:
+    """单个群的待合并消息与令牌桶"""
+    __slots__ = ("lines", "dropped", "first_at", "tokens", "refilled_at")
+
+    def __init__(self, burst):
+        self.lines = []
+        self.dropped = 0  # 积压超过上限被丢弃的最早几行, 发送时合并成一行提示
+        self.first_at = 0.0
+        self.tokens = float(burst)
+        self.refilled_at = time.time()
+
+
+class GroupShaper:
+    """
+    按群整形出站消息:
+    - 转发类消息(聊天转发、进出服、死亡、成就)在 merge_window 秒内到达的合并为一条多行消息
+    - 每个群按令牌桶限制每秒消息数(rate), 允许短时突发(burst)
+    - 指令回复、AI 回复走优先通道, 立即发送, 但同样消耗该群的令牌
+    - 每个群最多积压 max_pending_lines 行, 超出时丢弃最早的行, 发送时以"…省略 N 条"代替
+    """
+    def __init__(self, send_func, merge_window=1.5, max_merge_lines=10, rate=0.5, burst=3, max_pending_lines=50):
+        """
+        :param send_func: 实际发送 payload 的函数, 一般为 server.wscl.send_group_message
+        """
+        self.send_func = send_func
+        self.merge_window = merge_window
+        self.max_merge_lines = max(max_merge_lines, 2)  # 至少留一行给省略提示
+        self.max_pending_lines = max(max_pending_lines, self.max_merge_lines)
+        self.rate = rate
+        self.burst = burst
+        self._groups = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._flush_loop, name="group_shaper", daemon=True)
+        self._thread.start()
+        self.stats = {"lines": 0, "merged_sent": 0, "priority_sent": 0, "dropped": 0}
+
+    def _state(self, group_id) -> _GroupState:
+        state = self._groups.get(group_id)
+        if state is None:
+            state = self._groups[group_id] = _GroupState(self.burst)
+        return state
+
+    def _refill(self, state: _GroupState, now):
+        if self.rate:
+            state.tokens = min(self.burst, state.tokens + (now - state.refilled_at) * self.rate)
+        else:
+            state.tokens = self.burst
+        state.refilled_at = now
+
+    def submit(self, group_ids, message: str):
+        """提交一行转发类消息, 由后台线程合并后发送"""
+        if not isinstance(group_ids, (list, tuple, set)):
+            group_ids = [group_ids]
+        now = time.time()
+        with self._lock:
+            for group_id in group_ids:
+                state = self._state(str(group_id))
+                if not state.lines:
+                    state.first_at = now
+                state.lines.append(message)
+                self.stats["lines"] += 1
+                if len(state.lines) > self.max_pending_lines:
+                    del state.lines[0]
+                    state.dropped += 1
+                    self.stats["dropped"] += 1
+                if len(state.lines) >= self.max_merge_lines:
+                    self._wakeup.set()
+        self._wakeup.set()
+
+    def send_priority(self, payload):
+        """优先通道: 立即发送, 并从对应群的令牌桶中扣除（可以扣成负数, 让转发消息让路）"""
+        payloads = payload if isinstance(payload, list) else [payload]
+        now = time.time()
+        with self._lock:
+            for p in payloads:
+                group_id = p.get("params", {}).get("group_id") if isinstance(p, dict) else None
+                if group_id is not None:
+                    state = self._state(str(group_id))
+                    self._refill(state, now)
+                    state.tokens -= 1
+                self.stats["priority_sent"] += 1
+        return self.send_func(payload)
+
+    def _flush_loop(self):
+        while not self._stop_event.is_set():
+            self._wakeup.wait(timeout=0.2)
+            self._wakeup.clear()
+            for group_id, text in self._collect_ready():
+                try:
+                    self.send_func(build_payload("default", group_id, text))
+                except Exception as e:
+                    logger.error(f"发送合并消息失败: {e}")
+
+    def _collect_ready(self):
+        """取出已到合并窗口且有令牌的群的消息"""
+        ready = []
+        now = time.time()
+        with self._lock:
+            for group_id, state in self._groups.items():
+                if not state.lines:
+                    continue
+                window_passed = now - state.first_at >= self.merge_window
+                if not window_passed and len(state.lines) < self.max_merge_lines:
+                    continue
+                self._refill(state, now)
+                if state.tokens < 1:
+                    continue  # 令牌不足, 继续累积, 下次一起合并
+                state.tokens -= 1
+                ready.append((group_id, self._take_lines(state, self.max_merge_lines)))
+                state.first_at = now
+                self.stats["merged_sent"] += 1
+        return ready
+
+    @staticmethod
+    def _take_lines(state: _GroupState, limit=None) -> str:
+        """取出最多 limit 行合并为一条消息, 有被丢弃的行时第一行为省略提示"""
+        lines = []
+        if state.dropped:
+            lines.append(f"…省略 {state.dropped} 条")
+            state.dropped = 0
+            if limit:
+                limit -= 1
+        taken = state.lines[:limit] if limit else state.lines
+        state.lines = state.lines[len(taken):]
+        return "\n".join(lines + taken)
+
+    def pending(self) -> dict:
+        """各群待发送的行数"""
+        with self._lock:
+            return {group_id: len(state.lines) for group_id, state in self._groups.items() if state.lines}
+
+    def close(self):
+        """停止后台线程, 并把剩余消息立即发出"""
+        self._stop_event.set()
+        self._wakeup.set()
+        self._thread.join(timeout=2)
+        with self._lock:
+            remaining = [(gid, self._take_lines(state)) for gid, state in self._groups.items() if state.lines]
+            self._groups.clear()
+        for group_id, text in remaining:
+            self.send_func(build_payload("default", group_id, text))
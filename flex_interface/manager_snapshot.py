@@ -0,0 +1,97 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+logger = logging.getLogger("snapshot")
+
+
+class PlayerSnapshots:
+    """
+    玩家 NBT 快照:
+    - 每个玩家只查询一次完整实体数据(data get entity), 各字段从快照中读取
+    - 多个玩家的查询放到有上限的线程池中并行执行
+    - 快照缓存 ttl 秒, 同一玩家正在查询时复用同一个请求
+    """
+    def __init__(self, get_player_info, max_workers=4, ttl=5, timeout=5):
+        """
+        :param get_player_info: minecraft_data_api.get_player_info
+        :param timeout: 单个玩家的查询超时（秒）
+        """
+        self.get_player_info = get_player_info
+        self.ttl = ttl
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="player_snapshot")
+        self._cache = {}  # 玩家名 -> (获取时间, 快照)
+        self._pending = {}  # 玩家名 -> 正在进行的 Future
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "fetched": 0, "failed": 0}
+
+    def _fetch(self, player):
+        try:
+            data = self.get_player_info(player, timeout=self.timeout)
+        except Exception as e:
+            logger.warning(f"获取玩家 {player} 的实体数据失败: {e}")
+            data = None
+        with self._lock:
+            self._pending.pop(player, None)
+            if isinstance(data, dict):
+                self._cache[player] = (time.time(), data)
+                self.stats["fetched"] += 1
+            else:
+                self.stats["failed"] += 1
+        return data if isinstance(data, dict) else None
+
+    def get_many(self, players) -> dict:
+        """
+        获取多个玩家的快照, 返回 {玩家名: 快照字典}; 查询失败或超时的玩家不在结果中
+        """
+        now = time.time()
+        result = {}
+        futures = {}
+        with self._lock:
+            for player in players:
+                cached = self._cache.get(player)
+                if cached and now - cached[0] < self.ttl:
+                    result[player] = cached[1]
+                    self.stats["hits"] += 1
+                    continue
+                future = self._pending.get(player)
+                if future is None:
+                    future = self._pending[player] = self._executor.submit(self._fetch, player)
+                futures[player] = future
+        if futures:
+            wait(futures.values(), timeout=self.timeout + 1)
+        for player, future in futures.items():
+            if future.done() and future.result():
+                result[player] = future.result()
+        return result
+
+    def get(self, player: str):
+        """获取单个玩家的快照, 失败返回 None"""
+        return self.get_many([player]).get(player)
+
+    def peek(self, player: str, prefetch=True):
+        """
+        只读缓存, 不等待查询: 缓存过期或没有时返回 None
+        prefetch 为 True 时在后台发起查询, 下次调用即可命中
+        """
+        now = time.time()
+        with self._lock:
+            cached = self._cache.get(player)
+            if cached and now - cached[0] < self.ttl:
+                self.stats["hits"] += 1
+                return cached[1]
+            if prefetch and player not in self._pending:
+                self._pending[player] = self._executor.submit(self._fetch, player)
+        return None
+
+    def invalidate(self, player: str = None):
+        """丢弃缓存（不传玩家名时清空全部）"""
+        with self._lock:
+            if player is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(player, None)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
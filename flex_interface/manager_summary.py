@@ -0,0 +1,79 @@
+import logging
+import threading
+import time
+from .manager_context import ContextStore, truncate_to_tokens
+logger = logging.getLogger("summary")
+
+
+class ContextSummarizer:
+    """
+    滚动摘要: 后台把各群较早的聊天记录折叠进该群的摘要, 控制每次请求的输入长度
+    - 某群未折叠的记录达到 fold_threshold 条时, 保留最近 keep_recent 条原文, 其余连同旧摘要交给模型压缩
+    - 只在该群没有排队或进行中的AI请求时执行, 不与正常回复抢接口
+    - 某群失败后按 interval 指数退避(最长 max_backoff 秒)再重试, 避免接口故障时每轮都为同一批记录请求
+    """
+    def __init__(self, store: ContextStore, summarize_func, is_busy=None, keep_recent=10, fold_threshold=20,
+                 interval=60, max_summary_tokens=300, max_backoff=1800):
+        """
+        :param summarize_func: 生成摘要的函数, 接收 (群, 旧摘要, 待折叠的记录列表), 返回新摘要, 失败返回 None
+        :param is_busy: 判断该群是否正在处理AI请求
+        :param max_backoff: 连续失败后的最长重试间隔（秒）
+        """
+        self.store = store
+        self.summarize_func = summarize_func
+        self.is_busy = is_busy or (lambda group_key: False)
+        self.keep_recent = keep_recent
+        self.fold_threshold = max(fold_threshold, keep_recent + 1)
+        self.interval = interval
+        self.max_summary_tokens = max_summary_tokens
+        self.max_backoff = max_backoff
+        self._backoff = {}  # 群 -> (连续失败次数, 下次重试时间)
+        self.stats = {"folded": 0, "records": 0, "failed": 0, "backoff_skipped": 0}
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run_loop, name="context_summarizer", daemon=True)
+        self._thread.start()
+
+    def _run_loop(self):
+        while not self._stop_event.wait(self.interval):
+            for group_key in self.store.groups():
+                if self._stop_event.is_set():
+                    return
+                if self.is_busy(group_key):
+                    continue
+                backoff = self._backoff.get(group_key)
+                if backoff and backoff[1] > time.time():
+                    self.stats["backoff_skipped"] += 1
+                    continue
+                try:
+                    self.fold(group_key)
+                except Exception as e:
+                    self._record_failure(group_key)
+                    logger.error(f"群 {group_key} 生成聊天摘要失败: {e}")
+
+    def _record_failure(self, group_key):
+        failures = self._backoff.get(group_key, (0, 0))[0] + 1
+        delay = min(self.interval * 2 ** (failures - 1), self.max_backoff)
+        self._backoff[group_key] = (failures, time.time() + delay)
+        self.stats["failed"] += 1
+        if failures > 1:
+            logger.warning(f"群 {group_key} 连续 {failures} 次生成摘要失败，{delay:.0f}s 后再试")
+
+    def fold(self, group_key) -> bool:
+        """未折叠的记录达到阈值时折叠一次, 返回是否折叠"""
+        records = self.store.unfolded(group_key)
+        if len(records) < self.fold_threshold:
+            return False
+        batch = records[:len(records) - self.keep_recent]
+        summary = self.summarize_func(group_key, self.store.summary(group_key), batch)
+        if not summary:
+            self._record_failure(group_key)
+            return False
+        self._backoff.pop(group_key, None)
+        self.store.fold(group_key, truncate_to_tokens(summary.strip(), self.max_summary_tokens), batch[-1].seq)
+        self.stats["folded"] += 1
+        self.stats["records"] += len(batch)
+        logger.info(f"群 {group_key} 已将 {len(batch)} 条聊天记录折叠进摘要")
+        return True
+
+    def close(self):
+        self._stop_event.set()
@@ -0,0 +1,374 @@
+import base64
+import hashlib
+import hmac
+import logging
+import socket
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import requests
+from .manager_wsclient import WebSocketClient, STATE_CONNECTED, STATE_DISCONNECTED, STATE_RECONNECTING
+from .utils import json_dumps, json_loads
+logger = logging.getLogger("transport")
+
+_WS_MAGIC = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+_OP_CONT, _OP_TEXT, _OP_BINARY, _OP_CLOSE, _OP_PING, _OP_PONG = 0x0, 0x1, 0x2, 0x8, 0x9, 0xA
+_CLOSE_PROTOCOL_ERROR, _CLOSE_TOO_BIG = 1002, 1009
+
+
+class _FrameError(ValueError):
+    """对端发来不合规的帧, 以 code 关闭连接"""
+    def __init__(self, code, reason):
+        super().__init__(reason)
+        self.code = code
+
+
+def _check_token(headers, query, access_token) -> bool:
+    """校验 OneBot 的 access_token（请求头 Authorization 或查询参数 access_token）"""
+    if not access_token:
+        return True
+    auth = headers.get("Authorization", "")
+    if auth in (f"Bearer {access_token}", f"Token {access_token}"):
+        return True
+    return parse_qs(query).get("access_token", [None])[0] == access_token
+
+
+class ReverseWebSocketServer(WebSocketClient):
+    """
+    反向 WebSocket: 插件监听端口, 由 OneBot 实现主动连接（Lagrange 的 ReverseWebSocket 配置）
+    发送队列、发件箱、请求/响应、统计都复用 WebSocketClient, 只替换连接的建立与收发
+    同一时间只保留一个连接, 新连接会替换旧连接
+    超过 max_frame_size 的帧或消息以 1009 关闭, 未掩码的客户端帧以 1002 关闭
+    """
+    def __init__(self, host, port, on_message_callback, on_status_callback=None, path="/onebot/v11/ws",
+                 access_token=None, max_frame_size=16 * 1024 * 1024, **kwargs):
+        super().__init__(f"ws://{host}:{port}{path}", on_message_callback, on_status_callback, **kwargs)
+        self.host = host
+        self.port = port
+        self.path = path
+        self.access_token = access_token
+        self.max_frame_size = max_frame_size
+        self.auto_reconnect = False  # 断开后等待对端重连
+        self.ping_interval = 0
+        self._server_sock = None
+        self._conn = None
+        self._conn_lock = threading.Lock()
+        self._send_lock = threading.Lock()  # 写线程与读线程(回复 pong)都会写 socket
+
+    # -------------------- 连接管理 --------------------
+    def _run(self):
+        """监听端口并接受连接, 每个连接在独立线程中读取"""
+        try:
+            self._server_sock = socket.create_server((self.host, self.port))
+        except OSError as e:
+            logger.error(f"[{self.name}] 反向 WebSocket 监听 {self.host}:{self.port} 失败: {e}")
+            with self._state_lock:
+                self.state = STATE_DISCONNECTED
+            return
+        logger.info(f"[{self.name}] 反向 WebSocket 正在监听 {self.ws_url}")
+        with self._state_lock:
+            self.state = STATE_DISCONNECTED
+        while not self._stop_flag:
+            try:
+                conn, addr = self._server_sock.accept()
+            except OSError:
+                break
+            threading.Thread(target=self._serve_connection, args=(conn, addr), name="ws_reverse_conn", daemon=True).start()
+
+    def _handshake(self, conn) -> bool:
+        request = b""
+        while b"\r\n\r\n" not in request:
+            chunk = conn.recv(4096)
+            if not chunk or len(request) > 65536:
+                return False
+            request += chunk
+        lines = request.split(b"\r\n\r\n", 1)[0].decode("latin-1").split("\r\n")
+        try:
+            _, target, _ = lines[0].split(" ", 2)
+        except ValueError:
+            return False
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                key, value = line.split(":", 1)
+                headers[key.strip().title()] = value.strip()
+        parsed = urlparse(target)
+        key = headers.get("Sec-Websocket-Key")
+        if parsed.path.rstrip("/") != self.path.rstrip("/") or not key:
+            conn.sendall(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n")
+            return False
+        if not _check_token(headers, parsed.query, self.access_token):
+            conn.sendall(b"HTTP/1.1 401 Unauthorized\r\nContent-Length: 0\r\n\r\n")
+            return False
+        accept = base64.b64encode(hashlib.sha1((key + _WS_MAGIC).encode()).digest()).decode()
+        conn.sendall((
+            "HTTP/1.1 101 Switching Protocols\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            f"Sec-WebSocket-Accept: {accept}\r\n\r\n"
+        ).encode())
+        return True
+
+    def _serve_connection(self, conn, addr):
+        try:
+            if not self._handshake(conn):
+                conn.close()
+                return
+        except OSError as e:
+            logger.warning(f"[{self.name}] 反向 WebSocket 握手失败 {addr}: {e}")
+            conn.close()
+            return
+
+        with self._conn_lock:
+            old_conn, self._conn = self._conn, conn
+        if old_conn:
+            logger.info(f"[{self.name}] 新连接 {addr} 替换旧连接")
+            self._close_socket(old_conn)
+        logger.info(f"[{self.name}] OneBot 已从 {addr} 连入")
+        self.on_open(None)
+
+        reader = conn.makefile("rb")
+        fragments = []
+        fragments_size = 0
+        try:
+            while True:
+                fin, opcode, data = self._read_frame(reader)
+                if opcode is None or opcode == _OP_CLOSE:
+                    break
+                if opcode == _OP_PING:
+                    self._send_frame(conn, _OP_PONG, data)
+                elif opcode == _OP_PONG:
+                    self.on_pong(None, data)
+                elif opcode in (_OP_TEXT, _OP_BINARY, _OP_CONT):
+                    fragments_size += len(data)
+                    if fragments_size > self.max_frame_size:
+                        raise _FrameError(_CLOSE_TOO_BIG, f"分片消息超过 {self.max_frame_size} 字节")
+                    fragments.append(data)
+                    if fin:
+                        message = b"".join(fragments)
+                        fragments = []
+                        fragments_size = 0
+                        self.on_message(None, message.decode("utf-8"))
+        except _FrameError as e:
+            logger.warning(f"[{self.name}] 反向 WebSocket 收到不合规的帧, 以 {e.code} 关闭连接: {e}")
+            self._send_close(conn, e.code, str(e))
+        except (OSError, ValueError) as e:
+            logger.warning(f"[{self.name}] 反向 WebSocket 读取失败: {e}")
+        finally:
+            with self._conn_lock:
+                is_current = self._conn is conn
+                if is_current:
+                    self._conn = None
+            self._close_socket(conn)
+            if is_current:
+                self.on_close(None, None, None)
+
+    def _read_frame(self, reader):
+        header = reader.read(2)
+        if len(header) < 2:
+            return True, None, b""
+        first, second = header
+        fin = bool(first & 0x80)
+        opcode = first & 0x0F
+        length = second & 0x7F
+        if length == 126:
+            length = struct.unpack("!H", reader.read(2))[0]
+        elif length == 127:
+            length = struct.unpack("!Q", reader.read(8))[0]
+        if length > self.max_frame_size:  # 先检查长度, 不读入超大的帧
+            raise _FrameError(_CLOSE_TOO_BIG, f"帧长度 {length} 超过 {self.max_frame_size} 字节")
+        if not second & 0x80:
+            raise _FrameError(_CLOSE_PROTOCOL_ERROR, "客户端帧未掩码")
+        mask = reader.read(4)
+        data = reader.read(length)
+        if len(data) < length:
+            return True, None, b""
+        if mask and length:
+            # 整块异或解掩码, 比逐字节循环快得多
+            full_mask = (mask * (length // 4 + 1))[:length]
+            data = (int.from_bytes(data, "big") ^ int.from_bytes(full_mask, "big")).to_bytes(length, "big")
+        return fin, opcode, data
+
+    def _send_frame(self, conn, opcode, data: bytes):
+        length = len(data)
+        if length < 126:
+            header = struct.pack("!BB", 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+        with self._send_lock:
+            conn.sendall(header + data)
+
+    def _send_close(self, conn, code, reason=""):
+        """发送关闭帧, 原因截断到控制帧允许的长度"""
+        payload = struct.pack("!H", code) + reason.encode("utf-8")[:123].decode("utf-8", "ignore").encode("utf-8")
+        try:
+            self._send_frame(conn, _OP_CLOSE, payload)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _close_socket(conn):
+        try:
+            conn.close()
+        except OSError:
+            pass
+
+    def is_connected(self) -> bool:
+        return self._conn is not None
+
+    def _transmit(self, payload):
+        conn = self._conn
+        if conn is None:
+            raise ConnectionError("OneBot 未连入")
+        try:
+            self._send_frame(conn, _OP_TEXT, json_dumps(payload).encode("utf-8"))
+        except OSError as e:
+            raise ConnectionError(str(e))
+
+    def _reconnect(self):
+        """服务端模式无法主动重连: 断开当前连接, 等待 OneBot 重新连入"""
+        with self._conn_lock:
+            conn, self._conn = self._conn, None
+        if conn:
+            logger.info(f"[{self.name}] 断开当前连接，等待 OneBot 重新连入")
+            self._close_socket(conn)
+            self.on_close(None, None, None)
+
+    def stop(self):
+        self._reconnect()
+
+    def close(self):
+        super().close()
+        if self._server_sock:
+            self._close_socket(self._server_sock)
+
+
+class HttpTransport(WebSocketClient):
+    """
+    HTTP 模式: 事件由 OneBot 的 HTTP POST 推送到本地监听端口, 动作通过 OneBot 的 HTTP API 调用
+    动作的响应直接在 HTTP 响应中返回, 按请求的 echo 交给请求/响应机制处理
+    """
+    def __init__(self, api_url, listen_host, listen_port, on_message_callback, on_status_callback=None,
+                 path="/", access_token=None, secret=None, http_timeout=10, **kwargs):
+        super().__init__(api_url, on_message_callback, on_status_callback, **kwargs)
+        self.api_url = api_url.rstrip("/")
+        self.listen_host = listen_host
+        self.listen_port = listen_port
+        self.path = path
+        self.access_token = access_token
+        self.secret = secret  # OneBot HTTP POST 的 X-Signature 密钥
+        self.http_timeout = http_timeout
+        self.ping_interval = 0
+        self._session = requests.Session()
+        if access_token:
+            self._session.headers["Authorization"] = f"Bearer {access_token}"
+        self._httpd = None
+        self._api_ok = False
+
+    def _run(self):
+        """启动事件接收服务, 并探测一次 API 是否可用"""
+        transport = self
+
+        class _EventHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                parsed = urlparse(self.path)
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if parsed.path.rstrip("/") != transport.path.rstrip("/"):
+                    status = 404
+                elif not transport._verify_signature(self.headers.get("X-Signature"), body):
+                    status = 403
+                else:
+                    status = 204
+                self.send_response(status)
+                self.end_headers()
+                if status == 204:
+                    transport.on_message(None, body.decode("utf-8"))
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self._httpd = ThreadingHTTPServer((self.listen_host, self.listen_port), _EventHandler)
+        except OSError as e:
+            logger.error(f"[{self.name}] HTTP 事件接收监听 {self.listen_host}:{self.listen_port} 失败: {e}")
+            with self._state_lock:
+                self.state = STATE_DISCONNECTED
+            return
+        logger.info(f"[{self.name}] HTTP 事件接收已监听 {self.listen_host}:{self.listen_port}{self.path}")
+        threading.Thread(target=self._probe, name="http_probe", daemon=True).start()
+        self._httpd.serve_forever()
+
+    def _verify_signature(self, signature, body: bytes) -> bool:
+        if not self.secret:
+            return True
+        expected = "sha1=" + hmac.new(self.secret.encode(), body, hashlib.sha1).hexdigest()
+        return bool(signature) and hmac.compare_digest(signature, expected)
+
+    def _post_action(self, payload):
+        """调用 HTTP API, 返回 OneBot 的响应 JSON; 网络错误统一抛出 ConnectionError"""
+        try:
+            response = self._session.post(
+                f"{self.api_url}/{payload['action']}", json=payload.get("params", {}), timeout=self.http_timeout
+            )
+        except requests.RequestException as e:
+            self._mark_down()
+            raise ConnectionError(str(e))
+        response.raise_for_status()
+        return json_loads(response.content)
+
+    def _probe(self):
+        """用 get_status 探测 API 是否可用, 可用则进入已连接状态"""
+        try:
+            self._post_action({"action": "get_status", "params": {}})
+        except Exception as e:
+            logger.warning(f"[{self.name}] OneBot HTTP API 不可用: {e}")
+            self._mark_down()
+            with self._state_lock:
+                self.state = STATE_DISCONNECTED
+            return
+        if not self._api_ok:
+            self._api_ok = True
+            self.on_open(None)
+        else:
+            # 只是长时间没有事件推送, API 仍可用
+            with self._state_lock:
+                self.state = STATE_CONNECTED
+            self.last_frame_time = time.time()
+
+    def _mark_down(self):
+        if self._api_ok:
+            self._api_ok = False
+            self.on_close(None, None, None)
+
+    def is_connected(self) -> bool:
+        return self._api_ok
+
+    def _transmit(self, payload):
+        result = self._post_action(payload)
+        echo = payload.get("echo")
+        if echo is not None and isinstance(result, dict):
+            result["echo"] = echo
+            self._resolve_call(result)
+
+    def _reconnect(self):
+        """HTTP 没有长连接, 重连即重新探测 API"""
+        if self._stop_flag:
+            return
+        with self._state_lock:
+            if self.state == STATE_RECONNECTING:
+                return
+            self.state = STATE_RECONNECTING
+        threading.Thread(target=self._probe, name="http_probe", daemon=True).start()
+
+    def stop(self):
+        self._api_ok = False
+
+    def close(self):
+        super().close()
+        if self._httpd:
+            self._httpd.shutdown()
+            self._httpd.server_close()
@@ -1,28 +1,109 @@
 
-import json
 import logging
 import websocket
 import threading
 import time
+import queue
+import random
+import uuid
+from concurrent.futures import Future
+from .utils import json_dumps, json_loads, is_meta_event_frame
 logger = logging.getLogger("websocket")
 
+
+class _OutboundItem:
+    """待发送的一条 payload, future 为 None 时表示发出即不管"""
+    __slots__ = ("payload", "future", "enqueued_at")
+
+    def __init__(self, payload, future=None):
+        self.payload = payload
+        self.future = future
+        self.enqueued_at = time.time()
+
+
+# 发送群消息类的动作, 受 send_rate 限速
+SEND_ACTIONS = ("send_group_msg", "send_group_ai_record")
+
+# 连接状态
+STATE_DISCONNECTED = "disconnected"
+STATE_CONNECTING = "connecting"
+STATE_CONNECTED = "connected"
+STATE_RECONNECTING = "reconnecting"
+STATE_STOPPED = "stopped"
+
+
 class WebSocketClient:
-    def __init__(self, ws_url, on_message_callback, on_status_callback=None):
+    def __init__(self, ws_url, on_message_callback, on_status_callback=None, max_queue_size=1000, max_batch_size=20, outbox=None,
+                 action_timeout=10, max_in_flight=64, health_config=None, name="default", send_rate=0):
+        self.name = name  # 多账号时用于区分日志与统计
         self.ws_url = ws_url
         self.on_message_callback = on_message_callback
         self.ws = None
         self._stop_flag = False
         self._ws_thread = None
-        self._reconnect_delay = 5  # 秒
         self._reconnect_thread = None
+        # 连接健康监控: 指数退避重连 + ping/pong + OneBot 心跳看门狗 + RTT 采样
+        health_config = health_config or {}
+        self.backoff_base = health_config.get("backoff_base", 1)  # 首次重连等待(秒)
+        self.backoff_max = health_config.get("backoff_max", 60)  # 最长重连等待(秒)
+        self.ping_interval = health_config.get("ping_interval", 30)  # WebSocket ping 间隔, 0 为关闭
+        self.ping_timeout = health_config.get("ping_timeout", 10)  # 超过该时间未收到 pong 则断开
+        self.heartbeat_timeout = health_config.get("heartbeat_timeout", 60)  # 超过该时间未收到任何帧视为半开连接
+        self.rtt_interval = health_config.get("rtt_interval", 60)  # RTT 采样间隔
+        self.state = STATE_DISCONNECTED
+        self._state_lock = threading.Lock()
+        self._monitor_stop = threading.Event()
+        self._monitor_thread = None
+        self._reconnect_attempts = 0  # 连续重连失败次数, 连接成功后清零
+        self.reconnect_count = 0  # 累计重连次数
+        self.connected_since = None
+        self.last_pong_time = None
+        self.rtt_last = None
+        self.rtt_avg = None
+        self.auto_reconnect = True  # 由插件主动发起连接的传输方式才需要自动重连
         self.on_status_callback = on_status_callback
         self._lock = threading.Lock() 
         self.logger = logger
+        # 发送队列: 所有发送都由唯一的写线程完成, 调用线程只负责入队
+        self._send_queue = queue.Queue(maxsize=max_queue_size)
+        self._max_batch_size = max_batch_size  # 写线程每次唤醒最多连续发送的帧数
+        self._writer_stop = threading.Event()
+        self._writer_thread = None
+        self._stats_lock = threading.Lock()
+        self.outbox = outbox  # 断线期间暂存消息, 重连后补发
+        self.on_undeliverable = None  # 断线时无法发出的消息优先交给该回调(多账号时转交其他账号), 返回 True 表示已接管
+        self.send_rate = send_rate  # 每秒最多发送的群消息条数, 0 为不限制
+        self._next_send_at = 0.0
+        self.stats = {
+            "sent": 0,  # 成功发送的帧数
+            "dropped_full": 0,  # 队列已满被丢弃
+            "dropped_disconnected": 0,  # 未连接被丢弃
+            "failed": 0,  # 发送异常
+            "last_latency": 0.0,  # 最近一次从入队到发出的耗时(秒)
+            "avg_latency": 0.0,  # 入队到发出耗时的滑动平均(秒)
+            "max_latency": 0.0,
+            "calls_timeout": 0,  # 请求/响应调用超时次数
+            "calls_rejected": 0,  # 超出并发上限被拒绝的调用
+        }
+        # 请求/响应: echo -> (future, 截止时间)
+        self._pending_calls = {}
+        self._calls_lock = threading.Lock()
+        self.action_timeout = action_timeout
+        self.max_in_flight = max_in_flight
+        self.last_frame_time = 0.0  # 最近一次收到任意帧(包括心跳)的时间
+        self.meta_frames_skipped = 0
+
     def on_message(self, ws, message):
         """处理 WebSocket 消息"""
+        self.last_frame_time = time.time()
+        if is_meta_event_frame(message):  # 心跳等 meta_event 不需要解析
+            self.meta_frames_skipped += 1
+            return
         try:
-            data = json.loads(message)
+            data = json_loads(message)
             # logger.debug(f"接收到消息: {data}")
+            if self._resolve_call(data):
+                return
             self.on_message_callback(data)
         except Exception as e:
             logger.error(f"处理 WebSocket 消息时出错: {e}")
@@ -33,17 +114,33 @@ class WebSocketClient:
 
     def on_close(self, ws, close_status_code, close_msg):
         logger.warning("WebSocket 连接已关闭")
+        with self._state_lock:
+            if self.state in (STATE_CONNECTED, STATE_CONNECTING):
+                self.state = STATE_DISCONNECTED
+            self.connected_since = None
         if self.on_status_callback:
             self.on_status_callback(connected=False)
 
-    def _reconnect(self):
-        if self._stop_flag:
-            logger.info("WebSocket 已标记为停止，不进行重连")
-            return
+    def on_pong(self, ws, data):
+        self.last_pong_time = time.time()
 
-        if getattr(self, '_reconnecting', False):
-            logger.info("重连已在进行中，跳过")
-            return
+    def _next_backoff(self) -> float:
+        """指数退避 + 全抖动(在 0 到退避上限之间均匀取值), 避免多个客户端同时重连"""
+        delay = min(self.backoff_max, self.backoff_base * (2 ** self._reconnect_attempts))
+        return random.uniform(0, delay)
+
+    def _reconnect(self):
+        with self._state_lock:
+            if self._stop_flag:
+                logger.info("WebSocket 已标记为停止，不进行重连")
+                return
+            if self.state == STATE_RECONNECTING:
+                logger.info("重连已在进行中，跳过")
+                return
+            self.state = STATE_RECONNECTING
+            delay = self._next_backoff()
+            self._reconnect_attempts += 1
+            self.reconnect_count += 1
 
         if self.ws:
             try:
@@ -51,17 +148,21 @@ class WebSocketClient:
             except Exception as e:
                 logger.warning(f"关闭旧 ws 失败: {e}")
 
-        self._reconnecting = True
-
         def delayed_reconnect():
-            logger.info(f"{self._reconnect_delay}秒后尝试重新连接 WebSocket...")
-            time.sleep(self._reconnect_delay)
-            if not self._stop_flag:
-                logger.info("开始重新连接 WebSocket...")
-                self.start()
-            self._reconnecting = False
+            logger.info(f"{delay:.1f}秒后尝试第 {self._reconnect_attempts} 次重新连接 WebSocket...")
+            if self._monitor_stop.wait(delay) or self._stop_flag:
+                return
+            old_thread = self._ws_thread
+            if old_thread and old_thread.is_alive() and old_thread is not threading.current_thread():
+                old_thread.join(timeout=5)
+            with self._state_lock:
+                if self.state == STATE_RECONNECTING:
+                    self.state = STATE_DISCONNECTED
+            logger.info("开始重新连接 WebSocket...")
+            self.start()
 
-        threading.Thread(target=delayed_reconnect, daemon=True).start()
+        self._reconnect_thread = threading.Thread(target=delayed_reconnect, name="ws_reconnect", daemon=True)
+        self._reconnect_thread.start()
 
     def reconnect(self):
         """公共调用"""
@@ -71,6 +172,13 @@ class WebSocketClient:
     def on_open(self, ws):
         """处理 WebSocket 连接成功"""
         logger.info("WebSocket 连接成功")
+        with self._state_lock:
+            self.state = STATE_CONNECTED
+            self.connected_since = time.time()
+            self.last_frame_time = self.connected_since
+            self._reconnect_attempts = 0
+        if self.outbox:
+            self.outbox.start_replay(self._enqueue_replay, self.is_connected)
         if self.on_status_callback:
             self.on_status_callback(connected=True)
 
@@ -83,8 +191,81 @@ class WebSocketClient:
 
             logger.info("启动新的 WebSocket 连接线程")
             self._stop_flag = False
+            with self._state_lock:
+                self.state = STATE_CONNECTING
             self._ws_thread = threading.Thread(target=self._run, name="ws_thread", daemon=True)
             self._ws_thread.start()
+            self._start_writer()
+            self._start_monitor()
+
+    def _start_monitor(self):
+        """启动连接监控线程（已在运行则跳过）"""
+        if self._monitor_thread and self._monitor_thread.is_alive():
+            return
+        self._monitor_stop.clear()
+        self._monitor_thread = threading.Thread(target=self._monitor_loop, name="ws_monitor", daemon=True)
+        self._monitor_thread.start()
+
+    def _monitor_loop(self):
+        """
+        监控线程:
+        - 非重连状态下发现连接已断开(例如对端正常关闭)时触发重连
+        - 已连接但长时间没有任何帧(含 OneBot 心跳)时视为半开连接, 主动断开重连
+        - 定期用 get_status 请求采样往返延迟
+        """
+        last_rtt_sample = 0.0
+        while not self._monitor_stop.wait(timeout=5):
+            if self._stop_flag:
+                continue
+            now = time.time()
+            state = self.state
+            ws_thread_dead = not (self._ws_thread and self._ws_thread.is_alive())
+            if not self.auto_reconnect and state != STATE_CONNECTED:
+                continue
+            if state == STATE_DISCONNECTED or (state == STATE_CONNECTING and ws_thread_dead):
+                logger.warning("检测到 WebSocket 已断开，触发重连")
+                self._reconnect()
+            elif state == STATE_CONNECTED:
+                if self.heartbeat_timeout and now - self.last_frame_time > self.heartbeat_timeout:
+                    logger.warning(f"{self.heartbeat_timeout}秒内未收到任何数据(含心跳)，判定为半开连接，重新连接")
+                    self._reconnect()
+                elif self.rtt_interval and now - last_rtt_sample >= self.rtt_interval:
+                    last_rtt_sample = now
+                    self._sample_rtt()
+
+    def _sample_rtt(self):
+        """发送一次 get_status 并等待响应, 记录往返延迟"""
+        start = time.time()
+        future = self.call_action("get_status", timeout=self.action_timeout)
+        try:
+            future.result(timeout=self.action_timeout + 1)
+        except Exception as e:
+            logger.warning(f"RTT 采样失败: {e!r}")
+            return
+        rtt = time.time() - start
+        self.rtt_last = rtt
+        self.rtt_avg = rtt if self.rtt_avg is None else self.rtt_avg * 0.8 + rtt * 0.2
+
+    def get_health(self) -> dict:
+        """返回连接状态、在线时长、重连次数与 RTT"""
+        now = time.time()
+        return {
+            "state": self.state,
+            "uptime": now - self.connected_since if self.connected_since else 0.0,
+            "reconnect_count": self.reconnect_count,
+            "rtt_last": self.rtt_last,
+            "rtt_avg": self.rtt_avg,
+            "last_frame_age": now - self.last_frame_time if self.last_frame_time else None,
+            "meta_frames_skipped": self.meta_frames_skipped,
+        }
+
+    def _start_writer(self):
+        """启动写线程（已在运行则跳过）"""
+        if self._writer_thread and self._writer_thread.is_alive():
+            return
+        self._writer_stop.clear()
+        self._writer_thread = threading.Thread(target=self._writer_loop, name="ws_writer", daemon=True)
+        self._writer_thread.start()
 
     def _run(self):
         """运行 WebSocket"""
@@ -94,8 +275,12 @@ class WebSocketClient:
             on_message=self.on_message,
             on_error=self.on_error,
             on_close=self.on_close,
+            on_pong=self.on_pong,
         )
-        self.ws.run_forever()
+        if self.ping_interval:
+            self.ws.run_forever(ping_interval=self.ping_interval, ping_timeout=self.ping_timeout)
+        else:
+            self.ws.run_forever()
 
     def stop(self):
         """停止 WebSocket 客户端"""
@@ -103,17 +288,255 @@ class WebSocketClient:
             self.ws.close()
             logger.info("WebSocket Client已关闭")
 
-    def send_group_message(self, payload):
-        """发送群消息，支持单个或多个群号"""
+    def close(self):
+        """卸载插件时调用: 关闭连接并停止写线程与监控线程"""
+        self._stop_flag = True
+        with self._state_lock:
+            self.state = STATE_STOPPED
+        self._monitor_stop.set()
+        self.stop()
+        self._writer_stop.set()
+        if self._writer_thread and self._writer_thread.is_alive():
+            self._writer_thread.join(timeout=2)
+        if self.outbox:
+            self.outbox.close()
+
+    def is_connected(self) -> bool:
+        return bool(self.ws and self.ws.sock and self.ws.sock.connected)
+
+    def send_group_message(self, payload, wait=False, timeout=None):
+        """
+        发送群消息，支持单个或多个群号
+        :param payload: 单个 payload 或 payload 列表
+        :param wait: False 时只入队立即返回; True 时阻塞等待写线程发出
+        :param timeout: wait=True 时的最长等待时间(秒)
+        :return: wait=True 时返回是否全部发送成功, 否则返回是否全部入队成功
+        """
         if not isinstance(payload, list):
             payload = [payload]
-        
+
+        futures = []
+        all_queued = True
         for p in payload:
+            if self._should_buffer(p):
+                all_queued = self.outbox.push(p) and all_queued
+                continue
+            future = Future() if wait else None
             try:
-                message_json = json.dumps(p)
-                if self.ws and self.ws.sock and self.ws.sock.connected:
-                    self.ws.send(message_json)
-                else:
-                    logger.warning("WebSocket 未连接或已断开，尝试重连？")
-            except Exception as e:
-                logger.exception(f"发送消息失败: {e}, 消息内容: {p}")
\ No newline at end of file
+                self._send_queue.put_nowait(_OutboundItem(p, future))
+                if future:
+                    futures.append(future)
+            except queue.Full:
+                all_queued = False
+                self._incr("dropped_full")
+                logger.warning(f"发送队列已满({self._send_queue.maxsize})，丢弃消息: {p}")
+
+        if not wait:
+            return all_queued
+        try:
+            return all_queued and all(f.result(timeout=timeout) for f in futures)
+        except Exception as e:
+            logger.warning(f"等待消息发送结果失败: {e}")
+            return False
+
+    def call_action(self, action, params=None, timeout=None) -> Future:
+        """
+        发送一个 OneBot 动作并返回 Future, 响应到达后 Future 的结果为响应中的 data
+        :param action: 动作名, 如 get_group_member_info
+        :param params: 动作参数
+        :param timeout: 超时时间(秒), 超时后 Future 抛出 TimeoutError
+        """
+        future = Future()
+        if not self.is_connected():
+            future.set_exception(ConnectionError("WebSocket 未连接"))
+            return future
+
+        echo = f"{action}:{uuid.uuid4().hex}"
+        deadline = time.time() + (timeout or self.action_timeout)
+        with self._calls_lock:
+            if len(self._pending_calls) >= self.max_in_flight:
+                self._incr("calls_rejected")
+                future.set_exception(RuntimeError(f"进行中的请求已达上限({self.max_in_flight})"))
+                return future
+            self._pending_calls[echo] = (future, deadline)
+
+        payload = {"action": action, "params": params or {}, "echo": echo}
+        try:
+            self._send_queue.put_nowait(_OutboundItem(payload))
+        except queue.Full:
+            with self._calls_lock:
+                self._pending_calls.pop(echo, None)
+            self._incr("dropped_full")
+            future.set_exception(RuntimeError("发送队列已满"))
+        return future
+
+    def call_action_sync(self, action, params=None, timeout=None):
+        """call_action 的阻塞版本, 失败时记录日志并返回 None"""
+        timeout = timeout or self.action_timeout
+        try:
+            return self.call_action(action, params, timeout).result(timeout=timeout + 1)
+        except Exception as e:
+            logger.warning(f"调用 {action} 失败: {e!r}")
+            return None
+
+    def _resolve_call(self, data) -> bool:
+        """如果是 call_action 发起请求的响应, 完成对应的 Future 并返回 True"""
+        echo = data.get("echo") if isinstance(data, dict) else None
+        if not isinstance(echo, str):
+            return False
+        with self._calls_lock:
+            entry = self._pending_calls.pop(echo, None)
+        if not entry:
+            return False
+        future, _ = entry
+        if future.done():
+            return True
+        if data.get("status") == "failed" or data.get("retcode", 0) != 0:
+            future.set_exception(RuntimeError(
+                f"OneBot 动作失败 retcode={data.get('retcode')} {data.get('message') or data.get('wording', '')}"
+            ))
+        else:
+            future.set_result(data.get("data"))
+        return True
+
+    def _expire_calls(self):
+        """清理超时未收到响应的请求, 避免 _pending_calls 无限增长"""
+        now = time.time()
+        with self._calls_lock:
+            expired = [echo for echo, (_, deadline) in self._pending_calls.items() if deadline < now]
+            entries = [self._pending_calls.pop(echo) for echo in expired]
+        for future, _ in entries:
+            self._incr("calls_timeout")
+            if not future.done():
+                future.set_exception(TimeoutError("等待 OneBot 响应超时"))
+
+    def _should_buffer(self, payload) -> bool:
+        """未连接, 或发件箱还有未补发的消息时, 新消息也排进发件箱以保证顺序"""
+        if not self.outbox or not self.outbox.accepts(payload):
+            return False
+        if not self.is_connected():
+            return True
+        if len(self.outbox):
+            self.outbox.start_replay(self._enqueue_replay, self.is_connected)
+            return True
+        return False
+
+    def _enqueue_replay(self, payload):
+        """补发线程调用: 阻塞入队, 由写线程发出"""
+        self._send_queue.put(_OutboundItem(payload))
+
+    def queue_depth(self) -> int:
+        return self._send_queue.qsize()
+
+    def get_stats(self) -> dict:
+        """返回发送相关的统计数据"""
+        with self._stats_lock:
+            stats = dict(self.stats)
+        stats["queue_depth"] = self.queue_depth()
+        with self._calls_lock:
+            stats["calls_in_flight"] = len(self._pending_calls)
+        if self.outbox:
+            stats["outbox_pending"] = len(self.outbox)
+            stats["outbox"] = dict(self.outbox.stats)
+        return stats
+
+    def _incr(self, key, value=1):
+        with self._stats_lock:
+            self.stats[key] += value
+
+    def _record_latency(self, latency):
+        with self._stats_lock:
+            self.stats["last_latency"] = latency
+            self.stats["avg_latency"] = self.stats["avg_latency"] * 0.9 + latency * 0.1
+            self.stats["max_latency"] = max(self.stats["max_latency"], latency)
+
+    def _writer_loop(self):
+        """写线程: 取出一帧后顺带取出队列中已积压的帧, 连续发出"""
+        while not self._writer_stop.is_set():
+            self._expire_calls()
+            try:
+                item = self._send_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            batch = [item]
+            while len(batch) < self._max_batch_size:
+                try:
+                    batch.append(self._send_queue.get_nowait())
+                except queue.Empty:
+                    break
+            for index, item in enumerate(batch):
+                if not self._send_one(item):
+                    # 连接已断开: 本批剩余与队列中的消息都比发件箱里的旧, 按原顺序放回发件箱最前面
+                    self._handle_undeliverable(batch[index:] + self._drain_send_queue())
+                    break
+
+    def _drain_send_queue(self) -> list:
+        items = []
+        while True:
+            try:
+                items.append(self._send_queue.get_nowait())
+            except queue.Empty:
+                return items
+
+    def estimated_delay(self) -> float:
+        """按当前积压与发送速率估算一条新消息多久后能发出"""
+        if not self.send_rate:
+            return self.queue_depth() * 0.001
+        backlog_delay = (self.queue_depth() + 1) / self.send_rate
+        return max(0.0, self._next_send_at - time.time()) + backlog_delay
+
+    def _throttle(self, payload):
+        """按 send_rate 限制群消息的发送速率（只在写线程中调用）"""
+        if not self.send_rate or not isinstance(payload, dict) or payload.get("action") not in SEND_ACTIONS:
+            return
+        now = time.time()
+        if self._next_send_at > now:
+            time.sleep(self._next_send_at - now)
+            now = self._next_send_at
+        self._next_send_at = now + 1.0 / self.send_rate
+
+    def _transmit(self, payload):
+        """把一个 payload 发给 OneBot 实现, 由不同的传输方式覆盖（只在写线程中调用）"""
+        self.ws.send(json_dumps(payload))
+
+    def _send_one(self, item: _OutboundItem) -> bool:
+        """在写线程中序列化并发送单帧, 结果写入 future; 连接已断开、消息未处理时返回 False"""
+        success = False
+        try:
+            if not self.is_connected():
+                return False
+            self._throttle(item.payload)
+            self._transmit(item.payload)
+            success = True
+            self._incr("sent")
+            self._record_latency(time.time() - item.enqueued_at)
+        except ConnectionError as e:
+            logger.warning(f"[{self.name}] 发送时连接已断开: {e}")
+            return False
+        except Exception as e:
+            self._incr("failed")
+            logger.exception(f"发送消息失败: {e}, 消息内容: {item.payload}")
+        finally:
+            if item.future and not item.future.done():
+                item.future.set_result(success)
+        return True
+
+    def _handle_undeliverable(self, items):
+        """未连接时已出队的消息: 优先转交其他账号, 其次按原顺序放回发件箱最前面, 都不行才丢弃"""
+        transferred = 0
+        buffered = []
+        for item in items:
+            if item.future and not item.future.done():
+                item.future.set_result(False)
+            if self.on_undeliverable and self.on_undeliverable(self, item.payload):
+                transferred += 1
+            elif self.outbox and self.outbox.accepts(item.payload):
+                buffered.append(item.payload)
+            else:
+                self._incr("dropped_disconnected")
+                logger.warning(f"[{self.name}] WebSocket 未连接或已断开，丢弃消息: {item.payload}")
+        if transferred:
+            logger.info(f"[{self.name}] WebSocket 未连接，{transferred} 条消息已转交其他账号")
+        if buffered:
+            self.outbox.requeue(buffered)
+            logger.info(f"[{self.name}] WebSocket 未连接，{len(buffered)} 条消息已放回发件箱")
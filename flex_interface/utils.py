@@ -7,9 +7,39 @@ from pathlib import Path
 import re
 import shutil
 import hashlib
+import time
+from collections import OrderedDict
+try:
+    import orjson  # 可选依赖, 安装后自动启用
+except ImportError:
+    orjson = None
 
 logger = logging.getLogger("utils")
 
+# OneBot 心跳/生命周期事件的特征串; 字符串内容中的引号会被转义, 所以不会误匹配聊天内容
+_META_EVENT_MARKERS = ('"post_type":"meta_event"', '"post_type": "meta_event"')
+_META_EVENT_MARKERS_BYTES = tuple(m.encode() for m in _META_EVENT_MARKERS)
+
+
+def json_dumps(obj) -> str:
+    """序列化为紧凑的 JSON 字符串（不转义中文）, 安装了 orjson 时使用 orjson"""
+    if orjson is not None:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+def json_loads(data):
+    """解析 JSON 字符串或字节串, 安装了 orjson 时使用 orjson"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def is_meta_event_frame(frame) -> bool:
+    """不解析 JSON, 直接判断一帧是否为 meta_event（心跳、生命周期）"""
+    markers = _META_EVENT_MARKERS_BYTES if isinstance(frame, (bytes, bytearray)) else _META_EVENT_MARKERS
+    return any(marker in frame for marker in markers)
+
 class Config:
     def __init__(self, debug=False):
         self.debug = debug
@@ -60,6 +90,43 @@ class Config:
         """手动重新加载配置"""
         self.data = self.load_config()
 
+class RecentIdSet:
+    """
+    带TTL的有界ID集合, 用于丢弃重复投递的事件(例如断线重连后重复推送的同一条消息)
+    :param maxlen: 最多记录多少个ID, 超出后淘汰最早的
+    :param ttl: ID的有效期(秒)
+    """
+    def __init__(self, maxlen=2048, ttl=300):
+        self.maxlen = maxlen
+        self.ttl = ttl
+        self._ids = OrderedDict()  # id -> 首次出现的时间
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        while self._ids:
+            seen_at = next(iter(self._ids.values()))
+            if now - seen_at < self.ttl:
+                break
+            self._ids.popitem(last=False)
+
+    def add(self, item_id) -> bool:
+        """记录ID, 返回 True 表示首次出现, False 表示重复"""
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            if item_id in self._ids:
+                return False
+            self._ids[item_id] = now
+            if len(self._ids) > self.maxlen:
+                self._ids.popitem(last=False)
+            return True
+
+    def __len__(self):
+        with self._lock:
+            self._expire(time.time())
+            return len(self._ids)
+
+
 def _build_base_payload(group_id, message):
     """
     构建发送消息的基础 payload 结构
@@ -236,7 +303,52 @@ def build_message_from_qq(group_id, nickname, user_id, reply, text_content, at_t
     if current_text:
         merged_parts.append({"text": current_text})
 
-    return json.dumps(merged_parts, ensure_ascii=False)
+    return json_dumps(merged_parts)
+
+
+SENTENCE_PATTERN = re.compile(r'.+?(?:[。！？!?；;…~\n]+|\.(?=\s))[”’」』"\')）]*', re.S)
+NO_SENTINEL_STRIP = " \t\r\n'\"`‘’“”"
+
+
+def split_sentences(text: str, min_length: int = 6, limit: int = None):
+    """
+    按句末标点切分, 返回 (完整句子列表, 剩余未取出的原文)
+    短于 min_length 的句子并入下一句, 避免刷出很碎的消息
+    limit 指定时最多取出 limit 句; 剩余部分按原文返回, 句间的空白与换行不丢失
+    """
+    sentences = []
+    start = 0  # 已取出的句子在原文中的结束位置
+    if limit is not None and limit <= 0:
+        return sentences, text
+    for match in SENTENCE_PATTERN.finditer(text):
+        sentence = text[start:match.end()].strip()
+        if len(sentence) >= min_length:
+            sentences.append(sentence)
+            start = match.end()
+            if limit is not None and len(sentences) >= limit:
+                break
+    return sentences, text[start:]
+
+
+def is_no_sentinel(text: str) -> bool:
+    """AI 返回 'no' 表示不回复（允许带引号和空白）"""
+    return text.strip(NO_SENTINEL_STRIP).lower() == "no"
+
+
+def may_be_no_sentinel(text: str) -> bool:
+    """流式输出开头是否仍可能是 'no', 是则需要继续等待, 不能转发"""
+    return "no".startswith(text.strip(NO_SENTINEL_STRIP).lower())
+
+
+def compile_keywords(keywords):
+    """
+    把触发词编译成一个交替正则, 一次扫描即可判断是否命中任一关键词
+    长的词排在前面, 没有有效关键词时返回 None
+    """
+    words = sorted({str(word) for word in keywords or () if word}, key=len, reverse=True)
+    if not words:
+        return None
+    return re.compile("|".join(re.escape(word) for word in words))
 
 
 def has_permission(config, user_id, permission):
@@ -258,7 +370,7 @@ def send_gray_italic_message(server, text: str) -> None:
     发送灰色斜体消息（直接使用传入的完整文本）
     
     参数:
-        server: 需有 execute() 方法的服务器对象
+        server: 已挂载 dispatcher 的服务器对象
         text: 完整的消息内容（如 "[苦力仆] Yakult02在密谋..."）
     """
     tellraw_json = {
@@ -266,7 +378,7 @@ def send_gray_italic_message(server, text: str) -> None:
         "color": "gray",
         "italic": True
     }
-    server.execute(f'tellraw @a {json.dumps(tellraw_json, ensure_ascii=False)}')
+    server.dispatcher.tellraw_all(tellraw_json)
 
 def get_date_factor():
     import datetime
@@ -0,0 +1,149 @@
+"""
+本地 OpenAI 兼容接口替身, 用于在不消耗真实额度的情况下联调 AI 多接口路由（对冲、失败转移、熔断）
+
+用法:
+    python tools/ai_standin.py 端口[:延迟秒[:失败率]] [端口[:延迟秒[:失败率]] ...]
+    python tools/ai_standin.py 18001:0.3 18002:2.5 18003:0.3:1
+
+每个端口是一个独立的接口, 配置到 chat.providers 中即可, 例如:
+    {"name": "fast", "api_url": "http://127.0.0.1:18001/chat/completions", "api_key": "test"}
+
+替身会:
+- 对 POST 请求按设定延迟返回一条固定回复, 并按失败率随机返回 503（失败率为 1 时始终失败, 用于触发熔断）
+- 请求中 stream 为 true 时以 SSE 分段返回, 最后一个数据块带 usage
+- 运行中在控制台输入 "端口 延迟 [失败率]" 可以调整某个接口, 观察选路与熔断恢复
+"""
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPLY = "这是替身接口的测试回复，今天服务器也很热闹。"
+_request_ids = itertools.count(1)
+
+
+class Behavior:
+    def __init__(self, port, delay=0.3, fail_rate=0.0):
+        self.port = port
+        self.delay = delay
+        self.fail_rate = fail_rate
+        self.stats = {"requests": 0, "failed": 0}
+
+    def __str__(self):
+        return f"{self.port} 延迟{self.delay}s 失败率{self.fail_rate} 已处理{self.stats['requests']} 失败{self.stats['failed']}"
+
+
+def parse_behavior(spec):
+    parts = spec.split(":")
+    port = int(parts[0])
+    delay = float(parts[1]) if len(parts) > 1 else 0.3
+    fail_rate = float(parts[2]) if len(parts) > 2 else 0.0
+    return Behavior(port, delay, fail_rate)
+
+
+def fake_usage(request):
+    prompt_tokens = sum(len(str(message.get("content", ""))) for message in request.get("messages", []))
+    cache_hit = prompt_tokens // 2
+    return {
+        "prompt_tokens": prompt_tokens, "completion_tokens": len(REPLY),
+        "total_tokens": prompt_tokens + len(REPLY),
+        "prompt_cache_hit_tokens": cache_hit, "prompt_cache_miss_tokens": prompt_tokens - cache_hit
+    }
+
+
+def make_handler(behavior: Behavior):
+    class ApiHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_HEAD(self):  # 预热只建立连接
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            behavior.stats["requests"] += 1
+            request_id = next(_request_ids)
+            time.sleep(behavior.delay)
+            if random.random() < behavior.fail_rate:
+                behavior.stats["failed"] += 1
+                print(f"[{behavior.port}] #{request_id} 返回 503")
+                self._send_json(503, {"error": {"message": "standin unavailable"}})
+                return
+            print(f"[{behavior.port}] #{request_id} {'流式' if request.get('stream') else '普通'}请求")
+            if request.get("stream"):
+                self._send_stream(request)
+            else:
+                self._send_json(200, {
+                    "id": f"standin-{request_id}", "object": "chat.completion", "model": request.get("model", "standin"),
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": REPLY}, "finish_reason": "stop"}],
+                    "usage": fake_usage(request)
+                })
+
+        def _send_json(self, status, payload):
+            body = json.dumps(payload, ensure_ascii=False).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_stream(self, request):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            pieces = [REPLY[i:i + 4] for i in range(0, len(REPLY), 4)]
+            try:
+                for index, piece in enumerate(pieces):
+                    chunk = {"choices": [{"index": 0, "delta": {"content": piece}}]}
+                    if index == len(pieces) - 1:
+                        chunk["usage"] = fake_usage(request)
+                    self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+                    self.wfile.flush()
+                    time.sleep(0.05)
+                self.wfile.write(b"data: [DONE]\n\n")
+            except (BrokenPipeError, ConnectionResetError):
+                print(f"[{behavior.port}] 客户端中途断开流式请求")
+            self.close_connection = True
+
+        def log_message(self, format, *args):
+            pass
+
+    return ApiHandler
+
+
+def console(behaviors):
+    """读取控制台命令调整接口行为, 空行打印当前状态"""
+    for line in sys.stdin:
+        parts = line.split()
+        if not parts:
+            for behavior in behaviors.values():
+                print(behavior)
+            continue
+        try:
+            behavior = behaviors[int(parts[0])]
+            behavior.delay = float(parts[1])
+            if len(parts) > 2:
+                behavior.fail_rate = float(parts[2])
+            print(f"已调整: {behavior}")
+        except (KeyError, IndexError, ValueError):
+            print("格式: 端口 延迟 [失败率]")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    behaviors = {}
+    for spec in sys.argv[1:]:
+        behavior = parse_behavior(spec)
+        behaviors[behavior.port] = behavior
+        httpd = ThreadingHTTPServer(("127.0.0.1", behavior.port), make_handler(behavior))
+        httpd.daemon_threads = True
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        print(f"替身接口 http://127.0.0.1:{behavior.port}/chat/completions 延迟{behavior.delay}s 失败率{behavior.fail_rate}")
+    console(behaviors)
@@ -0,0 +1,107 @@
+"""
+本地 OneBot 替身, 用于在没有 Lagrange 的情况下联调 reverse / http 两种传输模式
+
+用法:
+    python tools/onebot_standin.py reverse ws://127.0.0.1:8081/onebot/v11/ws
+    python tools/onebot_standin.py http http://127.0.0.1:8082/ [API监听端口, 默认5700]
+
+替身会:
+- 对收到的每个动作返回 status=ok 的响应（send_group_msg 返回自增 message_id, get_group_list 返回一个测试群）
+- 启动后每隔几秒推送一条心跳和一条测试群消息
+"""
+import itertools
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+import websocket
+
+SELF_ID = 10001
+GROUP_ID = 123456
+_message_ids = itertools.count(1)
+
+
+def handle_action(action, params):
+    """按动作名生成假的响应数据"""
+    print(f"<- {action} {json.dumps(params, ensure_ascii=False)}")
+    if action in ("send_group_msg", "send_group_ai_record"):
+        return {"message_id": next(_message_ids)}
+    if action == "get_group_list":
+        return [{"group_id": GROUP_ID, "group_name": "测试群", "member_count": 3, "max_member_count": 200}]
+    if action == "get_status":
+        return {"online": True, "good": True}
+    if action == "can_send_record":
+        return {"yes": True}
+    return None
+
+
+def fake_events():
+    """交替生成心跳与测试群消息"""
+    for seq in itertools.count(1):
+        now = int(time.time())
+        yield {"time": now, "self_id": SELF_ID, "post_type": "meta_event", "meta_event_type": "heartbeat", "interval": 5000}
+        yield {
+            "time": now, "self_id": SELF_ID, "post_type": "message", "message_type": "group", "sub_type": "normal",
+            "message_id": 900000 + seq, "group_id": GROUP_ID, "user_id": 112233,
+            "message": [{"type": "text", "data": {"text": f"替身测试消息 {seq}"}}], "raw_message": f"替身测试消息 {seq}",
+            "sender": {"user_id": 112233, "nickname": "替身", "card": "替身"}
+        }
+
+
+def run_reverse(ws_url):
+    def on_message(ws, message):
+        request = json.loads(message)
+        response = {"status": "ok", "retcode": 0, "data": handle_action(request["action"], request.get("params", {}))}
+        if "echo" in request:
+            response["echo"] = request["echo"]
+        ws.send(json.dumps(response, ensure_ascii=False))
+
+    def on_open(ws):
+        def push():
+            for event in fake_events():
+                time.sleep(2.5)
+                ws.send(json.dumps(event, ensure_ascii=False))
+        threading.Thread(target=push, daemon=True).start()
+
+    ws = websocket.WebSocketApp(ws_url, on_open=on_open, on_message=on_message,
+                                header={"X-Self-ID": str(SELF_ID), "X-Client-Role": "Universal"})
+    ws.run_forever(reconnect=5)
+
+
+def run_http(webhook_url, api_port):
+    class ApiHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            params = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            data = handle_action(self.path.strip("/"), params)
+            body = json.dumps({"status": "ok", "retcode": 0, "data": data}, ensure_ascii=False).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", api_port), ApiHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    print(f"替身 HTTP API 监听 http://127.0.0.1:{api_port}")
+    for event in fake_events():
+        time.sleep(2.5)
+        try:
+            requests.post(webhook_url, json=event, timeout=5)
+        except requests.RequestException as e:
+            print(f"推送事件失败: {e}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] not in ("reverse", "http"):
+        print(__doc__)
+        sys.exit(1)
+    if sys.argv[1] == "reverse":
+        run_reverse(sys.argv[2])
+    else:
+        run_http(sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else 5700)